@@ -0,0 +1,414 @@
+"""
+This module is a load generation benchmark for mChat
+
+It starts a network of servers and a number of clients, lets the clients send messages at a fixed rate for a
+fixed time, and prints the results as JSON:
+
+    python3 benchmark.py --servers 3 --clients 300 --channels 30 --fanout 10 --size 200 --rate 5000 --duration 10
+
+The clients are driven by a few driver processes that handle their sockets with a selector, so thousands of
+clients don't need thousands of processes. Every message carries the time it was sent, so the receivers can
+measure the end-to-end latency. The topology is deterministic: client i connects to server i % servers and
+channel j has the clients (j * fanout + m) % clients, m < fanout, as members. The same arguments on the same
+machine give comparable results between commits. A fixed --rate measures latency, --rate 0 the largest
+throughput. Use --baseline with the JSON of an earlier run to make the
+benchmark fail (exit status 1) if the delivery rate has dropped more than --tolerance.
+
+Reference results on one 3-server host, all messages delivered, latency p50 / p90 / p99 in ms:
+
+    --servers 3 --clients 100 --rate 1000                                    0.63 / 1.12 / 2.57
+    --servers 3 --clients 300 --channels 30 --fanout 10 --size 200 --rate 5000   3.56 / 6.98 / 12.9
+    the same with --server-args=--asyncio                                    0.83 / 1.86 / 5.38 and 5.83 / 10.4 / 15.9
+
+Before the servers set TCP_NODELAY, Nagle's algorithm and delayed ACKs put the p90 of both at about 40 ms.
+"""
+
+import argparse
+import json
+import os
+import selectors
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from multiprocessing import Process, Queue, Event
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+SERVER_MAIN = os.path.join(base_dir, "server", "main.py")
+LISTEN_TIMEOUT = 10  # seconds to wait for a server to start listening
+DRAIN_TIME = 2  # seconds the clients keep receiving after the sending has stopped
+DRIVER_TIMEOUT = 60  # seconds, a driver that doesn't answer in time has failed
+RECV_SIZE = 65536
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="mChat load generation benchmark")
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--fanout", type=int, default=10, help="members per channel")
+    parser.add_argument("--size", type=int, default=100, help="bytes per MSG line")
+    parser.add_argument("--rate", type=int, default=1000,
+                        help="messages per second sent by all the clients together, 0 for as fast as the servers take them")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds between joining and sending")
+    parser.add_argument("--drivers", type=int, default=4, help="client driver processes")
+    parser.add_argument("--late-ms", type=float, default=1000, help="deliveries slower than this are late")
+    parser.add_argument("--base-port", type=int, default=47000,
+                        help="server i uses client port base + i and server port base + 1000 + i")
+    parser.add_argument("--server-args", default="",
+                        help="extra arguments for main.py, e.g. --server-args=\"--asyncio --binary-links\"")
+    parser.add_argument("--output", help="write the results to this file too")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="largest accepted drop of the delivery rate compared to the baseline")
+    args = parser.parse_args(argv)
+    if args.size < 64:
+        parser.error("--size must be at least 64")
+    args.fanout = min(args.fanout, args.clients)
+    return args
+
+
+# Returns the members of each channel as lists of client indexes
+def create_topology(args):
+    return [sorted(set((j * args.fanout + m) % args.clients for m in range(args.fanout)))
+            for j in range(args.channels)]
+
+
+def start_servers(args, work_dir):
+    procs = []
+    for i in range(args.servers):
+        command = [sys.executable, SERVER_MAIN, "start", "--non-daemon"] + args.server_args.split()
+        command += ["localhost", str(args.base_port + i), str(args.base_port + 1000 + i)]
+        if i > 0:
+            command += ["localhost", str(args.base_port + 1000)]
+        procs.append(subprocess.Popen(command, cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        wait_for_listen(args.base_port + i)
+    return procs
+
+
+def wait_for_listen(port):
+    deadline = time.monotonic() + LISTEN_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return
+        except socket.error:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Server on port {} didn't start".format(port))
+            time.sleep(0.05)
+
+
+def stop_servers(procs):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+    for proc in procs:
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+# The process and its descendants (worker processes), found through /proc
+def get_process_tree(pid):
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/{}/stat".format(entry)) as f:
+                    # the command name may contain spaces, the fields after it don't
+                    parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree = [pid]
+    for tree_pid in tree:
+        tree.extend(child for child, parent in parents.items() if parent == tree_pid)
+    return tree
+
+
+# Returns (CPU seconds, RSS in kB, peak RSS in kB) of the server and its workers, or None if /proc isn't available
+def get_server_usage(proc):
+    if not os.path.isdir("/proc"):
+        return None
+    cpu = 0.0
+    rss = 0
+    max_rss = 0
+    ticks = os.sysconf("SC_CLK_TCK")
+    for pid in get_process_tree(proc.pid):
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime and stime
+            with open("/proc/{}/status".format(pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1])
+                    elif line.startswith("VmHWM:"):
+                        max_rss += int(line.split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return (cpu, rss, max_rss)
+
+
+class BenchmarkClient():
+    __slots__ = ("index", "sock", "nick", "channels", "next_channel", "in_data", "out_data")
+
+    def __init__(self, index, sock, channels):
+        self.index = index
+        self.sock = sock
+        self.nick = "b" + str(index)
+        self.channels = channels  # names of the channels the client has joined
+        self.next_channel = 0  # the client sends to its channels in turns
+        self.in_data = bytearray()
+        self.out_data = bytearray()
+
+
+class Driver():
+    """
+    Runs in a driver process and handles a share of the clients. The results are put to the result queue as a
+    dict when the run is over.
+    """
+
+    def __init__(self, args, driver_id, topology, ready_queue, result_queue, go):
+        self.args = args
+        self.driver_id = driver_id
+        self.topology = topology
+        self.ready_queue = ready_queue
+        self.result_queue = result_queue
+        self.go = go
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.senders = []  # the clients that have joined a channel
+        self.sent = 0
+        self.expected = 0  # deliveries expected for the messages sent: members of the channel except the sender
+        self.delivered = 0
+        self.delivered_bytes = 0
+        self.late = 0
+        self.latencies = array("d")  # seconds
+        self.late_limit = args.late_ms / 1000
+
+    def run(self):
+        self.connect_clients()
+        self.ready_queue.put(self.driver_id)
+        self.go.wait()
+        start = time.monotonic()
+        send_end = start + self.args.duration
+        rate = self.args.rate / self.args.drivers
+        sender = 0
+        while True:
+            now = time.monotonic()
+            if now >= send_end + DRAIN_TIME:
+                break
+            if now < send_end and self.senders:
+                if rate:
+                    due = int((now - start) * rate) - self.sent
+                    for i in range(due):
+                        self.send_message(self.senders[sender % len(self.senders)])
+                        sender += 1
+                else:
+                    # Every client has one message on its way to the server at a time
+                    for client in self.senders:
+                        if not client.out_data:
+                            self.send_message(client)
+            for key, mask in self.selector.select(0.001):
+                if mask & selectors.EVENT_READ:
+                    self.read(key.data)
+                if mask & selectors.EVENT_WRITE:
+                    self.write(key.data)
+        self.result_queue.put({"sent": self.sent, "expected": self.expected, "delivered": self.delivered,
+                               "delivered_bytes": self.delivered_bytes, "late": self.late,
+                               "latencies": self.latencies})
+
+    def connect_clients(self):
+        memberships = {}
+        for channel, members in enumerate(self.topology):
+            for member in members:
+                memberships.setdefault(member, []).append("#bench" + str(channel))
+        for index in range(self.driver_id, self.args.clients, self.args.drivers):
+            sock = socket.create_connection(("localhost", self.args.base_port + index % self.args.servers))
+            # Each message is sent as soon as it's due, the latency shouldn't depend on Nagle's algorithm
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(False)
+            client = BenchmarkClient(index, sock, memberships.get(index, []))
+            self.clients.append(client)
+            if client.channels:
+                self.senders.append(client)
+            self.selector.register(sock, selectors.EVENT_READ, client)
+            self.queue(client, "NICK " + client.nick + "\n")
+            for channel in client.channels:
+                self.queue(client, "JOIN " + channel + "\n")
+
+    def send_message(self, client):
+        channel = client.channels[client.next_channel % len(client.channels)]
+        client.next_channel += 1
+        line = "MSG {} {} {!r} ".format(client.nick, channel, time.monotonic())
+        line += "x" * max(self.args.size - len(line) - 1, 0) + "\n"
+        self.queue(client, line)
+        self.sent += 1
+        self.expected += len(self.topology[int(channel[6:])]) - 1
+
+    def queue(self, client, line):
+        was_empty = not client.out_data
+        client.out_data += line.encode()
+        if was_empty:
+            self.write(client)
+
+    def write(self, client):
+        try:
+            sent = client.sock.send(client.out_data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        del client.out_data[:sent]
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if client.out_data else selectors.EVENT_READ
+        self.selector.modify(client.sock, events, client)
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            raise RuntimeError("Server closed the connection of client {}".format(client.index))
+        now = time.monotonic()
+        client.in_data += data
+        start = 0
+        while True:
+            end = client.in_data.find(b"\n", start)
+            if end < 0:
+                break
+            line = client.in_data[start:end]
+            start = end + 1
+            if line.startswith(b"MSG "):
+                fields = line.split(b" ", 4)
+                try:
+                    latency = now - float(fields[3])
+                except (IndexError, ValueError):
+                    continue
+                self.delivered += 1
+                self.delivered_bytes += len(line) + 1
+                self.latencies.append(latency)
+                if latency > self.late_limit:
+                    self.late += 1
+            elif line == b"HEART":
+                self.queue(client, "BLEED\n")
+        del client.in_data[:start]
+
+
+def run_driver(*args):
+    Driver(*args).run()
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_benchmark(args):
+    topology = create_topology(args)
+    work_dir = tempfile.mkdtemp(prefix="mchat_bench_")  # the servers write their logs to the working directory
+    servers = start_servers(args, work_dir)
+    drivers = []
+    try:
+        ready_queue = Queue()
+        result_queue = Queue()
+        go = Event()
+        drivers = [Process(target=run_driver, args=(args, i, topology, ready_queue, result_queue, go))
+                   for i in range(min(args.drivers, args.clients))]
+        args.drivers = len(drivers)
+        for driver in drivers:
+            driver.start()
+        for driver in drivers:
+            ready_queue.get(timeout=DRIVER_TIMEOUT)
+        # Let the joins and the channel subscriptions between the servers settle
+        time.sleep(args.warmup)
+        usage_before = [get_server_usage(server) for server in servers]
+        go.set()
+        results = [result_queue.get(timeout=args.duration + DRAIN_TIME + DRIVER_TIMEOUT) for driver in drivers]
+        usage_after = [get_server_usage(server) for server in servers]
+        for driver in drivers:
+            driver.join()
+    finally:
+        for driver in drivers:
+            if driver.is_alive():
+                driver.terminate()
+        stop_servers(servers)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    measured_time = args.duration + DRAIN_TIME
+    sent = sum(result["sent"] for result in results)
+    expected = sum(result["expected"] for result in results)
+    delivered = sum(result["delivered"] for result in results)
+    server_results = []
+    for before, after in zip(usage_before, usage_after):
+        if before is None or after is None:
+            server_results.append(None)
+            continue
+        server_results.append({"cpu_seconds": round(after[0] - before[0], 3),
+                               "cpu_percent": round((after[0] - before[0]) / measured_time * 100, 1),
+                               "rss_kb": after[1], "max_rss_kb": after[2]})
+    latency_ms = {}
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999), ("max", 1.0)):
+        value = percentile(latencies, fraction)
+        latency_ms[name] = None if value is None else round(value * 1000, 3)
+    config = vars(args).copy()
+    for key in ("output", "baseline", "tolerance"):
+        del config[key]
+    return {
+        "config": config,
+        "commit": get_commit(),
+        "python": sys.version.split()[0],
+        "sent": sent,
+        "sent_per_s": round(sent / args.duration, 1),
+        "expected_deliveries": expected,
+        "delivered": delivered,
+        "delivered_per_s": round(delivered / args.duration, 1),
+        "delivered_bytes_per_s": round(sum(result["delivered_bytes"] for result in results) / args.duration, 1),
+        "dropped": max(expected - delivered, 0),
+        "late": sum(result["late"] for result in results),
+        "latency_ms": latency_ms,
+        "servers": server_results,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=base_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Returns False if the delivery rate has dropped more than tolerance from the baseline
+def compare_to_baseline(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    if baseline["config"] != results["config"]:
+        print("Warning: the baseline was run with different arguments", file=sys.stderr)
+    change = (results["delivered_per_s"] - baseline["delivered_per_s"]) / max(baseline["delivered_per_s"], 1)
+    print("Delivery rate {:+.1f}% compared to {} ({} -> {} msgs/s)".format(
+        change * 100, baseline.get("commit"), baseline["delivered_per_s"], results["delivered_per_s"]), file=sys.stderr)
+    return change >= -tolerance
+
+
+def main():
+    args = parse_arguments(sys.argv[1:])
+    results = run_benchmark(args)
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    if args.baseline and not compare_to_baseline(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,11 +12,15 @@ class Client:
     MAX_NICK_LEN = 32
     MAX_ROOM_LEN = 64
     MAX_MSG_LEN = 1024 #Max size in bytes: 4096
+    MAX_REDIRECTS = 3 #A server can't send the client around forever
     
     def __init__(self, nick, prints_disabled=False):
         self.socket = None
         self.nick = nick
         self.rooms = []
+        self.redirects = 0 #How many redirects have been followed since the user connected
+        #Guards self.socket and self.rooms. The receiving thread replaces them when it follows a redirect.
+        self.lock = threading.RLock()
 
         self.heartbleed_interval = 2
         self.heartbleed_timer = Timer(5)
@@ -35,20 +39,22 @@ class Client:
         return True
     
     def sendString(self, string):
-        if self.isConnected():
-            try:
-                self.socket.sendall(string.encode())
-            except socket.error as e:
-                self.ui.printString("Send error, " + str(e))
-        else:
-            self.ui.printString("There is no connection.")
+        with self.lock:
+            if self.isConnected():
+                try:
+                    self.socket.sendall(string.encode())
+                except socket.error as e:
+                    self.ui.printString("Send error, " + str(e))
+            else:
+                self.ui.printString("There is no connection.")
             
     def getRoom(self, room_name):
-        for room in self.rooms:
-            if room.name == room_name:
-                return room
-            if room.getRoomNetworkName() == room_name:
-                return room
+        with self.lock:
+            for room in self.rooms:
+                if room.name == room_name:
+                    return room
+                if room.getRoomNetworkName() == room_name:
+                    return room
         return None
     
     def receiveMessagesAndCheckTimers(self):
@@ -92,10 +98,20 @@ class Client:
                 
             elif protocol_msg[0] == "BLEED":
                 self.heartbleed_timer.start()
+
+            elif protocol_msg[0] == "REDIRECT" and len(protocol_msg) == 3:
+                if self.redirects < Client.MAX_REDIRECTS:
+                    #The new connection gets a receiving thread of its own, so this one stops here
+                    self.followRedirect(protocol_msg[1], protocol_msg[2])
+                    return
             else:
                 self.ui.printString("Unidentified message: " + messages[0])
     
-    def connect(self, ip, port):
+    def connect(self, ip, port, redirects=0):
+        with self.lock:
+            self.connectLocked(ip, port, redirects)
+
+    def connectLocked(self, ip, port, redirects):
         if (self.isConnected()):
             self.ui.printString("There is a connection already. Disconnect before a new connection.")
             return
@@ -124,6 +140,7 @@ class Client:
             self.ui.printString("Connection failed.")
             return
         self.socket = sock
+        self.redirects = redirects
         t = threading.Thread(target=self.receiveMessagesAndCheckTimers)
         t.daemon = True
         t.start()
@@ -132,28 +149,53 @@ class Client:
         self.sendString("NICK " + self.nick + "\n")
         self.ui.printString("Connected to " + ip + ":" + str(port))
         
+    #The server is too busy and asks the client to use a less loaded server instead.
+    #The rooms that have been joined already are joined again on the new server. This runs in the receiving
+    #thread, so the lock is held until the rooms have been joined: a join, part or message from the main thread
+    #goes either to the old server before the redirect, or to the new one after it.
+    def followRedirect(self, ip, port):
+        with self.lock:
+            if not self.isConnected():
+                return #The user disconnected while the REDIRECT was on its way
+            rooms = list(self.rooms)
+            self.ui.printString("Redirected to " + ip + ":" + port)
+            self.disconnect()
+            self.connect(ip, port, self.redirects + 1)
+            if not self.isConnected():
+                return
+            for room in rooms:
+                if self.getRoom(room.name) == None:
+                    self.rooms.append(room)
+                    self.sendString("JOIN " + room.getRoomNetworkName() + "\n")
+
     def disconnect(self):
-        if (not self.isConnected()):
-            self.ui.printString("There is no connection.")
-            return
-        self.rooms = []
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-        except socket.error:
-            pass
-        self.socket = None
-        self.heartbleed_timer.reset()
-        self.ui.printString("Disconnected.")
+        with self.lock:
+            if (not self.isConnected()):
+                self.ui.printString("There is no connection.")
+                return
+            self.rooms = []
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+                self.socket.close()
+            except socket.error:
+                pass
+            self.socket = None
+            self.heartbleed_timer.reset()
+            self.ui.printString("Disconnected.")
     
     def quit(self):
-        if self.isConnected():
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
+        with self.lock:
+            if self.isConnected():
+                self.socket.shutdown(socket.SHUT_RDWR)
+                self.socket.close()
         self.ui.printString("Goodbye!")
         sys.exit()
         
     def sendMessage(self, room_name, message):
+        with self.lock:
+            self.sendMessageLocked(room_name, message)
+
+    def sendMessageLocked(self, room_name, message):
         if (not self.isConnected()):
             self.ui.printString("There is no connection.")
             return
@@ -186,6 +228,10 @@ class Client:
             self.ui.printString("Nick changed to " + new_nick + ".")
         
     def join(self, room_name, password=None):
+        with self.lock:
+            self.joinLocked(room_name, password)
+
+    def joinLocked(self, room_name, password):
         if (not self.isConnected()):
             self.ui.printString("There is no connection.")
             return
@@ -206,6 +252,10 @@ class Client:
         self.sendString(message_format)
     
     def part(self, room_name):
+        with self.lock:
+            self.partLocked(room_name)
+
+    def partLocked(self, room_name):
         if (not self.isConnected()):
             self.ui.printString("There is no connection.")
             return
@@ -218,12 +268,16 @@ class Client:
         self.rooms.remove(room)
         self.sendString(message_format)
         
-    def sendKeepAliveMessage(self):
-        if self.socket != None:
-            self.sendString("HEART\n")
-            thread = threading.Timer(self.heartbleed_interval, self.sendKeepAliveMessage)
-            thread.daemon = True # the main thread won't wait for this thread after exiting
-            thread.start()
+    def sendKeepAliveMessage(self, sock=None):
+        with self.lock:
+            if sock == None:
+                sock = self.socket
+            #Stop when the connection is closed, a new connection gets a keepalive thread of its own
+            if self.socket != None and self.socket is sock:
+                self.sendString("HEART\n")
+                thread = threading.Timer(self.heartbleed_interval, self.sendKeepAliveMessage, (sock,))
+                thread.daemon = True # the main thread won't wait for this thread after exiting
+                thread.start()
             
     def checkTimers(self):
         if (self.heartbleed_timer.has_expired()):
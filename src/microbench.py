@@ -0,0 +1,399 @@
+"""
+This module is a micro-benchmark suite for the hot paths of the mChat server
+
+Each benchmark runs one operation many times against data structures of growing size and reports the time
+per operation, so that a change in complexity shows up as a time that grows with the size:
+
+    python3 microbench.py --sizes 1000,10000,100000 --channels 30000 --output micro.json
+
+Sizes are numbers of connections. The channel benchmarks spread the connections over --channels channels,
+each connection joining --joins of them. The message benchmarks run the real MChatServer handlers with send()
+replaced by a counter, so they measure parsing, validation and routing but not the sockets. The results are
+printed as JSON. Use --baseline with the JSON of an earlier run to make the suite fail (exit status 1) if any
+benchmark has become more than --tolerance slower.
+
+Besides the time, every benchmark reports the memory blocks it leaves allocated per operation and the peak
+memory it used while running, both measured with tracemalloc. Python can't count short-lived allocations, so
+an operation that allocates and frees its temporary objects shows up only in the peak.
+"""
+
+import argparse
+import gc
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+
+base_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(base_dir, "server"))
+
+from benchmark import get_commit
+from channelmanager import ChannelManager
+from connectionmanager import ConnectionManager
+from linebuffer import LineBuffer
+from server import MChatServer
+from timerwheel import TimerWheel
+
+LINE_CHUNK_SIZE = 64 * 1024  # bytes of lines written to the socketpair at a time
+MESSAGE_FANOUT = 10  # other members in the channel of the message benchmarks
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(description="mChat server micro-benchmarks")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated numbers of connections")
+    parser.add_argument("--channels", type=int, default=30000)
+    parser.add_argument("--joins", type=int, default=3, help="channels joined by each connection")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark and size, the fastest counts")
+    parser.add_argument("--only", help="run only the benchmarks whose name matches this regular expression")
+    parser.add_argument("--output", help="write the results to this file too")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="largest accepted slowdown of a benchmark compared to the baseline")
+    args = parser.parse_args(argv)
+    try:
+        args.sizes = [int(size) for size in args.sizes.split(",")]
+    except ValueError:
+        parser.error("--sizes must be comma separated integers")
+    args.joins = max(1, min(args.joins, args.channels))
+    return args
+
+
+# Every benchmark is a function setup(n, args) that builds the data structures for n connections and returns
+# (run, ops): calling run() performs ops operations. A fresh setup is made for every run, so run() may change
+# the data structures as it likes.
+
+def channel_names(args):
+    return ["#channel{}".format(i) for i in range(args.channels)]
+
+
+# (socket, channel) pairs for n connections. Connections are ints: the managers only use them as keys.
+def memberships(n, args):
+    names = channel_names(args)
+    return [(sock, names[(sock * args.joins + j) % len(names)]) for sock in range(n) for j in range(args.joins)]
+
+
+def joined_channels(n, args):
+    channels = ChannelManager(args.channels, n)
+    pairs = memberships(n, args)
+    for sock, channel in pairs:
+        channels.join(sock, channel)
+    return channels, pairs
+
+
+def setup_channel_join(n, args):
+    channels = ChannelManager(args.channels, n)
+    pairs = memberships(n, args)
+
+    def run():
+        join = channels.join
+        for sock, channel in pairs:
+            join(sock, channel)
+    return run, len(pairs)
+
+
+def setup_channel_part(n, args):
+    channels, pairs = joined_channels(n, args)
+
+    def run():
+        part = channels.part
+        for sock, channel in pairs:
+            part(sock, channel)
+    return run, len(pairs)
+
+
+def setup_channel_part_all(n, args):
+    channels, pairs = joined_channels(n, args)
+
+    def run():
+        part_all = channels.part_all
+        for sock in range(n):
+            part_all(sock)
+    return run, n
+
+
+def setup_channel_get_channels_of_socket(n, args):
+    channels, pairs = joined_channels(n, args)
+
+    def run():
+        get_channels_of_socket = channels.get_channels_of_socket
+        for sock in range(n):
+            get_channels_of_socket(sock)
+    return run, n
+
+
+def added_connections(n):
+    connections = ConnectionManager(n, ConnectionManager.TYPE_CLIENT)
+    for sock in range(n):
+        connections.add(sock, None, "nick{}".format(sock))
+    return connections
+
+
+def setup_connection_add(n, args):
+    connections = ConnectionManager(n, ConnectionManager.TYPE_CLIENT)
+    nicks = ["nick{}".format(sock) for sock in range(n)]
+
+    def run():
+        add = connections.add
+        for sock in range(n):
+            add(sock, None, nicks[sock])
+    return run, n
+
+
+def setup_connection_remove(n, args):
+    connections = added_connections(n)
+
+    def run():
+        remove = connections.remove
+        for sock in range(n):
+            remove(sock)
+    return run, n
+
+
+def setup_connection_get_nickname(n, args):
+    connections = added_connections(n)
+
+    def run():
+        get_nickname = connections.get_nickname
+        for sock in range(n):
+            get_nickname(sock)
+    return run, n
+
+
+def setup_connection_set_heartbleed_received(n, args):
+    connections = added_connections(n)
+
+    def run():
+        set_heartbleed_received = connections.set_heartbleed_received
+        for sock in range(n):
+            set_heartbleed_received(sock)
+    return run, n
+
+
+# A server that is never started. It writes its log file to the working directory, so main() runs the
+# benchmarks in a temporary directory.
+def create_server(n):
+    server = MChatServer(os.path.join(os.getcwd(), "microbench.pid"), "localhost", 1, 2)
+    server.clients.max_connections = n
+    server.sent = 0
+
+    def send(sock, data, frame=None):
+        server.sent += 1
+    server.send = send
+    for sock in range(n):
+        server.clients.add(sock, None, "nick{}".format(sock))
+    return server
+
+
+# All n clients are due, so every one of them is checked, sent a HEART and scheduled again
+def setup_heartbleed_due(n, args):
+    server = create_server(n)
+    tick = MChatServer.HEARTBLEED_TICK
+    server.heartbleed_wheel = TimerWheel(tick, len(server.heartbleed_wheel.slots), time.monotonic() - 2 * tick)
+    for sock in range(n):
+        server.heartbleed_wheel.schedule(sock, 0)
+    return server.process_heartbleeds, n
+
+
+# None of the n clients is due. One operation is one call of process_heartbleeds(). The deadlines are half an
+# interval away, so no tick that passes during the run has keys in its slot.
+def setup_heartbleed_idle(n, args):
+    server = create_server(n)
+    deadline = time.monotonic() + MChatServer.HEARTBLEED_INTERVAL / 2
+    for sock in range(n):
+        server.heartbleed_wheel.schedule(sock, deadline)
+    calls = 1000
+
+    def run():
+        process_heartbleeds = server.process_heartbleeds
+        for i in range(calls):
+            process_heartbleeds()
+    return run, calls
+
+
+# n lines of a typical MSG size are received from a socketpair. The send on the other end is included, but it
+# is one system call per LINE_CHUNK_SIZE bytes.
+def setup_linebuffer_recv(n, args):
+    line = b"MSG nick0 #channel0 " + b"x" * 80 + b"\n"
+    lines_per_chunk = LINE_CHUNK_SIZE // len(line)
+    chunks = [line * lines_per_chunk] * (n // lines_per_chunk) + [line * (n % lines_per_chunk)]
+    reader, writer = socket.socketpair()
+    recv_buffer = LineBuffer(MChatServer.PROTOCOL_MSG_MAXLEN * 4)
+
+    def run():
+        try:
+            for chunk in chunks:
+                writer.sendall(chunk)
+                received = 0
+                while received < len(chunk):
+                    recv_buffer.recv(reader)
+                    data = recv_buffer.next_line()
+                    while data is not None:
+                        received += len(data) + 1
+                        data = recv_buffer.next_line()
+        finally:
+            reader.close()
+            writer.close()
+    return run, n
+
+
+# The client of the message benchmarks is socket n, and it shares a channel with MESSAGE_FANOUT other clients
+def create_message_server(n):
+    server = create_server(n + 1)
+    for sock in range(n - MESSAGE_FANOUT, n + 1):
+        server.channels.join(sock, "#bench")
+    return server
+
+
+def setup_client_messages(n, args):
+    server = create_message_server(n)
+    sock = n
+    messages = [("MSG nick{} #bench ".format(sock) + "x" * 80).encode(), b"HEART", b"BLEED",
+                "NICK nick{}".format(sock).encode()]
+    ops = 100000
+
+    def run():
+        handle_client_message = server.handle_client_message
+        for i in range(ops):
+            handle_client_message(sock, messages[i & 3])
+    return run, ops
+
+
+# The lines end with their newline, as the server reads them from its server links
+def setup_server_lines(n, args):
+    server = create_message_server(n)
+    sock = n + 1
+    server.servers.add(sock, ("localhost", 3))
+    lines = [("MSG nick0 #bench " + "x" * 80 + "\n").encode(), "SYSTEM #bench nick0 joined channel\n".encode()]
+    ops = 100000
+
+    def run():
+        handle_server_line = server.handle_server_line
+        for i in range(ops):
+            handle_server_line(sock, lines[i & 1])
+    return run, ops
+
+
+BENCHMARKS = [
+    ("channel_join", setup_channel_join),
+    ("channel_part", setup_channel_part),
+    ("channel_part_all", setup_channel_part_all),
+    ("channel_get_channels_of_socket", setup_channel_get_channels_of_socket),
+    ("connection_add", setup_connection_add),
+    ("connection_remove", setup_connection_remove),
+    ("connection_get_nickname", setup_connection_get_nickname),
+    ("connection_set_heartbleed_received", setup_connection_set_heartbleed_received),
+    ("heartbleed_due", setup_heartbleed_due),
+    ("heartbleed_idle", setup_heartbleed_idle),
+    ("linebuffer_recv", setup_linebuffer_recv),
+    ("client_messages", setup_client_messages),
+    ("server_lines", setup_server_lines),
+]
+
+
+# Returns the results of one benchmark at one size. The garbage collector is disabled while measuring, so its
+# pauses don't land on random operations.
+def run_benchmark(setup, n, args):
+    best = None
+    for i in range(args.repeat):
+        run, ops = setup(n, args)
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+
+    run, ops = setup(n, args)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start_size = tracemalloc.get_traced_memory()[0]
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    return {
+        "n": n,
+        "ops": ops,
+        "ns_per_op": round(best / ops * 1e9, 1),
+        "blocks_per_op": round(blocks / ops, 3),
+        "peak_kb": round((peak - start_size) / 1024, 1),
+    }
+
+
+def run_benchmarks(args):
+    results = {}
+    for name, setup in BENCHMARKS:
+        if args.only and not re.search(args.only, name):
+            continue
+        results[name] = []
+        for n in args.sizes:
+            result = run_benchmark(setup, n, args)
+            print("{:<36} n={:<8} {:>10.1f} ns/op {:>8.3f} blocks/op {:>10.1f} kB peak".format(
+                name, n, result["ns_per_op"], result["blocks_per_op"], result["peak_kb"]), file=sys.stderr)
+            results[name].append(result)
+    config = vars(args).copy()
+    for key in ("output", "baseline", "tolerance"):
+        del config[key]
+    return {
+        "config": config,
+        "commit": get_commit(),
+        "python": sys.version.split()[0],
+        "benchmarks": results,
+    }
+
+
+# Returns False if any benchmark that is in the baseline too has become more than tolerance slower
+def compare_to_baseline(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    passed = True
+    for name, runs in results["benchmarks"].items():
+        baseline_runs = {run["n"]: run for run in baseline["benchmarks"].get(name, [])}
+        for run in runs:
+            baseline_run = baseline_runs.get(run["n"])
+            if baseline_run is None:
+                continue
+            change = (run["ns_per_op"] - baseline_run["ns_per_op"]) / max(baseline_run["ns_per_op"], 0.1)
+            if change > tolerance:
+                print("{} n={} is {:+.1f}% slower than {} ({} -> {} ns/op)".format(
+                    name, run["n"], change * 100, baseline.get("commit"), baseline_run["ns_per_op"],
+                    run["ns_per_op"]), file=sys.stderr)
+                passed = False
+    return passed
+
+
+def main():
+    args = parse_arguments(sys.argv[1:])
+    output_path = os.path.abspath(args.output) if args.output else None
+    work_dir = tempfile.mkdtemp(prefix="mchat-microbench-")
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        results = run_benchmarks(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    output = json.dumps(results, indent=2)
+    print(output)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(output + "\n")
+    if args.baseline and not compare_to_baseline(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import os
+
+
+class AddressBook():
+    """
+    The listen addresses of the other servers we know of, as (ip, port) tuples in the order we heard of them.
+    Adding, removing and membership tests take constant time.
+
+    The addresses can be saved to a file, one "<ip> <port>" per line, so that a restarted server can reconnect
+    to its previous neighbours right away instead of discovering them through one seed server.
+    """
+
+    def __init__(self, path=None):
+        self.path = path  # the cache file, or None if the addresses are not saved
+        self.addrs = {}  # (ip, port) -> None, the dict works as a set that remembers the order
+        self.changed = False  # True if there are changes that have not been saved yet
+
+    def __contains__(self, addr):
+        return addr in self.addrs
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def __iter__(self):
+        return iter(self.addrs)
+
+    # Returns True if addr was not known yet
+    def add(self, addr):
+        if addr in self.addrs:
+            return False
+        self.addrs[addr] = None
+        self.changed = True
+        return True
+
+    def discard(self, addr):
+        if addr in self.addrs:
+            del self.addrs[addr]
+            self.changed = True
+
+    # Returns the addresses as a list. Takes linear time.
+    def get_addrs(self):
+        return list(self.addrs)
+
+    # Add the addresses saved in the cache file. Invalid lines, including undecodable bytes, are skipped, and a
+    # missing file is not an error.
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "r", errors="replace") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            fields = line.split()
+            if len(fields) == 2 and fields[1].isascii() and fields[1].isdigit() and 0 < int(fields[1]) < 65536:
+                self.add((fields[0], int(fields[1])))
+        self.changed = False
+
+    # Write the addresses to the cache file if they have changed. The file is replaced atomically, so a crash
+    # never leaves a half written cache behind. Raises OSError if the file can't be written.
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for ip, port in self.addrs:
+                f.write("{} {}\n".format(ip, port))
+        os.replace(tmp_path, self.path)
+        self.changed = False
@@ -0,0 +1,255 @@
+import asyncio
+import signal
+import socket
+import time
+from collections import deque
+from server import MChatServer
+from connectattempt import ConnectAttempt
+
+
+class StreamSocket(asyncio.Protocol):
+    """
+    Makes an asyncio transport look like the non-blocking socket MChatServer expects: recv() returns what has
+    been received so far and raises BlockingIOError when there's nothing to read, sendmsg() raises BlockingIOError
+    while the transport has asked us to pause writing.
+    """
+
+    def __init__(self, server, connection_made_handler=None):
+        self.server = server
+        self.connection_made_handler = connection_made_handler  # called with self when the connection is made
+        self.transport = None
+        self.chunks = deque()  # received data that hasn't been recv()'d yet
+        self.eof = False
+        self.writing_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.set_nodelay(transport.get_extra_info("socket"))
+        if self.connection_made_handler is not None:
+            self.connection_made_handler(self)
+
+    def data_received(self, data):
+        self.chunks.append(data)
+        self.notify_readable()
+
+    def eof_received(self):
+        self.eof = True
+        self.notify_readable()
+        return False  # let the transport close itself
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.notify_readable()
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self in self.server.connections:
+            self.server.flush(self)
+
+    # Data arriving before the connection has been added to the server stays in self.chunks until then
+    def notify_readable(self):
+        connection = self.server.connections.get(self)
+        if connection is not None and not connection.reads_paused:
+            connection.read(self)
+
+    # Returns everything received so far, bufsize is ignored
+    def recv(self, bufsize, flags=0):
+        if self.chunks:
+            data = b"".join(self.chunks)
+            self.chunks.clear()
+            return data
+        if self.eof:
+            return b""
+        raise BlockingIOError
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        if self.transport is None or self.transport.is_closing():
+            raise BrokenPipeError("Connection closed")
+        if self.writing_paused:
+            raise BlockingIOError
+        self.transport.writelines(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+    def getpeername(self):
+        peername = None
+        if self.transport is not None:
+            peername = self.transport.get_extra_info("peername")
+        if peername is None:
+            raise socket.error("Not connected")
+        return peername
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class AsyncMChatServer(MChatServer):
+    """
+    Runs the same protocol as MChatServer on an asyncio event loop. Peer connects run as tasks, the heartbleed
+    and candidate server deadlines are checked by a periodic task, and writes are buffered by the transports.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncMChatServer, self).__init__(*args, **kwargs)
+        self.loop = None
+        self.tasks = set()  # running tasks, a reference has to be kept until they are done
+        self.flush_scheduled = False
+
+    def run(self):
+        """
+        Overrides run() of MChatServer
+        """
+        self.log_listener.start()
+        try:
+            asyncio.run(self.__start_server())
+        except (KeyboardInterrupt, SystemExit):
+            self.logger.info("Server stopped.")
+        except Exception as e:
+            self.logger.exception("Uncaught exception:")
+            raise e
+        finally:
+            self.save_known_servers(force=True)
+            self.log_listener.stop()
+
+    async def __start_server(self):
+        """
+        Only run this function from the run() wrapper.
+        """
+        signal.signal(signal.SIGTERM, self.sigterm_handler)
+        # The event loop backs off by itself when accepting fails because of the file descriptor limit
+        self.raise_fd_limit()
+        self.loop = asyncio.get_running_loop()
+        # The callback is run by the loop, not in the middle of whatever the loop is doing
+        self.loop.add_signal_handler(signal.SIGUSR1, self.handle_profile_signal)
+        # A worker starts with SIGUSR1 blocked (see WorkerGroup.run)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+
+        self.create_listen_sockets()
+        listeners = [await self.loop.create_server(lambda: StreamSocket(self, self.client_connected),
+                                                   sock=self.client_listen_socket)]
+        if self.gateway:
+            listeners.append(await self.loop.create_server(lambda: StreamSocket(self, self.server_connected),
+                                                           sock=self.server_listen_socket))
+        if self.admin_listen_socket is not None:
+            listeners.append(await asyncio.start_server(self.serve_admin, sock=self.admin_listen_socket,
+                                                        limit=MChatServer.ADMIN_REQUEST_MAXLEN))
+        for link in self.worker_links:
+            _, stream = await self.loop.connect_accepted_socket(lambda: StreamSocket(self), link)
+            self.add_worker(stream)
+
+        log_message = "Server started on '{}'. Client port: {}, Server port: {} (asyncio)".format(self.ip, self.client_listen_port, self.server_listen_port)
+        self.logger.info(log_message)
+
+        self.connect_to_new_servers()
+        try:
+            await self.heartbleed_task()
+        finally:
+            for listener in listeners:
+                listener.close()
+
+    async def serve_admin(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), MChatServer.ADMIN_TIMEOUT)
+            writer.write(self.create_admin_response(request))
+            await asyncio.wait_for(writer.drain(), MChatServer.ADMIN_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, socket.error):
+            pass
+        finally:
+            writer.close()
+
+    def start_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    # The loop latency is measured as how much later than asked the sleep of this task ends
+    async def heartbleed_task(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(MChatServer.HEARTBLEED_TICK)
+            self.update_loop_latency(max(time.monotonic() - started - MChatServer.HEARTBLEED_TICK, 0))
+            self.process_heartbleeds()
+            self.report_load()
+            self.maintain_overlay()
+            self.connect_to_new_servers()
+            self.save_known_servers()
+
+    def client_connected(self, stream):
+        try:
+            addr = stream.getpeername()
+        except socket.error:
+            stream.close()
+            return
+        self.add_client(stream, addr)
+
+    def server_connected(self, stream):
+        self.add_candidate_server(stream)
+
+    def promote_candidate_server(self, sock):
+        connection = self.connections[sock]
+        connection.read = self.read_server
+        connection.close = self.close_server
+        self.candidate_servers.discard(sock)
+
+    # The connects run as tasks. The event loop resolves the host name in its default executor.
+    def start_connect(self, server_addr, attempt):
+        if self.is_own_address(server_addr[0], server_addr[1]):
+            return
+        if server_addr in self.connect_attempts or self.servers.has_listen_addr(server_addr):
+            return
+        connect_attempt = ConnectAttempt(server_addr, attempt)
+        self.connect_attempts[server_addr] = connect_attempt
+        self.start_task(self.connect_server(connect_attempt))
+
+    async def connect_server(self, connect_attempt):
+        ip, port = connect_attempt.server_addr
+        try:
+            _, stream = await asyncio.wait_for(self.loop.create_connection(lambda: StreamSocket(self), ip, port),
+                                               MChatServer.CONNECT_TIMEOUT)
+        except (socket.error, asyncio.TimeoutError) as e:
+            self.connect_failed(connect_attempt, e)
+            return
+        del self.connect_attempts[connect_attempt.server_addr]
+        # Another attempt found a parent for the overlay while this one was connecting
+        if self.overlay and self.overlay_parent is not None:
+            stream.close()
+            return
+        self.add_connected_server(stream, connect_attempt.server_addr)
+        # ALL_ADDRS has most likely arrived already
+        if stream in self.connections:
+            self.read_server(stream)
+
+    # The transport calls StreamSocket when there's something to read, nothing to register
+    def register(self, sock, read_handler):
+        pass
+
+    # Flush once the callbacks that are ready to run in this loop iteration have been run
+    def schedule_flush(self, sock):
+        self.pending_flushes.add(sock)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush_pending)
+
+    def flush_pending(self):
+        self.flush_scheduled = False
+        super(AsyncMChatServer, self).flush_pending()
+
+    def close_connection(self, sock):
+        connection = self.connections.pop(sock, None)
+        if connection is not None:
+            connection.metrics.closed.inc()
+        self.heartbleed_wheel.cancel(sock)
+        sock.close()
+
+    def update_events(self, sock):
+        connection = self.connections[sock]
+        was_paused = connection.reads_paused
+        self.update_reads_paused(sock, connection)
+        if connection.reads_paused and not was_paused:
+            sock.transport.pause_reading()
+        elif was_paused and not connection.reads_paused:
+            sock.transport.resume_reading()
@@ -0,0 +1,61 @@
+"""
+This module implements the binary framing of server links (see MChatServer.handle_caps). Every frame starts
+with a fixed header
+
+    type (1 byte), flags (1 byte), channel length (2 bytes), nick length (2 bytes), payload length (4 bytes)
+
+in network byte order, followed by the channel, nick and payload bytes. MSG and SYSTEM frames carry their
+fields in the header, so they can be routed and passed on without touching the payload. Any other message is
+sent as a TYPE_TEXT frame whose payload is the text protocol message.
+"""
+
+import struct
+
+HEADER = struct.Struct("!BBHHI")
+
+TYPE_TEXT = 0
+TYPE_MSG = 1  # MSG <nick> <channel> <payload>
+TYPE_SYSTEM = 2  # SYSTEM <channel> <payload>
+TYPE_BATCH = 3  # payload is a batch of frames, see LinkBatcher
+
+FLAG_COMPRESSED = 1  # TYPE_BATCH only
+
+
+def encode(frame_type, payload, channel=b"", nick=b"", flags=0):
+    return HEADER.pack(frame_type, flags, len(channel), len(nick), len(payload)) + channel + nick + payload
+
+
+# line is a newline terminated text protocol message
+def encode_text(line):
+    return encode(TYPE_TEXT, line[:-1])
+
+
+# Returns the size of the frame that starts at data[start], or None if its header hasn't been received yet
+def frame_size(data, start):
+    if len(data) - start < HEADER.size:
+        return None
+    _, _, channel_len, nick_len, payload_len = HEADER.unpack_from(data, start)
+    return HEADER.size + channel_len + nick_len + payload_len
+
+
+# Returns (type, flags, channel, nick, payload) of a complete frame
+def decode(frame):
+    frame_type, flags, channel_len, nick_len, payload_len = HEADER.unpack_from(frame)
+    channel_start = HEADER.size
+    nick_start = channel_start + channel_len
+    payload_start = nick_start + nick_len
+    return (frame_type, flags, frame[channel_start:nick_start], frame[nick_start:payload_start],
+            frame[payload_start:payload_start + payload_len])
+
+
+# Returns the frames packed in data as a list, or None if the last one is incomplete
+def split(data):
+    frames = []
+    start = 0
+    while start < len(data):
+        size = frame_size(data, start)
+        if size is None or start + size > len(data):
+            return None
+        frames.append(data[start:start + size])
+        start += size
+    return frames
@@ -6,72 +6,92 @@ class ChannelManager():
     def __init__(self, max_channels, max_members):
         self.max_channels = max_channels
         self.max_members = max_members
+        # Members of each channel. The members are dict keys (values are None), so the dict works as a set that
+        # remembers the order in which the sockets joined.
         self.channels = {}
+        # The same member dicts keyed by the utf-8 encoded channel names, for looking up channels of messages
+        # that are not decoded
+        self.encoded_channels = {}
+        # Reverse index: the channels each socket has joined, stored the same way
+        self.socket_channels = {}
 
     # Return True if join succesful (socket not joined already), otherwise return False
     def join(self, socket, channel):
+        members = self.channels.get(channel)
         # If channel exists make socket join it
-        if channel in self.channels:
+        if members is not None:
             # Check that socket not already joined
-            if socket not in self.channels[channel]:
-                if len(self.channels[channel]) < self.max_members:
-                    self.channels[channel].append(socket)
-                    return True
-                else:
-                    raise ChannelJoinError("Too many members on channel. Unable to add more.")
-        # If channel doesn't exist create the channel list and add socket as the only subscriber
+            if socket in members:
+                return False
+            if len(members) >= self.max_members:
+                raise ChannelJoinError("Too many members on channel. Unable to add more.")
+            members[socket] = None
+        # If channel doesn't exist create the channel and add socket as the only subscriber
         else:
-            if len(self.channels) < self.max_channels:
-                self.channels[channel] = [socket]
-                return True
-            else:
+            if len(self.channels) >= self.max_channels:
                 raise ChannelJoinError("Too many channels. Can't create more.")
-
-        return False
-
-    # Part socket from channel but doesn't delete channel if it is empty.
-    # Instead returns false if channel is empty and has to be deleted, otherwise returns true
-    def __part_but_dont_delete_channel(self, socket, channel):
-        if channel in self.channels:
-            if socket in self.channels[channel]:
-                self.channels[channel].remove(socket)
-
-                if self.channels[channel] == []:
-                    return False
+            self.channels[channel] = {socket: None}
+            self.encoded_channels[channel.encode()] = self.channels[channel]
+        self.socket_channels.setdefault(socket, {})[channel] = None
         return True
 
+    # Part socket from channel and delete the channel if it became empty
+    def __part(self, socket, channel):
+        members = self.channels[channel]
+        del members[socket]
+        if not members:
+            del self.channels[channel]
+            del self.encoded_channels[channel.encode()]
+
     # return True if part succesful (client had joined first), return False if unsuccesful
     def part(self, socket, channel):
-        if socket in self.channels[channel]:
-            if not self.__part_but_dont_delete_channel(socket, channel):
-                del self.channels[channel]
-            return True
-        return False
-
+        joined_channels = self.socket_channels.get(socket)
+        if joined_channels is None or channel not in joined_channels:
+            return False
+        del joined_channels[channel]
+        if not joined_channels:
+            del self.socket_channels[socket]
+        self.__part(socket, channel)
+        return True
 
     # return a list of all the parted channels
     def part_all(self, socket):
-        empty_channels = []
-        sockets_channels = []
-        for channel in self.channels:
-            if socket in self.channels[channel]:
-                sockets_channels.append(channel)
-            if not self.__part_but_dont_delete_channel(socket, channel):
-                empty_channels.append(channel)
-        for empty_channel in empty_channels:
-            del self.channels[empty_channel]
-        return sockets_channels
+        joined_channels = self.socket_channels.pop(socket, {})
+        for channel in joined_channels:
+            self.__part(socket, channel)
+        return list(joined_channels)
 
-    # Returns list of sockets that are subscribed to channel.
-    # Returns empty list if channel doesn't exist
+    # Returns a list of the sockets that are subscribed to channel. The list is a copy, so the members may join
+    # and part while it is iterated, e.g. when a broadcast closes a connection. Returns empty list if channel
+    # doesn't exist
     def get(self, channel):
-        if self.channels.get(channel) is None:
+        members = self.channels.get(channel)
+        if members is None:
             return []
-        return self.channels.get(channel)
+        return list(members)
+
+    # Same as get(), but channel is the encoded name of the channel
+    def get_encoded(self, channel):
+        members = self.encoded_channels.get(channel)
+        if members is None:
+            return []
+        return list(members)
+
+    # Returns True if socket has joined channel, without copying the members
+    def is_member(self, socket, channel):
+        members = self.channels.get(channel)
+        return members is not None and socket in members
+
+    # Returns the number of sockets subscribed to channel, 0 if channel doesn't exist
+    def member_count(self, channel):
+        members = self.channels.get(channel)
+        if members is None:
+            return 0
+        return len(members)
+
+    # Returns the names of all the channels that have members
+    def get_channel_names(self):
+        return self.channels.keys()
 
     def get_channels_of_socket(self, sock):
-        socket_channels = []
-        for channel in self.channels:
-            if sock in self.channels[channel]:
-                socket_channels.append(channel)
-        return socket_channels
\ No newline at end of file
+        return list(self.socket_channels.get(sock, ()))
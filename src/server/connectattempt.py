@@ -0,0 +1,9 @@
+class ConnectAttempt():
+    __slots__ = ("server_addr", "attempt", "addrinfo", "sock", "deadline")
+
+    def __init__(self, server_addr, attempt):
+        self.server_addr = server_addr  # (ip, port) tuple of the server being connected
+        self.attempt = attempt  # how many earlier attempts to this server have failed
+        self.addrinfo = []  # resolved addresses that have not been tried yet, as returned by getaddrinfo()
+        self.sock = None  # the socket whose connect is in progress
+        self.deadline = 0  # time.monotonic() after which the connect of sock is given up
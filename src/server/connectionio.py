@@ -0,0 +1,15 @@
+class ConnectionIO():
+    """
+    Receive buffer, send queue and handlers of one open socket.
+    """
+    __slots__ = ("recv_buffer", "send_queue", "read", "close", "metrics", "reads_paused", "batcher", "binary")
+
+    def __init__(self, recv_buffer, send_queue, read, close, metrics):
+        self.recv_buffer = recv_buffer  # LineBuffer
+        self.send_queue = send_queue  # SendQueue
+        self.read = read  # method that reads the socket and handles the received messages
+        self.close = close  # method that closes the socket properly for its connection type
+        self.metrics = metrics  # ConnectionMetrics of the connection type
+        self.reads_paused = False  # True while the send queue is full and the policy is POLICY_PAUSE_READS
+        self.batcher = None  # LinkBatcher if the server link has agreed to send batches
+        self.binary = False  # True if the frames sent to the server link are binary frames (see binaryframe)
@@ -2,93 +2,104 @@ class ConnectionAddError(Exception):
     pass
 
 
+class Connection():
+    __slots__ = ("sock", "heartbleed_status", "listen_addr", "nickname")
+
+    def __init__(self, sock, listen_addr, nickname):
+        self.sock = sock  # Socket object
+        self.heartbleed_status = -1  # Integer telling how many HEART\n messages have not been answered with BLEED\n
+                                     # message. Negative value means that an answer has been received during that cycle
+        self.listen_addr = listen_addr  # A tuple with ip/dns as string and port as integer
+        self.nickname = nickname
+
+
 class ConnectionManager():
     TYPE_UNKNOWN = 0
     TYPE_SERVER = 1
     TYPE_CLIENT = 2
+    TYPE_WORKER = 3
 
     def __init__(self, max_connections, conn_type):
         self.max_connections = max_connections
         self.type = conn_type  # receives one of the values defined in class variables
-        # Same index in these three list means that the values belong to same connection
-        self.sockets = []  # Socket objects
-        self.heartbleed_status = []  # Integer telling how many HEART\n messages have not been answered with BLEED\n
-                                     # message. Negative value means that an answer has been received during that cycle
-        self.listen_addrs = []  # A tuple with ip/dns as string and port as integer
-        self.nickname = []
+        self.connections = {}  # Connection objects keyed by socket, in the order they were added
+        self.listen_index = {}  # socket of each listen address, for the connections that have one
+
+    # Socket objects of all the connections. Supports fast membership tests (sock in sockets).
+    @property
+    def sockets(self):
+        return self.connections.keys()
+
+    # A list of listen addresses of all the connections
+    @property
+    def listen_addrs(self):
+        return [connection.listen_addr for connection in self.connections.values()]
+
+    def __len__(self):
+        return len(self.connections)
+
+    # Returns the Connection of socket. Raises ValueError if socket not added
+    def get_connection(self, sock):
+        try:
+            return self.connections[sock]
+        except KeyError:
+            raise ValueError("Socket is not added.")
 
     def add(self, sock, listen_addr=None, nickname="NoName"):
-        if len(self.sockets) < self.max_connections:
-            if sock not in self.sockets:
-                self.sockets.append(sock)
-                self.heartbleed_status.append(-1)
-                self.listen_addrs.append(listen_addr)
-                self.nickname.append(nickname)
+        if len(self.connections) < self.max_connections:
+            if sock not in self.connections:
+                self.connections[sock] = Connection(sock, listen_addr, nickname)
+                if listen_addr is not None:
+                    self.listen_index[listen_addr] = sock
             else:
                 raise ConnectionAddError("Socket is already added.")
         else:
             raise ConnectionAddError("Server can't handle more connections.")
 
     def remove(self, sock):
-        try:
-            conn_index = self.sockets.index(sock)
-            self.pop(conn_index)
-        # Socket not in self.sockets. No need to do anything special.
-        except ValueError:
-            return
+        # Socket not in self.connections. No need to do anything special.
+        connection = self.connections.pop(sock, None)
+        if connection is not None:
+            self.unindex(connection)
+
+    def unindex(self, connection):
+        if self.listen_index.get(connection.listen_addr) is connection.sock:
+            del self.listen_index[connection.listen_addr]
 
+    # Remove the i:th connection. Takes linear time, use remove() when the socket is known.
     def pop(self, i):
-        try:
-            sock = self.sockets.pop(i)
-            status = self.heartbleed_status.pop(i)
-            addr = self.listen_addrs.pop(i)
-            nick = self.nickname.pop(i)
-            return (sock, status, addr, nick)
-        except IndexError:
-            return None
+        for j, sock in enumerate(self.connections):
+            if i == j:
+                connection = self.connections.pop(sock)
+                self.unindex(connection)
+                return (sock, connection.heartbleed_status, connection.listen_addr, connection.nickname)
+        return None
 
     def set_heartbleed_received(self, sock):
-        try:
-            conn_index = self.sockets.index(sock)
-            self.heartbleed_status[conn_index] = -1
-        except ValueError:
-            raise
+        self.get_connection(sock).heartbleed_status = -1
 
     # Returns listen_address of socket. Raises ValueError if socket not self.sockets
     def get_socket_listen_addr(self, sock):
-        try:
-            conn_index = self.sockets.index(sock)
-            return self.listen_addrs[conn_index]
-        # Socket not in self.sockets. Raise error
-        except ValueError:
-            raise
+        return self.get_connection(sock).listen_addr
+
+    # Returns the socket of the connection with listen_addr, or None
+    def get_socket_by_listen_addr(self, listen_addr):
+        return self.listen_index.get(listen_addr)
+
+    def has_listen_addr(self, listen_addr):
+        return listen_addr in self.listen_index
 
     # Returns heartbleed_status of socket. Raises ValueError if socket not self.sockets
     def get_heartbleed_status(self, sock):
-        try:
-            conn_index = self.sockets.index(sock)
-            return self.heartbleed_status[conn_index]
-        # Socket not in self.sockets. Raise error
-        except ValueError:
-            raise
+        return self.get_connection(sock).heartbleed_status
 
     def get_nickname(self, sock):
-        try:
-            conn_index = self.sockets.index(sock)
-            return self.nickname[conn_index]
-        # Socket not in self.sockets. Raise error
-        except ValueError:
-            raise
+        return self.get_connection(sock).nickname
 
     # return True if a new nickname was set (that is different from the previous nick), otherwise return False
     def set_nickname(self, sock, nickname):
-        try:
-            conn_index = self.sockets.index(sock)
-            previous_nickname = self.nickname[conn_index]
-
-            if previous_nickname != nickname:
-                self.nickname[conn_index] = nickname
-                return True
-        except ValueError:
-            raise
-        return False
\ No newline at end of file
+        connection = self.get_connection(sock)
+        if connection.nickname != nickname:
+            connection.nickname = nickname
+            return True
+        return False
@@ -0,0 +1,15 @@
+class ConnectionMetrics():
+    """
+    Traffic counters shared by all the connections of one type ("client", "server" or "worker"). Every
+    ConnectionIO refers to the ConnectionMetrics of its type.
+    """
+    __slots__ = ("opened", "closed", "messages_received", "messages_sent", "bytes_received", "bytes_sent")
+
+    def __init__(self, registry, conn_type):
+        labels = {"type": conn_type}
+        self.opened = registry.counter("mchat_connections_opened_total", "Connections opened", labels)
+        self.closed = registry.counter("mchat_connections_closed_total", "Connections closed", labels)
+        self.messages_received = registry.counter("mchat_messages_received_total", "Messages received", labels)
+        self.messages_sent = registry.counter("mchat_messages_sent_total", "Messages queued for sending", labels)
+        self.bytes_received = registry.counter("mchat_bytes_received_total", "Bytes received", labels)
+        self.bytes_sent = registry.counter("mchat_bytes_sent_total", "Bytes sent", labels)
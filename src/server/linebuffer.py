@@ -0,0 +1,80 @@
+import socket
+import binaryframe
+
+
+class LineBuffer():
+    RECV_SIZE = 65536  # bytes requested from the kernel per recv() call
+
+    def __init__(self, max_line_len, bytes_received=None):
+        self.max_line_len = max_line_len  # a line that grows longer than this is handed out in max_line_len pieces
+        self.bytes_received = bytes_received  # metrics.Counter of the received bytes, or None
+        self.data = bytearray()
+        self.start = 0  # index in self.data where the next unhandled line begins
+        self.block_size = None  # set by expect_block()
+        self.max_frame_len = None  # set by set_binary()
+        self.keep_newline = False  # if True, next_line() returns the lines with their newline character
+
+    # Read whatever the socket has available with a single non-blocking recv() call.
+    # Raises socket.error if the connection has been closed by the peer.
+    def recv(self, sock):
+        try:
+            data = sock.recv(LineBuffer.RECV_SIZE, socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            raise socket.error("Connection closed by peer")
+        if self.bytes_received is not None:
+            self.bytes_received.inc(len(data))
+        # Drop the already handled lines before appending, so the buffer never holds more than one partial line
+        # in addition to the new data
+        if self.start:
+            del self.data[:self.start]
+            self.start = 0
+        self.data += data
+        if self.max_frame_len is not None:
+            size = binaryframe.frame_size(self.data, self.start)
+            if size is not None and size > self.max_frame_len:
+                raise socket.error("Frame too long ({} bytes)".format(size))
+
+    # From now on the data is binary frames (see binaryframe), and next_line() returns one complete frame at a time
+    @property
+    def binary(self):
+        return self.max_frame_len is not None
+
+    def set_binary(self, max_frame_len):
+        self.max_frame_len = max_frame_len
+
+    # The next size bytes are a block of binary data. next_line() returns them in one piece, once they have all
+    # been received.
+    def expect_block(self, size):
+        self.block_size = size
+
+    # Return the next complete line, without the newline character unless keep_newline is set, or None if there
+    # isn't one yet. A line cut at max_line_len has no newline either way.
+    def next_line(self):
+        if self.max_frame_len is not None:
+            size = binaryframe.frame_size(self.data, self.start)
+            if size is None or len(self.data) - self.start < size:
+                return None
+            frame = bytes(self.data[self.start:self.start + size])
+            self.start += size
+            return frame
+        if self.block_size is not None:
+            if len(self.data) - self.start < self.block_size:
+                return None
+            end = self.start + self.block_size
+            self.block_size = None
+            block = bytes(self.data[self.start:end])
+            self.start = end
+            return block
+        end = self.data.find(b"\n", self.start, self.start + self.max_line_len)
+        if end >= 0:
+            line = bytes(self.data[self.start:end + 1 if self.keep_newline else end])
+            self.start = end + 1
+            return line
+        if len(self.data) - self.start >= self.max_line_len:
+            end = self.start + self.max_line_len
+            line = bytes(self.data[self.start:end])
+            self.start = end
+            return line
+        return None
@@ -0,0 +1,107 @@
+import zlib
+import binaryframe
+from collections import deque
+from sendqueue import SendQueueFullError
+
+
+class LinkBatcher():
+    """
+    Packs the frames sent to a server link into BATCH frames:
+
+        BATCH <size> [Z]\n<size bytes of newline terminated frames, zlib compressed if Z is given>
+
+    or, on a binary link, into binaryframe.TYPE_BATCH frames.
+
+    A batch is closed when it grows to MAX_BATCH_SIZE or when the connection is flushed at the end of the loop
+    iteration. The link uses credit based flow control: the receiver starts by allowing CREDIT bytes of batches
+    in flight and gives the credit back with CREDIT <bytes> as it handles them. Closed batches that don't fit in
+    the credit wait here, nothing is ever dropped. If more than max_backlog bytes are waiting, SendQueueFullError
+    is raised and the link should be closed.
+
+    The receiving side of the link is kept here too.
+    """
+
+    MAX_BATCH_SIZE = 64 * 1024  # bytes of frames in one batch before compression
+    MAX_BLOCK_SIZE = 1024 * 1024  # largest batch accepted from the other server, before and after decompression
+    COMPRESS_MIN_SIZE = 512  # smaller batches are not worth compressing
+    COMPRESS_LEVEL = 1
+    CREDIT = 1024 * 1024  # bytes of batches the other server may have in flight
+
+    def __init__(self, compress, binary, max_backlog):
+        self.compress = compress
+        self.binary = binary
+        self.max_backlog = max_backlog
+        self.frames = []  # frames of the batch being filled
+        self.size = 0  # bytes in self.frames
+        self.batches = deque()  # (size, BATCH frame) of closed batches waiting for credit
+        self.backlog = 0  # bytes in self.batches
+        self.credit = LinkBatcher.CREDIT  # bytes we may still send
+        # Receiving side
+        self.block_compressed = None  # compression flag of the batch whose data is expected next, or None
+        self.consumed = 0  # bytes of received batches handled but not credited back yet
+
+    # Add frame to the batch being filled. Returns True if the batch is full and should be closed.
+    def add(self, frame):
+        self.frames.append(frame)
+        self.size += len(frame)
+        return self.size >= LinkBatcher.MAX_BATCH_SIZE
+
+    # Close the batch being filled
+    def seal(self):
+        if not self.frames:
+            return
+        payload = b"".join(self.frames)
+        self.frames = []
+        self.size = 0
+        compressed = self.compress and len(payload) >= LinkBatcher.COMPRESS_MIN_SIZE
+        if compressed:
+            payload = zlib.compress(payload, LinkBatcher.COMPRESS_LEVEL)
+        if self.binary:
+            flags = binaryframe.FLAG_COMPRESSED if compressed else 0
+            batch = binaryframe.encode(binaryframe.TYPE_BATCH, payload, flags=flags)
+        elif compressed:
+            batch = "BATCH {} Z\n".format(len(payload)).encode() + payload
+        else:
+            batch = "BATCH {}\n".format(len(payload)).encode() + payload
+        self.batches.append((len(payload), batch))
+        self.backlog += len(payload)
+        if self.backlog > self.max_backlog:
+            raise SendQueueFullError("Link backlog is full ({} bytes in {} batches)".format(self.backlog, len(self.batches)))
+
+    # Remove and return the closed batches that fit in the credit
+    def take_sendable(self):
+        sendable = []
+        while self.batches and self.batches[0][0] <= self.credit:
+            size, batch = self.batches.popleft()
+            self.backlog -= size
+            self.credit -= size
+            sendable.append(batch)
+        return sendable
+
+    def add_credit(self, size):
+        self.credit = min(self.credit + size, LinkBatcher.CREDIT)
+
+    # Returns the frames of a received batch as one bytes object, or None if the batch is invalid
+    def unpack(self, block):
+        compressed = self.block_compressed
+        self.block_compressed = None
+        self.consumed += len(block)
+        if not compressed:
+            return block
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(block, LinkBatcher.MAX_BLOCK_SIZE)
+        except zlib.error:
+            return None
+        # Either the batch decompresses to more than MAX_BLOCK_SIZE or the compressed stream is cut short
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            return None
+        return payload
+
+    # Returns the amount of credit to give back to the other server, or 0 if it's not worth a message yet
+    def take_consumed(self):
+        if self.consumed < LinkBatcher.CREDIT // 2:
+            return 0
+        consumed = self.consumed
+        self.consumed = 0
+        return consumed
@@ -0,0 +1,9 @@
+class LoadReport():
+    __slots__ = ("client_addr", "connections", "msg_rate", "loop_latency", "time")
+
+    def __init__(self, client_addr, connections, msg_rate, loop_latency, time):
+        self.client_addr = client_addr  # (ip, port) tuple where the server accepts clients
+        self.connections = connections  # number of clients connected to the server
+        self.msg_rate = msg_rate  # client messages per second
+        self.loop_latency = loop_latency  # milliseconds, how long handling one round of events takes on average
+        self.time = time  # time.monotonic() when the report was received
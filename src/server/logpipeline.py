@@ -0,0 +1,64 @@
+"""
+This module implements the logging pipeline of the server. The thread that logs a record only puts it on a
+bounded queue, and a QueueListener thread writes it to the log file and the console. File writes, log
+rotation and slow terminals never block the loop, and repetitive records are rate limited before they are
+even queued.
+"""
+
+import logging
+import queue
+import time
+from logging.handlers import QueueHandler
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts the records on a queue of at most maxsize records. If the writer thread can't keep up and the queue is
+    full, the record is dropped instead of blocking the caller.
+    """
+
+    def __init__(self, maxsize, dropped=None):
+        super(DroppingQueueHandler, self).__init__(queue.Queue(maxsize))
+        self.dropped = dropped  # metrics.Counter of the dropped records, or None
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.dropped is not None:
+                self.dropped.inc()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through burst records from one line of code, and after that rate records per second (token bucket).
+    The first record that gets through after others from the same line were suppressed tells how many were.
+    """
+
+    def __init__(self, rate, burst, suppressed=None):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.suppressed = suppressed  # metrics.Counter of the suppressed records, or None
+        self.buckets = {}  # (pathname, lineno) -> [tokens, time.monotonic() of the last refill, suppressed records]
+
+    def filter(self, record):
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now, 0]
+            self.buckets[key] = bucket
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            if self.suppressed is not None:
+                self.suppressed.inc()
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = "{} ({} similar messages suppressed)".format(record.getMessage(), bucket[2])
+            record.args = None
+            bucket[2] = 0
+        return True
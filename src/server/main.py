@@ -1,11 +1,16 @@
 from server import MChatServer
+from asyncserver import AsyncMChatServer
+from workers import WorkerGroup
 from daemon import Daemon
 import sys
+import os
+import signal
 
 
 def print_instructions(program_name):
-    print("""usage: %s start [--non-daemon] <ip> <client_port> <server_port> [<remote_ip> <remote_port>]
- | stop <ip> <client_port>""" % program_name)
+    print("""usage: %s start [--non-daemon] [--asyncio] [--overlay] [--batch-links] [--compress-links] [--binary-links] [--redirect-clients] [--address-cache <file>] [--admin-port <port>] [--workers <count>] <ip> <client_port> <server_port> [<remote_ip> <remote_port>]
+ | stop <ip> <client_port>
+ | profile <ip> <client_port>""" % program_name)
 
 
 def main():
@@ -17,6 +22,50 @@ def main():
     except ValueError:
         daemon = True
 
+    try:
+        sys.argv.remove("--asyncio")
+        server_class = AsyncMChatServer
+    except ValueError:
+        server_class = MChatServer
+
+    # Options that are passed on to the server class. A daemon's stdout goes nowhere, so it only logs to the file.
+    server_options = {"console_log": not daemon}
+    for flag in ("--overlay", "--batch-links", "--compress-links", "--binary-links", "--redirect-clients"):
+        try:
+            sys.argv.remove(flag)
+            server_options[flag[2:].replace("-", "_")] = True
+        except ValueError:
+            pass
+
+    worker_count = 1
+    if "--workers" in sys.argv:
+        i = sys.argv.index("--workers")
+        try:
+            worker_count = int(sys.argv[i + 1])
+        except (IndexError, ValueError):
+            print_instructions(sys.argv[0])
+            sys.exit(2)
+        del sys.argv[i:i + 2]
+
+    # The known servers are saved to the file, and connected right away on the next start
+    if "--address-cache" in sys.argv:
+        i = sys.argv.index("--address-cache")
+        if i + 1 >= len(sys.argv):
+            print_instructions(sys.argv[0])
+            sys.exit(2)
+        server_options["address_cache"] = os.path.abspath(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+
+    # The metrics are served on 127.0.0.1:<port>, by worker i on <port> + i
+    if "--admin-port" in sys.argv:
+        i = sys.argv.index("--admin-port")
+        try:
+            server_options["admin_port"] = int(sys.argv[i + 1])
+        except (IndexError, ValueError):
+            print_instructions(sys.argv[0])
+            sys.exit(2)
+        del sys.argv[i:i + 2]
+
     if len(sys.argv) == 5 or len(sys.argv) == 7:
         ip = sys.argv[2]
         client_port = int(sys.argv[3])
@@ -29,7 +78,11 @@ def main():
             remote_port = int(sys.argv[6])
 
         if 'start' == sys.argv[1]:
-            server = MChatServer(pidfile, ip, client_port, server_port, remote_ip, remote_port)
+            if worker_count > 1:
+                server = WorkerGroup(pidfile, worker_count, server_class, ip, client_port, server_port, remote_ip, remote_port,
+                                     **server_options)
+            else:
+                server = server_class(pidfile, ip, client_port, server_port, remote_ip, remote_port, **server_options)
             if daemon:
                 server.start()
                 print("Server started.")
@@ -46,6 +99,15 @@ def main():
             server_daemon = Daemon(pidfile)
             server_daemon.stop()
             print("Server stopped.")
+        elif 'profile' == sys.argv[1]:
+            # The server profiles itself for MChatServer.PROFILE_DEFAULT_DURATION seconds
+            try:
+                with open(pidfile, "r") as f:
+                    os.kill(int(f.read().strip()), signal.SIGUSR1)
+            except (OSError, ValueError) as e:
+                print("Failed to signal the server: {}".format(e))
+                sys.exit(1)
+            print("Profiling started, the profile is written next to the server log.")
         else:
             print_instructions(sys.argv[0])
             sys.exit(2)
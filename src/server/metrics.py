@@ -0,0 +1,105 @@
+"""
+This module implements the metrics of the server: counters and histograms that are cheap enough to update on
+the hot paths, gauges that are only computed when the metrics are read, and a registry that renders all of
+them in the Prometheus text format (https://prometheus.io/docs/instrumenting/exposition_formats/).
+"""
+
+from bisect import bisect_left
+
+
+class Counter():
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge():
+    __slots__ = ("function",)
+
+    def __init__(self, function):
+        self.function = function  # returns the current value, called when the metrics are rendered
+
+    @property
+    def value(self):
+        return self.function()
+
+
+class Histogram():
+    """
+    Counts the observed values in buckets. bucket_counts[i] is the number of values that are at most buckets[i]
+    but larger than buckets[i - 1], the last one counts the values larger than any bucket.
+    """
+    __slots__ = ("buckets", "bucket_counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry():
+    """
+    The metrics of one server. Metrics with the same name and different labels are rendered as one family.
+    """
+
+    def __init__(self):
+        self.families = {}  # name -> [type, help, [(labels, metric), ...]], in the order they were created
+
+    def counter(self, name, help, labels=None):
+        return self.add(name, "counter", help, labels, Counter())
+
+    def gauge(self, name, help, function, labels=None):
+        return self.add(name, "gauge", help, labels, Gauge(function))
+
+    def histogram(self, name, help, buckets, labels=None):
+        return self.add(name, "histogram", help, labels, Histogram(buckets))
+
+    def add(self, name, metric_type, help, labels, metric):
+        family = self.families.setdefault(name, [metric_type, help, []])
+        if family[0] != metric_type:
+            raise ValueError("Metric {} is a {}, not a {}".format(name, family[0], metric_type))
+        family[2].append((labels or {}, metric))
+        return metric
+
+    # Returns all the metrics in the Prometheus text format
+    def render(self):
+        lines = []
+        for name, (metric_type, help, metrics) in self.families.items():
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, metric in metrics:
+                if metric_type == "histogram":
+                    cumulative = 0
+                    for bucket, count in zip(metric.buckets + ["+Inf"], metric.bucket_counts):
+                        cumulative += count
+                        bucket_labels = dict(labels, le=format_value(bucket))
+                        lines.append("{}_bucket{} {}".format(name, format_labels(bucket_labels), cumulative))
+                    lines.append("{}_sum{} {}".format(name, format_labels(labels), format_value(metric.sum)))
+                    lines.append("{}_count{} {}".format(name, format_labels(labels), metric.count))
+                else:
+                    lines.append("{}{} {}".format(name, format_labels(labels), format_value(metric.value)))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ['{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for key, value in sorted(labels.items())]
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,68 @@
+import os
+import sys
+import threading
+import time
+
+
+class SamplingProfiler():
+    """
+    Samples the stack of one thread at a fixed interval and counts how many times each stack was seen. The
+    sampling runs in a background thread that only exists while profiling, so a profiler that is not running
+    costs nothing.
+
+    The counts are written in the collapsed stack format read by flamegraph.pl and speedscope, one stack per line
+    with the outermost frame first:
+
+        run (server.py:175);__start_server (server.py:191);select (selectors.py:451) 42
+    """
+
+    def __init__(self, interval):
+        self.interval = interval  # seconds between samples
+        self.thread = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Sample the thread whose threading.get_ident() is thread_id for duration seconds and write the stacks to
+    # path. done(path, samples, error) is called from the sampling thread when the file has been written, error
+    # is None or the OSError that prevented writing it. Returns False if the profiler is already running.
+    def start(self, thread_id, duration, path, done):
+        if self.is_running():
+            return False
+        self.thread = threading.Thread(target=self.run, args=(thread_id, duration, path, done), name="profiler",
+                                       daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self, thread_id, duration, path, done):
+        counts = {}  # collapsed stack -> number of samples
+        samples = 0
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break  # the thread has exited
+            stack = collapse_stack(frame)
+            del frame
+            counts[stack] = counts.get(stack, 0) + 1
+            samples += 1
+        error = None
+        try:
+            with open(path, "w") as f:
+                for stack, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+                    f.write("{} {}\n".format(stack, count))
+        except OSError as e:
+            error = e
+        done(path, samples, error)
+
+
+# Returns the stack of frame as "outermost;...;frame"
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
@@ -0,0 +1,84 @@
+import socket
+from collections import deque
+from itertools import islice
+
+
+class SendQueueFullError(socket.error):
+    pass
+
+
+class SendQueue():
+    # What to do when a connection does not read its data fast enough and the queue grows over max_bytes
+    POLICY_DROP_OLDEST = 0  # drop the oldest frames that have not been sent yet
+    POLICY_DISCONNECT = 1  # raise SendQueueFullError, the owner of the connection should close it
+    POLICY_PAUSE_READS = 2  # keep queueing, the owner should stop reading from the connection until it drains
+
+    IOV_MAX = 1024  # maximum number of buffers in one sendmsg() call on Linux
+    EARLY_FLUSH_SIZE = 64 * 1024  # bytes, queues this big are flushed without waiting for the end of the iteration
+
+    def __init__(self, max_bytes, policy, bytes_sent=None):
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.bytes_sent = bytes_sent  # metrics.Counter of the sent bytes, or None
+        self.frames = deque()  # bytes objects waiting to be sent, oldest first
+        self.offset = 0  # how many bytes of self.frames[0] have been sent already
+        self.size = 0  # bytes waiting to be sent in total
+        self.dropped = 0  # frames dropped since the queue was empty the last time
+
+    def __len__(self):
+        return len(self.frames)
+
+    def is_full(self):
+        return self.size > self.max_bytes
+
+    # Returns True when there's less than half of max_bytes waiting, so paused reads can be resumed
+    def has_drained(self):
+        return self.size <= self.max_bytes // 2
+
+    # Add frame to the end of the queue and apply the slow consumer policy if the queue got full
+    def push(self, frame):
+        self.frames.append(frame)
+        self.size += len(frame)
+        if self.size <= self.max_bytes:
+            return
+        if self.policy == SendQueue.POLICY_DROP_OLDEST:
+            self.drop_oldest()
+        elif self.policy == SendQueue.POLICY_DISCONNECT:
+            raise SendQueueFullError("Send queue is full ({} bytes in {} frames)".format(self.size, len(self.frames)))
+
+    def drop_oldest(self):
+        # A partially sent frame has to be finished or the receiver would get a broken message
+        first = 1 if self.offset else 0
+        while self.size > self.max_bytes and len(self.frames) > first + 1:
+            if first:
+                frame = self.frames[1]
+                del self.frames[1]
+            else:
+                frame = self.frames.popleft()
+            self.size -= len(frame)
+            self.dropped += 1
+
+    # Send as much as the socket accepts without blocking. The waiting frames are written with one sendmsg()
+    # (writev) call per IOV_MAX frames. Returns True if the queue is empty afterwards. Raises socket.error if
+    # the connection is broken.
+    def flush(self, sock):
+        while self.frames:
+            buffers = list(islice(self.frames, SendQueue.IOV_MAX))
+            if self.offset:
+                buffers[0] = memoryview(buffers[0])[self.offset:]
+            try:
+                sent = sock.sendmsg(buffers, (), socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= sent
+            if self.bytes_sent is not None:
+                self.bytes_sent.inc(sent)
+            for buffer in buffers:
+                if sent < len(buffer):
+                    # The socket didn't take everything, the rest has to wait until it is writable again
+                    self.offset += sent
+                    return False
+                sent -= len(buffer)
+                self.frames.popleft()
+                self.offset = 0
+        return True
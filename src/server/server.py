@@ -1,15 +1,39 @@
 import socket
 import sys
-import select
+import selectors
 import logging
 import signal
+import time
+import random
+import errno
+import os
+import resource
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueListener
 from daemon import Daemon
 from channelmanager import ChannelManager
 from channelmanager import ChannelJoinError
 from connectionmanager import ConnectionManager
 from connectionmanager import ConnectionAddError
+from linebuffer import LineBuffer
+from sendqueue import SendQueue
+from connectionio import ConnectionIO
+from connectattempt import ConnectAttempt
+from linkbatcher import LinkBatcher
+from addressbook import AddressBook
+from loadreport import LoadReport
+from metrics import MetricsRegistry
+from connectionmetrics import ConnectionMetrics
+from profiler import SamplingProfiler
+from logpipeline import DroppingQueueHandler
+from logpipeline import RateLimitFilter
+import binaryframe
 from timer import Timer
+from timerwheel import TimerWheel
 
 
 
@@ -30,23 +54,173 @@ class MChatServer(Daemon):
     HEARTBLEED_INTERVAL = 2  # seconds
     MISSING_HEARTBLEEDS_ACCEPTED = 2  # the server closes connection when MORE than this amount of heartbleed responses
                                       # are missing in a row
-
-    def __init__(self, pidfile, ip, client_listen_port, server_listen_port, existing_server_ip=None, existing_server_port=None):
-        # Servers that have been detected but not connected to yet. A list of (ip, port) tuples
-        self.not_connected_servers = []
+    HEARTBLEED_TICK = 0.1  # seconds, resolution of the heartbleed deadlines
+    MAX_CANDIDATE_SERVERS = 100  # servers whose handshake can be in progress at the same time
+    FD_RESERVE = 100  # file descriptors needed in addition to the clients and servers (listen sockets, logs, ...)
+    ACCEPT_BACKOFF = 0.5  # seconds a listen socket is not read after the process has run out of file descriptors
+    # Connecting to other servers. A failed connect is retried after CONNECT_RETRY_DELAY seconds, and the delay is
+    # doubled after every failure up to CONNECT_RETRY_MAX_DELAY.
+    CONNECT_TIMEOUT = 5  # seconds, per address
+    CONNECT_MAX_ATTEMPTS = 5
+    CONNECT_RETRY_DELAY = 1  # seconds
+    CONNECT_RETRY_MAX_DELAY = 30  # seconds
+    RESOLVER_THREADS = 4  # host names are resolved in these threads so the main loop never blocks on DNS
+    # In overlay mode (see __init__) a server is linked to at most this many other servers
+    OVERLAY_MAX_DEGREE = 4
+    OVERLAY_RETRY_INTERVAL = 5  # seconds between attempts to find a new parent in the overlay
+    RELAY_CACHE_SIZE = 100000  # how many relayed message IDs are remembered for dropping duplicates
+    PRESENCE_CACHE_SIZE = 1000  # how many split PRESENCE events are remembered (see deliver_presence)
+    ADDRESS_CACHE_SAVE_INTERVAL = 10  # seconds, the address cache is written at most this often
+    # Every server reports its load to the servers it is linked to (see report_load). With redirect_clients a new
+    # client is redirected to the least loaded server, if that has at least REDIRECT_THRESHOLD clients less.
+    LOAD_REPORT_INTERVAL = 2  # seconds
+    LOAD_REPORT_MAX_AGE = 3 * LOAD_REPORT_INTERVAL  # seconds, older reports are not trusted for redirects
+    REDIRECT_THRESHOLD = 5
+    LOOP_LATENCY_WEIGHT = 0.1  # weight of the latest round of events in the loop latency average
+    # Kinds of PRESENCE messages
+    PRESENCE_NICK = "NICK"
+    PRESENCE_QUIT = "QUIT"
+    # Limits (in bytes) for data waiting to be sent to a connection, and what to do when a connection doesn't read
+    # its data fast enough. The policies are defined in SendQueue.
+    CLIENT_SEND_QUEUE_MAXLEN = 256 * 1024
+    CLIENT_SLOW_CONSUMER_POLICY = SendQueue.POLICY_DROP_OLDEST
+    SERVER_SEND_QUEUE_MAXLEN = 4 * 1024 * 1024
+    SERVER_SLOW_CONSUMER_POLICY = SendQueue.POLICY_DISCONNECT
+    WORKER_SEND_QUEUE_MAXLEN = 16 * 1024 * 1024
+    WORKER_SLOW_CONSUMER_POLICY = SendQueue.POLICY_DISCONNECT
+    # The metrics (see create_metrics) are served in the Prometheus text format over HTTP to the admin port, which
+    # only listens on the loopback interface
+    ADMIN_IP = "127.0.0.1"
+    ADMIN_TIMEOUT = 1  # seconds to wait for the request and for sending the answer
+    ADMIN_REQUEST_MAXLEN = 8192  # bytes
+    ADMIN_SEND_QUEUE_MAXLEN = 4 * 1024 * 1024
+    LOOP_TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)  # seconds
+    FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)  # receivers
+    # SIGUSR1 or POST /profile?seconds=<n> to the admin port starts the sampling profiler (see start_profiler)
+    PROFILE_INTERVAL = 0.005  # seconds between samples
+    PROFILE_DEFAULT_DURATION = 10  # seconds
+    PROFILE_MAX_DURATION = 300  # seconds
+    # The log is written by a background thread (see logger_setup). Records from one line of code are limited to
+    # LOG_RATE per second after a burst of LOG_BURST, and records that don't fit in the queue are dropped.
+    LOG_QUEUE_MAXLEN = 10000  # records
+    LOG_RATE = 10  # records per second
+    LOG_BURST = 100  # records
+
+    def __init__(self, pidfile, ip, client_listen_port, server_listen_port, existing_server_ip=None, existing_server_port=None,
+                 worker_id=None, worker_links=(), overlay=False, batch_links=False, compress_links=False,
+                 binary_links=False, address_cache=None, redirect_clients=False, admin_port=None, console_log=True):
+        # When the server runs as one of several worker processes (see WorkerGroup), worker_id is its index and
+        # worker_links are Unix sockets to the other workers. Worker 0 is the gateway to the other servers.
+        self.worker_id = worker_id
+        self.worker_links = worker_links
+        self.gateway = worker_id is None or worker_id == 0
+        # Servers that have been detected but not connected to yet. (ip, port) tuples as dict keys (values are None)
+        self.not_connected_servers = {}
         if (existing_server_ip is not None) and (existing_server_port is not None):
-            self.not_connected_servers.append((existing_server_ip, existing_server_port))
+            self.not_connected_servers[(existing_server_ip, existing_server_port)] = None
+        # Every server we have heard of or been linked to. The gateway saves them to the address_cache file, and
+        # connects to the saved servers when it restarts. Servers that can't be connected are forgotten.
+        self.known_servers = AddressBook(address_cache if self.gateway else None)
+        self.known_servers.load()
+        for server_addr in self.not_connected_servers:
+            self.known_servers.add(server_addr)
+        self.address_cache_timer = Timer(MChatServer.ADDRESS_CACHE_SAVE_INTERVAL)
 
         self.servers = ConnectionManager(MChatServer.MAX_SERVERS, ConnectionManager.TYPE_SERVER)
+        # By default every server connects to every other server it hears of. In overlay mode a server only
+        # connects to one of them, its parent, and servers that already have OVERLAY_MAX_DEGREE links send new
+        # servers further on, so the servers form a tree. Channel messages are relayed along the tree as
+        # RELAY <origin> <sequence number> <message>, and the IDs of recently relayed messages are remembered
+        # so that a message is never handled twice even if the links form a loop.
+        self.overlay = overlay
+        # Link capabilities offered to the other servers with CAPS. With BATCH the frames sent to a server are
+        # packed into BATCH frames (see LinkBatcher), and with ZLIB the batches are compressed. With BINARY the
+        # link switches to length-prefixed binary frames (see binaryframe).
+        self.link_caps = []
+        if batch_links or compress_links:
+            self.link_caps.append("BATCH")
+        if compress_links:
+            self.link_caps.append("ZLIB")
+        if binary_links:
+            self.link_caps.append("BINARY")
+        self.overlay_parent = None
+        self.overlay_next = 0  # index of the next server in known_servers to try as a parent
+        if not overlay:
+            self.not_connected_servers.update(dict.fromkeys(self.known_servers))
+        self.overlay_retry_timer = Timer(MChatServer.OVERLAY_RETRY_INTERVAL)
+        self.relay_origin = "{}:{}:{:x}".format(ip, server_listen_port, random.getrandbits(32))
+        self.relay_seq = 0
+        # A server started without any server to connect to is the root of the overlay and never looks for a
+        # parent. Every server knows its path to the root as the relay origins of its ancestors and itself: the
+        # parent tells its path with OVERLAY_PATH, and a server that finds itself on it drops the link to the
+        # parent, because the link closed a loop.
+        self.overlay_root = overlay and not self.known_servers
+        self.overlay_path = [self.relay_origin]
+        # Listen addresses of the servers that have connected to us as our children, never tried as a parent
+        self.overlay_children = {}  # values are None
+        self.relayed = {}  # (origin, sequence number) of recently relayed messages, oldest first
+        self.presence_seq = 0
+        self.presence_notified = {}  # event ID of a split PRESENCE event -> local clients notified, oldest first
         self.clients = ConnectionManager(MChatServer.MAX_CLIENTS, ConnectionManager.TYPE_CLIENT)
+        self.redirect_clients = redirect_clients
+        self.peer_load = {}  # the latest LoadReport of each server link that has sent one
+        # The gateway reports the load of the whole host. The other workers tell it with WORKER_LOAD how many clients
+        # they have and how many messages per second the clients send: worker link -> (clients, messages per second)
+        self.worker_load = {}
+        self.load_report_messages = 0  # messages received from clients when the previous load report was sent
+        self.loop_latency = 0.0  # seconds, moving average of the time it takes to handle one round of events
+        self.last_load_report = time.monotonic()
+        self.workers = ConnectionManager(len(worker_links), ConnectionManager.TYPE_WORKER)
         self.channels = ChannelManager(MChatServer.MAX_CHANNELS, MChatServer.MAX_CLIENTS_PER_CHANNEL)
+        # Channel messages are only forwarded to the servers and workers that have told (with SUB) that they want
+        # them. peer_interest holds the channels each of them has subscribed, interest_unknown the links that
+        # haven't sent their first SUB yet (they get everything until then), and advertised the channels we
+        # have subscribed from each link.
+        self.peer_interest = ChannelManager(MChatServer.MAX_CHANNELS, MChatServer.MAX_SERVERS + len(worker_links))
+        self.interest_unknown = set()
+        self.advertised = {}
         self.ip = ip
         self.client_listen_port = client_listen_port
         self.server_listen_port = server_listen_port
         self.server_listen_socket = None
         self.client_listen_socket = None
-        self.heartbleed_timer = Timer(MChatServer.HEARTBLEED_INTERVAL)
-        self.candidate_server_socket = None
+        # Every client and server connection has its own heartbleed deadline. The first one is set to a random
+        # moment within the interval, so the HEART messages are spread evenly over the interval.
+        slot_count = int(MChatServer.HEARTBLEED_INTERVAL / MChatServer.HEARTBLEED_TICK) + 1
+        self.heartbleed_wheel = TimerWheel(MChatServer.HEARTBLEED_TICK, slot_count, time.monotonic())
+        # Servers that have connected to us but not answered ALL_ADDRS with MY_ADDR yet. Each of them has a deadline
+        # in heartbleed_wheel too: lets give new servers heartbleed interval amount of time to connect.
+        self.candidate_servers = set()
+        self.connect_attempts = {}  # ConnectAttempt of every server being connected, keyed by (ip, port)
+        self.connecting = {}  # ConnectAttempt keyed by the socket whose connect is in progress
+        self.connect_retries = {}  # (ip, port) -> (attempt, time.monotonic() of the next attempt)
+        self.resolver = None
+        self.resolved = deque()  # (ConnectAttempt, future) of finished name resolutions, filled by resolver threads
+        self.wakeup_reader = None  # the resolver threads write to wakeup_writer to wake up the main loop
+        self.wakeup_writer = None
+        self.selector = None
+        # Each worker serves its own metrics, worker i on port admin_port + i
+        self.admin_port = None if admin_port is None else admin_port + (worker_id or 0)
+        self.admin_listen_socket = None
+        # The request received so far on each admin connection, or None once it has been answered
+        self.admin_requests = {}
+        self.profiler = SamplingProfiler(MChatServer.PROFILE_INTERVAL)
+        self.profile_requested = False  # set by sigusr1_handler, the main loop starts the profiler
+        self.connections = {}  # ConnectionIO of every open connection, keyed by socket
+        self.paused_listeners = {}  # listen socket -> (accept handler, time.monotonic() when to accept again)
+        self.pending_flushes = set()  # sockets that have been sent something during this loop iteration
+        self.client_commands = {}  # command (bytes) -> handler, see register_command()
+        self.no_arg_commands = set()  # handlers of the commands that take no arguments
+        self.register_command("BLEED", self.handle_bleed, has_args=False)
+        self.register_command("HEART", self.handle_heart, has_args=False)
+        self.register_command("JOIN", self.handle_join)
+        self.register_command("PART", self.handle_part)
+        self.register_command("NICK", self.handle_nick)
+        self.register_command("MSG", self.handle_msg)
+        self.metrics = MetricsRegistry()
+        self.create_metrics()
+        self.console_log = console_log  # log to stdout too, there's no point in it when running as a daemon
+        self.log_listener = None
         self.logger = self.logger_setup()
 
         super(MChatServer, self).__init__(pidfile)
@@ -55,6 +229,7 @@ class MChatServer(Daemon):
         """
         Overrides run() of parent class Daemon
         """
+        self.log_listener.start()
         try:
             self.__start_server()
         except (KeyboardInterrupt, SystemExit):
@@ -63,7 +238,11 @@ class MChatServer(Daemon):
             self.logger.exception("Uncaught exception:")
             raise e
         finally:
-            print("Server stopped.")
+            if self.resolver is not None:
+                self.resolver.shutdown(wait=False)
+            self.save_known_servers(force=True)
+            # Writes out the records still in the queue
+            self.log_listener.stop()
 
     def __start_server(self):
         """
@@ -71,236 +250,658 @@ class MChatServer(Daemon):
         """
         # Set signal handlers.
         signal.signal(signal.SIGTERM, self.sigterm_handler)
-        
-        # Lets give new servers heartbleed interval amount of time to connect
-        candidate_server_timer = Timer(MChatServer.HEARTBLEED_INTERVAL)
+        self.raise_fd_limit()
 
         # Listen socket for accepting incoming connections
-        self.client_listen_socket = self.create_listen_socket(self.ip, self.client_listen_port)
-        self.server_listen_socket = self.create_listen_socket(self.ip, self.server_listen_port)
-        if self.client_listen_socket == None or self.server_listen_socket == None:
-            sys.exit("Failed to open listen sockets to given hostname and port combination.")
+        self.create_listen_sockets()
+
+        # Every socket stays registered for as long as it is open. The data of each registration is the method
+        # that handles the socket when it becomes readable. Connections are also registered for writing while
+        # their send queue is not empty.
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.client_listen_socket, selectors.EVENT_READ, self.accept_client)
+        if self.gateway:
+            self.selector.register(self.server_listen_socket, selectors.EVENT_READ, self.accept_server)
+        if self.admin_listen_socket is not None:
+            self.selector.register(self.admin_listen_socket, selectors.EVENT_READ, self.accept_admin)
+        for link in self.worker_links:
+            self.add_worker(link)
+        # Threads are started only here, after the daemon and the worker processes have been forked
+        self.resolver = ThreadPoolExecutor(MChatServer.RESOLVER_THREADS)
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, self.read_wakeup)
+        signal.signal(signal.SIGUSR1, self.sigusr1_handler)
+        # A worker starts with SIGUSR1 blocked (see WorkerGroup.run)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
 
         log_message = "Server started on '{}'. Client port: {}, Server port: {}".format(self.ip, self.client_listen_port, self.server_listen_port)
-        print(log_message)
         self.logger.info(log_message)
 
-        self.heartbleed_timer.start()
-
         while True:
-            # Create connection to all not_connected_servers
-            self.connect_to_new_servers()
+            self.maintain_overlay()
+            self.save_known_servers()
 
-            if self.heartbleed_timer.has_expired():
-                self.process_heartbleeds()
-                self.heartbleed_timer.start()
-
-            if self.candidate_server_socket == None:
-                candidate_server_timer.reset()
-            if candidate_server_timer.has_expired():
-                self.candidate_server_socket.close()
-                self.candidate_server_socket = None
-                candidate_server_timer.reset()
-
-            try_to_read_from_sockets = self.clients.sockets + self.servers.sockets + [self.client_listen_socket, self.server_listen_socket]
-            if self.candidate_server_socket != None:
-                try_to_read_from_sockets.append(self.candidate_server_socket)
-
-            read_sockets, write_sockets, error_sockets = select.select(try_to_read_from_sockets, [], [], MChatServer.HEARTBLEED_INTERVAL)
-
-            for sock in read_sockets:
-
-                # New connection attempt to listen_socket
-                if sock == self.client_listen_socket:
-                    sockfd, addr = self.client_listen_socket.accept()
-                    try:
-                        self.clients.add(sockfd)
-                        log_message = "Client connected, IP: {}, port: {}".format(addr[0], addr[1])
-                        print(log_message)
-                        self.logger.info(log_message)
-                    except ConnectionAddError:
-                        """
-                        TODO: Tell client that server is full. Our protocol doesn't define how to do this so let's
-                              just rudely close the connection and continue.
-                        """
-                        self.logger.exception("Connection from client IP: {}, port: {} refused.".format(addr[0], addr[1]))
-                        sockfd.close()
+            # Start connecting to all not_connected_servers and the servers whose retry is due
+            self.connect_to_new_servers()
+            self.check_connect_timeouts()
+
+            self.process_heartbleeds()
+            self.report_load()
+            self.resume_accepting()
+
+            events = self.selector.select(MChatServer.HEARTBLEED_TICK)
+            started = time.monotonic()
+            for key, mask in events:
+                # A handler may have closed this socket (and its fd may even have been reused) earlier during
+                # this iteration. Only dispatch events whose registration is still the current one.
+                if self.selector.get_map().get(key.fd) is not key:
+                    continue
+                if key.fileobj in self.connecting:
+                    self.finish_connect(key.fileobj)
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self.flush(key.fileobj)
+                    if self.selector.get_map().get(key.fd) is not key:
                         continue
+                if mask & selectors.EVENT_READ:
+                    key.data(key.fileobj)
 
-                # New server connection attempt
-                elif sock == self.server_listen_socket and self.candidate_server_socket == None:
-                    sockfd, addr = self.server_listen_socket.accept()
-                    try:
-                        message = "ALL_ADDRS"
-                        for address in self.servers.listen_addrs:
-                            new_part = " " + address[0] + " " + str(address[1])
-                            appended_message = message + new_part
-                            if len(appended_message) >= MChatServer.PROTOCOL_MSG_MAXLEN:
-                                sockfd.sendall((message + "\n").encode())
-                                message = "ALL_ADDRS" + new_part
-                                continue
-                            message = appended_message
-                        sockfd.sendall((message + "\n").encode())
-
-                        candidate_server_timer.start()
-                        self.candidate_server_socket = sockfd
-                    except socket.error:
-                        sockfd.close()
-                        continue
+            # Everything sent to a connection during the iteration goes out in one system call
+            self.flush_pending()
+            self.update_loop_latency(time.monotonic() - started)
 
+    # Returns (socket, address) of a new connection to listen_sock, or None if it couldn't be accepted. If the
+    # process has run out of file descriptors, the pending connections would keep the listen socket readable, so
+    # it is not read for ACCEPT_BACKOFF seconds.
+    def accept(self, listen_sock):
+        try:
+            sock, addr = listen_sock.accept()
+            self.set_nodelay(sock)
+            return sock, addr
+        except (BlockingIOError, InterruptedError):
+            return None
+        except OSError as e:
+            if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                return None  # the connection was aborted before it was accepted
+            self.logger.error("Can't accept connections for {} seconds: {}".format(MChatServer.ACCEPT_BACKOFF, e))
+            handler = self.selector.get_key(listen_sock).data
+            self.selector.unregister(listen_sock)
+            self.paused_listeners[listen_sock] = (handler, time.monotonic() + MChatServer.ACCEPT_BACKOFF)
+            return None
 
-                elif sock == self.candidate_server_socket and self.candidate_server_socket != None:
-                    try:
-                        data = self.recv_until_newline(sock)
-                        message = data.decode()  # decode bytes to utf-8
-                        protocol_msg = message.split(" ")
-                        if len(protocol_msg) == 3 and protocol_msg[0] == "MY_ADDR":
-                            self.servers.add(sock, listen_addr=(protocol_msg[1], int(protocol_msg[2])))
+    # The send queue already writes everything queued in one round of events with one sendmsg, so Nagle's
+    # algorithm would only hold the last small write back until the previous one is acknowledged. Unix sockets
+    # (the worker links) have no such option.
+    def set_nodelay(self, sock):
+        if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass  # the connection has been reset already, reading it will tell
 
-                            log_message = "Server connected, IP: {}, server listen port: {}".format(protocol_msg[1], protocol_msg[2])
-                            print(log_message)
-                            self.logger.info(log_message)
+    def resume_accepting(self):
+        if not self.paused_listeners:
+            return
+        now = time.monotonic()
+        for listen_sock, (handler, resume_time) in list(self.paused_listeners.items()):
+            if now >= resume_time:
+                del self.paused_listeners[listen_sock]
+                self.selector.register(listen_sock, selectors.EVENT_READ, handler)
+
+    # Every connection needs a file descriptor. Raise the soft limit of open files so that MAX_CLIENTS and
+    # MAX_SERVERS can be reached, or as close to that as the hard limit allows.
+    def raise_fd_limit(self):
+        needed = MChatServer.MAX_CLIENTS + MChatServer.MAX_SERVERS + MChatServer.FD_RESERVE
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY or soft >= needed:
+            return
+        limit = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        if limit > soft:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+                soft = limit
+            except (ValueError, OSError):
+                pass
+        if soft < needed:
+            self.logger.warning("The open file limit is {}, but MAX_CLIENTS and MAX_SERVERS need {}. Raise the hard "
+                                "limit (ulimit -Hn).".format(soft, needed))
+
+    # New connection attempt to client_listen_socket
+    def accept_client(self, listen_sock):
+        accepted = self.accept(listen_sock)
+        if accepted is None:
+            return
+        sockfd, addr = accepted
+        self.add_client(sockfd, addr)
 
-                            self.candidate_server_socket = None
-                    except socket.error:
-                        sock.close()
-                        self.candidate_server_socket = None
-                        continue
-                    # Not valid unicode message, ignore the message
-                    except (UnicodeDecodeError, UnicodeEncodeError):
-                        continue
-                    except ConnectionAddError:
-                        """ TODO: here we should tell the new server that we can not accept any more
-                                  servers (we're full). For now just close the connection.
-                        """
-                        sock.close()
-                        self.candidate_server_socket = None
-                        self.logger.exception("Connection from candidate server refused.")
-                        continue
+    def add_client(self, sockfd, addr):
+        try:
+            self.clients.add(sockfd)
+            self.add_connection(sockfd, self.read_client, self.close_client, self.client_metrics,
+                                MChatServer.CLIENT_SEND_QUEUE_MAXLEN, MChatServer.CLIENT_SLOW_CONSUMER_POLICY)
+            self.start_heartbleeds(sockfd)
+            log_message = "Client connected, IP: {}, port: {}".format(addr[0], addr[1])
+            self.logger.info(log_message)
+            if self.redirect_clients:
+                self.redirect_client(sockfd)
+        except ConnectionAddError:
+            """
+            TODO: Tell client that server is full. Our protocol doesn't define how to do this so let's
+                  just rudely close the connection and continue.
+            """
+            self.logger.exception("Connection from client IP: {}, port: {} refused.".format(addr[0], addr[1]))
+            sockfd.close()
+
+    # New server connection attempt
+    def accept_server(self, listen_sock):
+        accepted = self.accept(listen_sock)
+        if accepted is None:
+            return
+        self.add_candidate_server(accepted[0])
 
+    # Any number of candidate servers can be handshaking at the same time, each with its own deadline
+    def add_candidate_server(self, sock):
+        if len(self.candidate_servers) >= MChatServer.MAX_CANDIDATE_SERVERS:
+            self.logger.error("Too many servers connecting at the same time, connection refused.")
+            sock.close()
+            return
+        self.candidate_servers.add(sock)
+        self.add_connection(sock, self.read_candidate_server, self.close_candidate_server, self.server_metrics,
+                            MChatServer.SERVER_SEND_QUEUE_MAXLEN, MChatServer.SERVER_SLOW_CONSUMER_POLICY)
+        self.heartbleed_wheel.schedule(sock, time.monotonic() + MChatServer.HEARTBLEED_INTERVAL)
+        self.send_all_addrs(sock)
+
+    # Start the handshake with the candidate server by telling it all the servers we are connected to
+    def send_all_addrs(self, sock):
+        try:
+            addresses = [address[0] + " " + str(address[1]) for address in self.servers.listen_addrs]
+            for message in self.split_message("ALL_ADDRS", addresses):
+                self.send(sock, message)
+            # The new server should try the servers we just told about instead
+            if self.overlay and len(self.servers) >= MChatServer.OVERLAY_MAX_DEGREE:
+                self.send(sock, "FULL\n".encode())
+            # The new server answers with CAPS_ACK <the capabilities it supports too> after MY_ADDR
+            if self.link_caps:
+                self.send(sock, ("CAPS " + " ".join(self.link_caps) + "\n").encode())
+        except socket.error:
+            self.close_candidate_server(sock)
 
-                # Incoming message from a client
-                elif sock in self.clients.sockets:
-                    try:
-                        data = self.recv_until_newline(sock)
-                        message = data.decode()  # decode bytes to utf-8
-                        protocol_msg = message.split(" ", 3)
-
-                        if len(protocol_msg) == 1:
-                            if protocol_msg[0] == "BLEED":
-                                self.clients.set_heartbleed_received(sock)
-                            elif protocol_msg[0] == "HEART":
-                                sock.sendall("BLEED\n".encode())
-
-                        elif len(protocol_msg) == 2:
-                            if protocol_msg[0] == "JOIN":
-                                channel = protocol_msg[1]
-                                if len(channel) > MChatServer.CHANNELNAME_MAXLEN:
-                                    continue
-                                if self.channels.join(sock, channel):
-                                    nick = self.clients.get_nickname(sock)
-                                    self.send_system_message(channel, nick + " joined channel")
-                            elif protocol_msg[0] == "PART":
-                                channel = protocol_msg[1]
-                                if len(channel) > MChatServer.CHANNELNAME_MAXLEN:
-                                    continue
-                                if self.channels.part(sock, channel):
-                                    nick = self.clients.get_nickname(sock)
-                                    self.send_system_message(channel, nick + " left channel")
-                            elif protocol_msg[0] == "NICK":
-                                nick = protocol_msg[1]
-                                if len(nick) > MChatServer.NICKNAME_MAXLEN:
-                                    continue
-                                old_nick = self.clients.get_nickname(sock)
-                                if nick != old_nick:
-                                    self.clients.set_nickname(sock, nick)
-                                    for channel in self.channels.get_channels_of_socket(sock):
-                                        self.send_system_message(channel, old_nick + " changed nickname to " + nick)
-
-                        elif len(protocol_msg) == 4:
-                            if protocol_msg[0] == "MSG":
-                                nick = protocol_msg[1]
-                                # check that MSG message is valid (length of channel name and nickname), continue if it isn't
-                                if (len(nick) > MChatServer.NICKNAME_MAXLEN) or (len(protocol_msg[2]) > MChatServer.CHANNELNAME_MAXLEN):
-                                    continue
-                                # Limit so that MSG can only be sent if joined the channel first, continue if channel is not joined
-                                if sock not in self.channels.get(protocol_msg[2]):
-                                    continue
-
-                                old_nick = self.clients.get_nickname(sock)
-                                if nick != old_nick:
-                                    self.clients.set_nickname(sock, nick)
-                                    for channel in self.channels.get_channels_of_socket(sock):
-                                        self.send_system_message(channel, old_nick + " changed nickname to " + nick)
-
-                                broadcast_data = (message + "\n").encode()
-                                self.broadcast_channel(broadcast_data, protocol_msg[2], [sock])
-                                self.broadcast_servers(broadcast_data)
-
-                    # Client disconnected
-                    except socket.error:
-                        self.close_client(sock)
-                        continue
-                    # Not valid unicode message, ignore the message
-                    except (UnicodeDecodeError, UnicodeEncodeError):
-                        continue
-                    # Unable to join a channel
-                    except ChannelJoinError:
-                        """
-                        TODO: Here we should tell the client that joining channel was not successful.
-                              The protocol doesn't support this yet, so let's just continue.
-                        """
-                        try:
-                            addr = sock.getpeername()
-                            self.logger.exception("Client {} {} couldn't join channel {}.".format(addr[0], addr[1], protocol_msg[1]))
-                        except socket.error:
-                            self.logger.exception("Client couldn't join channel {}. Failed to fetch address of the client".format(protocol_msg[1]))
-                        continue
+    # A server completed its handshake while the other candidates were handshaking. Their ALL_ADDRS didn't
+    # include it, so tell them about it now, or they would never connect to each other.
+    def send_new_server_addr(self, listen_addr):
+        message = ("ALL_ADDRS " + listen_addr[0] + " " + str(listen_addr[1]) + "\n").encode()
+        self.broadcast_list(message, list(self.candidate_servers))
 
-                elif sock in self.servers.sockets:
-                    try:
-                        data = self.recv_until_newline(sock)
-                        message = data.decode()  # decode bytes to utf-8
-                        protocol_msg_id = message.split(" ", 1)[0]
-                        if protocol_msg_id == "MSG":
-                            protocol_msg = message.split(" ", 3)
-                            if len(protocol_msg) != 4:
-                                continue
-                            # check that MSG message is valid (length of channel name and nickname), continue if it isn't
-                            if (len(protocol_msg[1]) > MChatServer.NICKNAME_MAXLEN) or (len(protocol_msg[2]) > MChatServer.CHANNELNAME_MAXLEN):
-                                continue
-                            self.broadcast_channel((message + "\n").encode(), protocol_msg[2])
-
-                        elif protocol_msg_id == "ALL_ADDRS":
-                            all_addrs = message.split(" ")[1:]
-                            if len(all_addrs) % 2 == 1:
-                                continue  # odd number, address and port should come in pairs
-                            for i in range(0, len(all_addrs), 2):
-                                addr_tuple = (all_addrs[i], int(all_addrs[i+1]))
-                                if addr_tuple not in (self.servers.listen_addrs + self.not_connected_servers):
-                                    self.not_connected_servers.append(addr_tuple)
-                            # Send MY_ADDR as a response
-                            my_addr_msg = "MY_ADDR " + self.ip + " " + str(self.server_listen_port) + "\n"
-                            sock.sendall(my_addr_msg.encode())
-                        elif protocol_msg_id == "HEART" and len(message.split(" ")) == 1:
-                            sock.sendall("BLEED\n".encode())
-                        elif protocol_msg_id == "BLEED" and len(message.split(" ")) == 1:
-                            self.servers.set_heartbleed_received(sock)
-                        elif protocol_msg_id == "SYSTEM":
-                            protocol_msg = message.split(" ", 2)
-                            if len(protocol_msg) != 3:
-                                continue
-                            if len(protocol_msg[1]) > MChatServer.CHANNELNAME_MAXLEN:
-                                continue
-                            self.broadcast_channel((message + "\n").encode(), protocol_msg[1])
-
-                    except socket.error:
-                        self.close_server(sock)
-                        continue
-                    # Not valid unicode message, ignore the message
-                    except (UnicodeDecodeError, UnicodeEncodeError):
+    def read_candidate_server(self, sock):
+        connection = self.connections[sock]
+        try:
+            connection.recv_buffer.recv(sock)
+        except socket.error:
+            self.close_candidate_server(sock)
+            return
+        while sock in self.candidate_servers:
+            data = connection.recv_buffer.next_line()
+            if data is None:
+                return
+            self.handle_candidate_message(sock, data)
+        # MY_ADDR was accepted. Anything the new server sent after it belongs to the server connection.
+        if self.connections.get(sock) is connection:
+            self.handle_buffered_messages(sock, self.handle_server_message)
+
+    def handle_candidate_message(self, sock, data):
+        try:
+            message = data.decode()  # decode bytes to utf-8
+            protocol_msg = message.split(" ")
+            if len(protocol_msg) == 3 and protocol_msg[0] == "MY_ADDR":
+                if self.overlay and len(self.servers) >= MChatServer.OVERLAY_MAX_DEGREE:
+                    self.close_candidate_server(sock)
+                    return
+                listen_addr = (protocol_msg[1], int(protocol_msg[2]))
+                if not self.keep_new_server_link(listen_addr, listen_addr):
+                    self.close_candidate_server(sock)
+                    return
+                self.servers.add(sock, listen_addr=listen_addr)
+                self.known_servers.add(listen_addr)
+
+                log_message = "Server connected, IP: {}, server listen port: {}".format(protocol_msg[1], protocol_msg[2])
+                self.logger.info(log_message)
+
+                self.promote_candidate_server(sock)
+                self.connections[sock].recv_buffer.keep_newline = True
+                self.start_heartbleeds(sock)
+                self.interest_unknown.add(sock)
+                self.send_interest(sock)
+                self.send_new_server_addr(listen_addr)
+                if self.overlay:
+                    self.overlay_children[listen_addr] = None
+                    self.send_overlay_path(sock)
+        except socket.error:
+            self.close_candidate_server(sock)
+        # Not valid unicode message, ignore the message
+        except (UnicodeDecodeError, UnicodeEncodeError):
+            return
+        except ConnectionAddError:
+            """ TODO: here we should tell the new server that we can not accept any more
+                      servers (we're full). For now just close the connection.
+            """
+            self.close_candidate_server(sock)
+            self.logger.exception("Connection from candidate server refused.")
+
+    # Incoming data from a client
+    def read_client(self, sock):
+        try:
+            self.connections[sock].recv_buffer.recv(sock)
+        except socket.error:
+            self.close_client(sock)
+            return
+        self.handle_buffered_messages(sock, self.handle_client_message)
+
+    # Client messages are dispatched by their first word, which is looked up as bytes. The handler gets the rest of
+    # the message as bytes and checks the lengths of the arguments before decoding them, and it gets the whole
+    # message too, so it can be passed on without encoding it again.
+    def handle_client_message(self, sock, data):
+        self.client_metrics.messages_received.inc()
+        command, space, args = data.partition(b" ")
+        handler = self.client_commands.get(command)
+        if handler is None:
+            return
+        # Arguments are required if the command takes them and not allowed if it doesn't
+        if (handler in self.no_arg_commands) == bool(space):
+            return
+        try:
+            handler(sock, args, data)
+        # Client disconnected
+        except socket.error:
+            self.close_client(sock)
+        # Not valid unicode message, ignore the message
+        except (UnicodeDecodeError, UnicodeEncodeError):
+            return
+
+    # Add a client command. handler(sock, args, data) is called with the arguments (bytes after the command and a
+    # space) and the whole message. A command without arguments is only accepted without the space.
+    def register_command(self, command, handler, has_args=True):
+        self.client_commands[command.encode()] = handler
+        if not has_args:
+            self.no_arg_commands.add(handler)
+
+    # Decode a client argument that must not contain spaces. Returns None if it is too long or has spaces.
+    def decode_argument(self, arg, max_length):
+        # A character is 1 - 4 bytes, so arguments that are far too long are dropped without decoding them
+        if len(arg) > max_length * 4:
+            return None
+        arg = arg.decode()
+        if len(arg) > max_length or " " in arg:
+            return None
+        return arg
+
+    def handle_bleed(self, sock, args, data):
+        self.clients.set_heartbleed_received(sock)
+
+    def handle_heart(self, sock, args, data):
+        self.send(sock, "BLEED\n".encode())
+
+    def handle_join(self, sock, args, data):
+        channel = self.decode_argument(args, MChatServer.CHANNELNAME_MAXLEN)
+        if channel is None:
+            return
+        try:
+            joined = self.channels.join(sock, channel)
+        # Unable to join a channel
+        except ChannelJoinError:
+            """
+            TODO: Here we should tell the client that joining channel was not successful.
+                  The protocol doesn't support this yet, so let's just continue.
+            """
+            try:
+                addr = sock.getpeername()
+                self.logger.exception("Client {} {} couldn't join channel {}.".format(addr[0], addr[1], channel))
+            except socket.error:
+                self.logger.exception("Client couldn't join channel {}. Failed to fetch address of the client".format(channel))
+            return
+        if joined:
+            if self.channels.member_count(channel) == 1:
+                self.update_interest(channel)
+            nick = self.clients.get_nickname(sock)
+            self.send_system_message(channel, nick + " joined channel")
+
+    def handle_part(self, sock, args, data):
+        channel = self.decode_argument(args, MChatServer.CHANNELNAME_MAXLEN)
+        if channel is None:
+            return
+        if self.channels.part(sock, channel):
+            if not self.channels.member_count(channel):
+                self.update_interest(channel)
+            nick = self.clients.get_nickname(sock)
+            self.send_system_message(channel, nick + " left channel")
+
+    def handle_nick(self, sock, args, data):
+        nick = self.decode_argument(args, MChatServer.NICKNAME_MAXLEN)
+        if nick is None:
+            return
+        self.change_nickname(sock, nick)
+
+    # MSG <nick> <channel> <text>. The nick and the channel are bounded in the bytes like any other argument, and
+    # the text is decoded only if they pass, so that invalid unicode is never passed on.
+    def handle_msg(self, sock, args, data):
+        fields = args.split(b" ", 2)
+        if len(fields) != 3:
+            return
+        nick = self.decode_argument(fields[0], MChatServer.NICKNAME_MAXLEN)
+        channel = self.decode_argument(fields[1], MChatServer.CHANNELNAME_MAXLEN)
+        if nick is None or channel is None:
+            return
+        # Limit so that MSG can only be sent if joined the channel first, return if channel is not joined
+        if not self.channels.is_member(sock, channel):
+            return
+        message = "MSG " + nick + " " + channel + " " + fields[2].decode()
+
+        self.change_nickname(sock, nick)
+
+        broadcast_data = data + b"\n"
+        self.broadcast_channel(broadcast_data, channel, [sock])
+        self.broadcast_peers(broadcast_data, [channel], frame=self.create_frame(message))
+
+    # Incoming data from a server
+    def read_server(self, sock):
+        try:
+            self.connections[sock].recv_buffer.recv(sock)
+        except socket.error:
+            self.close_server(sock)
+            return
+        self.handle_buffered_messages(sock, self.handle_server_message)
+
+    # data is a text protocol message, the data of a BATCH or, on a binary link, a binary frame
+    def handle_server_message(self, sock, data):
+        connection = self.connections[sock]
+        if connection.batcher is not None and connection.batcher.block_compressed is not None:
+            self.handle_batch(sock, connection.batcher, data)
+            return
+        connection.metrics.messages_received.inc()
+        if connection.recv_buffer.binary:
+            self.handle_server_frame(sock, data)
+        else:
+            self.handle_server_line(sock, data)
+
+    # The lines read from a server link end with their newline, so that relay_server_line() can pass them on as
+    # they are. The lines of batches and binary text frames don't.
+    def handle_server_line(self, sock, data):
+        if not self.overlay and (data.startswith(b"MSG ") or data.startswith(b"SYSTEM ")):
+            if self.relay_server_line(sock, data):
+                return
+        if data.endswith(b"\n"):
+            data = data[:-1]
+        batcher = self.connections[sock].batcher
+        try:
+            message = data.decode()  # decode bytes to utf-8
+            relay_data = None
+            if message.startswith("RELAY "):
+                relay = message.split(" ", 3)
+                if len(relay) != 4 or not self.remember_relayed(relay[1], relay[2]):
+                    return
+                relay_data = (message + "\n").encode()
+                message = relay[3]
+            protocol_msg_id = message.split(" ", 1)[0]
+            if protocol_msg_id == "MSG":
+                protocol_msg = message.split(" ", 3)
+                if len(protocol_msg) != 4:
+                    return
+                # check that MSG message is valid (length of channel name and nickname), return if it isn't
+                if (len(protocol_msg[1]) > MChatServer.NICKNAME_MAXLEN) or (len(protocol_msg[2]) > MChatServer.CHANNELNAME_MAXLEN):
+                    return
+                broadcast_data = (message + "\n").encode()
+                self.broadcast_channel(broadcast_data, protocol_msg[2])
+                self.broadcast_peers(broadcast_data, [protocol_msg[2]], sock, relay_data, self.create_frame(message))
+
+            elif protocol_msg_id == "ALL_ADDRS":
+                all_addrs = message.split(" ")[1:]
+                if len(all_addrs) % 2 == 1:
+                    return  # odd number, address and port should come in pairs
+                for i in range(0, len(all_addrs), 2):
+                    addr_tuple = (all_addrs[i], int(all_addrs[i+1]))
+                    if self.is_own_address(*addr_tuple):
                         continue
+                    self.known_servers.add(addr_tuple)
+                    # In overlay mode only remembered, maintain_overlay() connects to them if we need a new parent
+                    if not self.overlay and not self.servers.has_listen_addr(addr_tuple):
+                        self.not_connected_servers[addr_tuple] = None
+                # Send MY_ADDR as a response
+                my_addr_msg = "MY_ADDR " + self.ip + " " + str(self.server_listen_port) + "\n"
+                self.send(sock, my_addr_msg.encode())
+                # The other server handles everything after MY_ADDR as a server message
+                self.send_interest(sock)
+            elif protocol_msg_id == "HEART" and len(message.split(" ")) == 1:
+                self.send(sock, "BLEED\n".encode())
+            elif protocol_msg_id == "BLEED" and len(message.split(" ")) == 1:
+                self.servers.set_heartbleed_received(sock)
+            elif protocol_msg_id == "SYSTEM":
+                protocol_msg = message.split(" ", 2)
+                if len(protocol_msg) != 3:
+                    return
+                if len(protocol_msg[1]) > MChatServer.CHANNELNAME_MAXLEN:
+                    return
+                broadcast_data = (message + "\n").encode()
+                self.broadcast_channel(broadcast_data, protocol_msg[1])
+                self.broadcast_peers(broadcast_data, [protocol_msg[1]], sock, relay_data, self.create_frame(message))
+            elif protocol_msg_id == "PRESENCE":
+                presence = self.parse_presence(message)
+                if presence is None:
+                    return
+                self.deliver_presence(*presence)
+                self.broadcast_peers((message + "\n").encode(), presence[3], sock, relay_data)
+            elif protocol_msg_id == "SUB" or protocol_msg_id == "UNSUB":
+                self.handle_interest_message(sock, message)
+            elif protocol_msg_id == "FULL" and self.overlay:
+                self.close_server(sock)
+            elif protocol_msg_id == "OVERLAY_PATH" and self.overlay:
+                self.handle_overlay_path(sock, message.split(" ")[1:])
+            elif protocol_msg_id == "BATCH":
+                self.handle_batch_header(sock, batcher, message.split(" "))
+            elif protocol_msg_id == "CREDIT":
+                protocol_msg = message.split(" ")
+                if batcher is not None and len(protocol_msg) == 2:
+                    batcher.add_credit(int(protocol_msg[1]))
+                    self.release_batches(sock, self.connections[sock])
+            elif protocol_msg_id == "CAPS" or protocol_msg_id == "CAPS_ACK":
+                self.handle_caps(sock, message.split(" "))
+            elif protocol_msg_id == "LOAD":
+                # LOAD <client ip> <client port> <connections> <messages per second> <loop latency in ms>
+                protocol_msg = message.split(" ")
+                if len(protocol_msg) == 6:
+                    self.peer_load[sock] = LoadReport((protocol_msg[1], int(protocol_msg[2])), int(protocol_msg[3]),
+                                                      float(protocol_msg[4]), float(protocol_msg[5]), time.monotonic())
+            elif message == "MODE BINARY" and "BINARY" in self.link_caps:
+                # Everything after this is binary frames. The largest frame is a full batch.
+                self.connections[sock].recv_buffer.set_binary(LinkBatcher.MAX_BLOCK_SIZE + binaryframe.HEADER.size)
+
+        except socket.error:
+            self.close_server(sock)
+        # Not valid unicode message, ignore the message
+        except (UnicodeDecodeError, UnicodeEncodeError):
+            return
+        # Invalid number in CREDIT or LOAD
+        except ValueError:
+            return
+
+    # Pass a MSG or SYSTEM message from a server on without decoding it. Only the positions of the fields are
+    # looked up, and the channel members are found by the encoded channel name. The other server may be broken,
+    # so the field lengths are checked and the message must be valid unicode: an ASCII message is, anything else
+    # is test decoded. Returns False if the message can't be checked from the bytes alone, and should be handled
+    # as text.
+    def relay_server_line(self, sock, data):
+        if not data.isascii():
+            try:
+                data.decode()
+            except UnicodeDecodeError:
+                return False
+        if data.startswith(b"MSG "):
+            nick_end = data.find(b" ", 4, 5 + MChatServer.NICKNAME_MAXLEN)
+            if nick_end < 0:
+                return False
+            channel_start = nick_end + 1
+        else:
+            channel_start = 7
+        channel_end = data.find(b" ", channel_start, channel_start + MChatServer.CHANNELNAME_MAXLEN + 1)
+        if channel_end < 0:
+            return False
+        channel = data[channel_start:channel_end]
+        broadcast_data = data if data.endswith(b"\n") else data + b"\n"
+        self.broadcast_list(broadcast_data, self.channels.get_encoded(channel))
+        # Servers are all connected to each other, so only the workers need the message
+        if self.workers.sockets:
+            try:
+                self.broadcast_peers(broadcast_data, [channel.decode()], sock)
+            except UnicodeDecodeError:
+                pass
+        return True
+
+    # CAPS <capability> ... offers the capabilities to a new server after ALL_ADDRS, and the new server answers
+    # with CAPS_ACK <capability> ... listing the ones both support. Both then start using them. With BINARY each
+    # side sends MODE BINARY as its last text message, so the other side knows where the binary frames start.
+    def handle_caps(self, sock, protocol_msg):
+        connection = self.connections[sock]
+        if connection.batcher is not None or connection.binary:
+            return
+        caps = [cap for cap in protocol_msg[1:] if cap in self.link_caps]
+        if protocol_msg[0] == "CAPS":
+            if not caps:
+                return
+            self.send(sock, ("CAPS_ACK " + " ".join(caps) + "\n").encode())
+        if "BINARY" in caps:
+            self.send(sock, "MODE BINARY\n".encode())
+            connection.binary = True
+        if "BATCH" in caps:
+            connection.batcher = LinkBatcher("ZLIB" in caps, connection.binary, MChatServer.SERVER_SEND_QUEUE_MAXLEN)
+
+    # MSG and SYSTEM frames are passed on to the other servers and workers as they are. Their payload was
+    # validated by the server that got it from a client, so only the header fields are decoded here.
+    def handle_server_frame(self, sock, frame):
+        frame_type, flags, channel, nick, payload = binaryframe.decode(frame)
+        if frame_type == binaryframe.TYPE_TEXT:
+            self.handle_server_line(sock, payload)
+            return
+        if frame_type == binaryframe.TYPE_BATCH:
+            batcher = self.connections[sock].batcher
+            if batcher is None:
+                self.close_server(sock)
+                return
+            batcher.block_compressed = bool(flags & binaryframe.FLAG_COMPRESSED)
+            self.handle_batch(sock, batcher, payload)
+            return
+        try:
+            channel_name = channel.decode()
+            if len(channel_name) > MChatServer.CHANNELNAME_MAXLEN or " " in channel_name:
+                return
+            if frame_type == binaryframe.TYPE_MSG:
+                nick_name = nick.decode()
+                if len(nick_name) > MChatServer.NICKNAME_MAXLEN or " " in nick_name:
+                    return
+                broadcast_data = b"MSG " + nick + b" " + channel + b" " + payload + b"\n"
+            elif frame_type == binaryframe.TYPE_SYSTEM:
+                broadcast_data = b"SYSTEM " + channel + b" " + payload + b"\n"
+            else:
+                return
+        # Not valid unicode, ignore the frame
+        except UnicodeDecodeError:
+            return
+        self.broadcast_channel(broadcast_data, channel_name)
+        self.broadcast_peers(broadcast_data, [channel_name], sock, frame=frame)
+
+    # BATCH <size> [Z] is followed by size bytes of frames, which handle_batch() gets as one piece
+    def handle_batch_header(self, sock, batcher, protocol_msg):
+        # If we can't tell where the batch ends, the rest of the stream can't be trusted
+        if batcher is None or len(protocol_msg) < 2 or len(protocol_msg) > 3 or not protocol_msg[1].isdigit():
+            self.close_server(sock)
+            return
+        size = int(protocol_msg[1])
+        if size > LinkBatcher.MAX_BLOCK_SIZE:
+            self.close_server(sock)
+            return
+        batcher.block_compressed = len(protocol_msg) == 3 and protocol_msg[2] == "Z"
+        self.connections[sock].recv_buffer.expect_block(size)
+
+    def handle_batch(self, sock, batcher, block):
+        payload = batcher.unpack(block)
+        if payload is None:
+            self.close_server(sock)
+            return
+        connection = self.connections[sock]
+        if connection.recv_buffer.binary:
+            frames = binaryframe.split(payload)
+            if frames is None:
+                self.close_server(sock)
+                return
+        else:
+            frames = payload.split(b"\n")[:-1]
+        for frame in frames:
+            self.handle_server_message(sock, frame)
+            if self.connections.get(sock) is not connection:
+                return
+        consumed = batcher.take_consumed()
+        if consumed:
+            credit = ("CREDIT " + str(consumed) + "\n").encode()
+            if connection.binary:
+                credit = binaryframe.encode_text(credit)
+            try:
+                self.push_frame(sock, connection, credit)
+            except socket.error:
+                self.close_server(sock)
+
+    def add_worker(self, sock):
+        self.workers.add(sock)
+        self.add_connection(sock, self.read_worker, self.close_worker, self.worker_metrics,
+                            MChatServer.WORKER_SEND_QUEUE_MAXLEN, MChatServer.WORKER_SLOW_CONSUMER_POLICY)
+        self.interest_unknown.add(sock)
+        self.send_interest(sock)
 
+    # Incoming data from another worker process of this host
+    def read_worker(self, sock):
+        try:
+            self.connections[sock].recv_buffer.recv(sock)
+        except socket.error:
+            self.close_worker(sock)
+            return
+        self.handle_buffered_messages(sock, self.handle_worker_message)
+
+    # Workers only pass MSG, SYSTEM, PRESENCE and subscription messages to each other. They have been validated by
+    # the worker that received them from a client or a server.
+    def handle_worker_message(self, sock, data):
+        self.worker_metrics.messages_received.inc()
+        try:
+            message = data.decode()  # decode bytes to utf-8
+            protocol_msg = message.split(" ", 3)
+            broadcast_data = (message + "\n").encode()
+            if protocol_msg[0] == "MSG" and len(protocol_msg) == 4:
+                channels = [protocol_msg[2]]
+            elif protocol_msg[0] == "SYSTEM" and len(protocol_msg) >= 3:
+                channels = [protocol_msg[1]]
+            elif protocol_msg[0] == "PRESENCE":
+                presence = self.parse_presence(message)
+                if presence is None:
+                    return
+                self.deliver_presence(*presence)
+                channels = presence[3]
+            elif protocol_msg[0] == "SUB" or protocol_msg[0] == "UNSUB":
+                self.handle_interest_message(sock, message)
+                return
+            elif protocol_msg[0] == "WORKER_LOAD" and len(protocol_msg) == 3:
+                # WORKER_LOAD <clients> <messages per second>
+                self.worker_load[sock] = (int(protocol_msg[1]), float(protocol_msg[2]))
+                return
+            else:
+                return
+            if protocol_msg[0] != "PRESENCE":
+                self.broadcast_channel(broadcast_data, channels[0])
+            # The gateway passes the message on to the other servers and the rest of the workers
+            self.broadcast_peers(broadcast_data, channels, sock, frame=self.create_frame(message))
+        # Not valid unicode message, ignore the message
+        except (UnicodeDecodeError, UnicodeEncodeError):
+            return
+        # Invalid number in WORKER_LOAD
+        except ValueError:
+            return
 
     # Helper method for broadcasting to every other socket except sock (given as parameter)
     # and self.listen_sock
@@ -310,52 +911,229 @@ class MChatServer(Daemon):
     def broadcast_servers(self, message, blacklist=None):
         self.broadcast_list(message, self.servers.sockets, blacklist)
 
+    # Worker processes of a WorkerGroup are linked so that the gateway (worker 0) has a link to every other worker
+    # and the other workers only have a link to the gateway
+    def broadcast_workers(self, message, blacklist=None):
+        self.broadcast_list(message, self.workers.sockets, blacklist)
+
+    # Send message to the servers and workers that want messages of any of the channels. source is the link the
+    # message came from, or None if it came from a local client. Servers are all connected to each other, so a
+    # message from a server is only passed on to the workers, unless the servers form an overlay. In overlay mode
+    # the servers get the message as relay_data, which is created here if the message doesn't have an ID yet.
+    # frame is the message as a binary frame for the servers that use binary links, if it has one.
+    def broadcast_peers(self, message, channels, source=None, relay_data=None, frame=None):
+        peers = self.get_interested_peers(channels, source)
+        if self.overlay:
+            servers = [peer for peer in peers if peer in self.servers.sockets]
+            if servers:
+                if relay_data is None:
+                    relay_data = self.create_relay_data(message)
+                peers = [peer for peer in peers if peer not in self.servers.sockets]
+                self.broadcast_list(relay_data, servers)
+        self.broadcast_list(message, peers, frame=frame)
+
+    def get_interested_peers(self, channels, source=None):
+        only_workers = not self.overlay and source is not None and source in self.servers.sockets
+        peers = {}
+        for channel in channels:
+            for peer in self.peer_interest.get(channel):
+                peers[peer] = None
+        for peer in self.interest_unknown:
+            peers[peer] = None
+        peers.pop(source, None)
+        if only_workers:
+            return [peer for peer in peers if peer in self.workers.sockets]
+        return list(peers)
+
     def broadcast_channel(self, message, channel, blacklist=None):
         socklist = self.channels.get(channel)
         self.broadcast_list(message, socklist, blacklist)
 
-    def broadcast_list(self, message, socklist, blacklist=None):
-        if blacklist is None:
-            blacklist = []
-
-        forced_blacklist = [self.client_listen_socket, self.server_listen_socket]
+    # message is bytes. The same bytes object is queued to every receiver, nothing is copied per receiver.
+    def broadcast_list(self, message, socklist, blacklist=None, frame=None):
+        self.broadcast_receivers.observe(len(socklist))
+        if blacklist:
+            blacklist = set(blacklist)
 
+        dead_sockets = []
         for recv_socket in socklist:
-            if recv_socket not in forced_blacklist and recv_socket not in blacklist:
-                try:
-                    recv_socket.sendall(message)
-                except socket.error:
-                    # Broken connection, close it
-                    if recv_socket in self.clients.sockets:
-                        self.close_client(recv_socket)
-                    elif recv_socket in self.servers.sockets:
-                        self.close_server(recv_socket)
-                    elif recv_socket == self.candidate_server_socket:
-                        self.candidate_server_socket.close()
-                        self.candidate_server_socket = None
-                    else:
-                        raise
-
-    # Call recv() until newline (success) or PROTOCOL_MSG_MAXLEN * 4 bytes received (utf-8 char is max 4 bytes)
-    # Returns message received before newline. Does NOT return the newline character.
-    # raises socket.error
-    def recv_until_newline(self, sock):
-        max_len = MChatServer.PROTOCOL_MSG_MAXLEN * 4
-        total_data = bytearray()
-        while max_len > 0:
+            if blacklist and recv_socket in blacklist:
+                continue
             try:
-                data = sock.recv(1)
+                self.send(recv_socket, message, frame)
             except socket.error:
-                raise
-            if data:
-                max_len -= 1
-                if data == b'\n':
-                    break
-                total_data.extend(data)
-            else:
-                raise socket.error
+                dead_sockets.append(recv_socket)
 
-        return bytes(total_data)
+        # Broken connections are closed only after the loop, because closing a client modifies the channel lists
+        for dead_sock in dead_sockets:
+            self.close_socket(dead_sock)
+
+    # Start reading sock with the given handler. Every connection gets its own receive buffer, so partial
+    # messages never block the other connections, and its own send queue, so a slow reader never blocks the others.
+    # The traffic of the connection is counted in metrics, the ConnectionMetrics of its type.
+    def add_connection(self, sock, read_handler, close_handler, metrics, send_queue_maxlen, slow_consumer_policy):
+        recv_buffer = LineBuffer(MChatServer.PROTOCOL_MSG_MAXLEN * 4, metrics.bytes_received)  # utf-8 char is max 4 bytes
+        send_queue = SendQueue(send_queue_maxlen, slow_consumer_policy, metrics.bytes_sent)
+        self.connections[sock] = ConnectionIO(recv_buffer, send_queue, read_handler, close_handler, metrics)
+        metrics.opened.inc()
+        self.register(sock, read_handler)
+
+    def register(self, sock, read_handler):
+        self.selector.register(sock, selectors.EVENT_READ, read_handler)
+
+    # Stop reading sock, drop its buffers and close it
+    def close_connection(self, sock):
+        connection = self.connections.pop(sock, None)
+        if connection is not None:
+            connection.metrics.closed.inc()
+        self.heartbleed_wheel.cancel(sock)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+    # Close sock properly whatever kind of connection it is
+    def close_socket(self, sock):
+        connection = self.connections.get(sock)
+        if connection is not None:
+            connection.close(sock)
+
+    # Queue data (bytes) to be sent to sock. The queue is flushed at the end of the loop iteration, so everything
+    # sent to sock during one iteration goes out with a single system call. Raises socket.error if the connection
+    # is closed or the slow consumer policy of the connection is POLICY_DISCONNECT and the queue is full. The
+    # caller should close the connection in that case. On a binary link the message is sent as frame, or as a
+    # text frame if it has no frame of its own.
+    def send(self, sock, data, frame=None):
+        connection = self.connections.get(sock)
+        if connection is None:
+            raise socket.error("Send to a closed connection")
+        connection.metrics.messages_sent.inc()
+        if connection.binary:
+            data = frame if frame is not None else binaryframe.encode_text(data)
+        if connection.batcher is not None:
+            if connection.batcher.add(data):
+                self.release_batches(sock, connection)
+            self.schedule_flush(sock)
+            return
+        self.push_frame(sock, connection, data)
+
+    # Queue data to be sent to the socket, bypassing the batcher
+    def push_frame(self, sock, connection, data):
+        send_queue = connection.send_queue
+        was_dropping = send_queue.dropped > 0
+        try:
+            send_queue.push(data)
+        except socket.error:
+            self.log_slow_consumer(sock, "disconnected")
+            raise
+        if send_queue.dropped and not was_dropping:
+            self.log_slow_consumer(sock, "started dropping messages")
+        # Don't let one iteration pile up a lot of data, write it out early
+        if send_queue.size >= SendQueue.EARLY_FLUSH_SIZE:
+            try:
+                send_queue.flush(sock)
+            except socket.error:
+                pass  # the error is raised again and handled by the scheduled flush
+        self.schedule_flush(sock)
+
+    # Close the batch being filled and move the batches that fit in the credit to the send queue
+    def release_batches(self, sock, connection):
+        batcher = connection.batcher
+        try:
+            batcher.seal()
+        except socket.error:
+            self.log_slow_consumer(sock, "disconnected")
+            raise
+        for batch in batcher.take_sendable():
+            self.push_frame(sock, connection, batch)
+
+    def schedule_flush(self, sock):
+        self.pending_flushes.add(sock)
+
+    def flush_pending(self):
+        # Flushing may close connections, which may send more messages (e.g. "left channel")
+        while self.pending_flushes:
+            pending_flushes = self.pending_flushes
+            self.pending_flushes = set()
+            for sock in pending_flushes:
+                if sock in self.connections:
+                    self.flush(sock)
+
+    # Called when sock is writable and at the end of the loop iterations sock has been sent something
+    def flush(self, sock):
+        connection = self.connections[sock]
+        send_queue = connection.send_queue
+        try:
+            if connection.batcher is not None:
+                self.release_batches(sock, connection)
+            emptied = send_queue.flush(sock)
+        except socket.error:
+            connection.close(sock)
+            return
+        if emptied:
+            self.log_dropped_messages(sock, send_queue)
+            # An admin connection is done when its answer has been sent
+            if sock in self.admin_requests and self.admin_requests[sock] is None:
+                self.close_admin(sock)
+                return
+        was_paused = connection.reads_paused
+        self.update_events(sock)
+        # Messages may have been left in the receive buffer when reading was paused
+        if was_paused and not connection.reads_paused:
+            connection.read(sock)
+
+    # Register sock for writing while it has data waiting and stop reading it while its send queue is full
+    # (POLICY_PAUSE_READS only)
+    def update_events(self, sock):
+        connection = self.connections[sock]
+        send_queue = connection.send_queue
+        self.update_reads_paused(sock, connection)
+        events = 0 if connection.reads_paused else selectors.EVENT_READ
+        if send_queue.frames:
+            events |= selectors.EVENT_WRITE
+        key = self.selector.get_key(sock)
+        if key.events != events:
+            self.selector.modify(sock, events, key.data)
+
+    def update_reads_paused(self, sock, connection):
+        send_queue = connection.send_queue
+        if send_queue.policy != SendQueue.POLICY_PAUSE_READS:
+            return
+        if not connection.reads_paused and send_queue.is_full():
+            connection.reads_paused = True
+            self.log_slow_consumer(sock, "paused reading")
+        elif connection.reads_paused and send_queue.has_drained():
+            connection.reads_paused = False
+
+    def log_dropped_messages(self, sock, send_queue):
+        if send_queue.dropped:
+            self.log_slow_consumer(sock, "dropped {} messages".format(send_queue.dropped))
+            send_queue.dropped = 0
+
+    # Returns (frames, bytes) waiting to be sent to sock
+    def get_send_queue_depth(self, sock):
+        send_queue = self.connections[sock].send_queue
+        return (len(send_queue), send_queue.size)
+
+    def log_slow_consumer(self, sock, action):
+        frames, size = self.get_send_queue_depth(sock)
+        try:
+            addr = sock.getpeername()
+            self.logger.warning("Slow connection {} {}: {} ({} messages, {} bytes queued)".format(addr[0], addr[1], action, frames, size))
+        except socket.error:
+            self.logger.warning("Slow connection: {} ({} messages, {} bytes queued)".format(action, frames, size))
+
+    # Pass the complete messages already received from sock to handle_message one by one. Stops if sock gets
+    # closed by one of the messages.
+    def handle_buffered_messages(self, sock, handle_message):
+        connection = self.connections[sock]
+        data = connection.recv_buffer.next_line()
+        while data is not None:
+            handle_message(sock, data)
+            if self.connections.get(sock) is not connection or connection.reads_paused:
+                return
+            data = connection.recv_buffer.next_line()
 
     # This method should not raise error or do anything unexpected even if the socket is already closed or invalid
     def close_client(self, client_sock):
@@ -369,23 +1147,31 @@ class MChatServer(Daemon):
         try:
             client_name = client_sock.getpeername()
             log_message = "Client offline, IP: {}, port: {}".format(client_name[0], client_name[1])
-            print(log_message)
             self.logger.info(log_message)
         except socket.error:
             log_message = "Client offline, failed to fetch IP and port of the client"
-            print(log_message)
             self.logger.info(log_message)
 
         # Part closing client from all channels
         parted_channels = self.channels.part_all(client_sock)
 
         self.clients.remove(client_sock)
-        client_sock.close()
+        self.close_connection(client_sock)
 
         # Send system message about the client leaving in the end of the method so that it does not get sent
         # to the  client itself
+        if parted_channels:
+            self.send_presence(MChatServer.PRESENCE_QUIT, nick, None, parted_channels)
         for channel in parted_channels:
-            self.send_system_message(channel, nick + " left channel")
+            if not self.channels.member_count(channel):
+                self.update_interest(channel)
+
+    def change_nickname(self, sock, nick):
+        old_nick = self.clients.get_nickname(sock)
+        if self.clients.set_nickname(sock, nick):
+            channels = self.channels.get_channels_of_socket(sock)
+            if channels:
+                self.send_presence(MChatServer.PRESENCE_NICK, old_nick, nick, channels)
 
 
     # This method should not raise error or do anything unexpected even if the socket is already closed or invalid
@@ -398,96 +1184,518 @@ class MChatServer(Daemon):
             return
 
         log_message = "Closed server connection, IP: {}, port: {}".format(listen_addr[0], listen_addr[1])
-        print(log_message)
         self.logger.info(log_message)
 
         self.servers.remove(server_sock)
-        server_sock.close()
-
-    def process_heartbleeds(self):
-        self.check_heartbleed_responses(self.clients)
-        self.check_heartbleed_responses(self.servers)
+        self.close_connection(server_sock)
+        self.forget_interest(server_sock)
+        self.peer_load.pop(server_sock, None)
+        if server_sock is self.overlay_parent:
+            # maintain_overlay() looks for a new parent right away
+            self.overlay_parent = None
+            self.overlay_retry_timer.reset()
+            self.set_overlay_path([self.relay_origin])
+
+    def close_worker(self, worker_sock):
+        if worker_sock not in self.workers.sockets:
+            return
+        log_message = "Lost link to another worker process"
+        self.logger.error(log_message)
+        self.workers.remove(worker_sock)
+        self.worker_load.pop(worker_sock, None)
+        self.close_connection(worker_sock)
+        self.forget_interest(worker_sock)
+
+    # The candidate server has been added to self.servers, from now on handle it as a server connection
+    def promote_candidate_server(self, sock):
+        connection = self.connections[sock]
+        connection.read = self.read_server
+        connection.close = self.close_server
+        self.selector.modify(sock, self.selector.get_key(sock).events, self.read_server)
+        self.candidate_servers.discard(sock)
+
+    # Two servers that handshake with others at the same time may connect to each other at the same time too.
+    # Of two links between the same servers, the one opened by the server with the smaller listen address is
+    # kept, so both ends agree on it. Returns False if the new link opened by initiator_addr should be closed,
+    # and closes the old link if the new one is kept.
+    def keep_new_server_link(self, listen_addr, initiator_addr):
+        old_sock = self.servers.get_socket_by_listen_addr(listen_addr)
+        if old_sock is None:
+            return True
+        if min((self.ip, self.server_listen_port), listen_addr) != initiator_addr:
+            return False
+        self.close_server(old_sock)
+        return True
+
+    def close_candidate_server(self, sock):
+        if sock not in self.candidate_servers:
+            return
+        self.candidate_servers.discard(sock)
+        self.close_connection(sock)
 
-        self.send_heartbleed_requests(self.clients)
-        self.send_heartbleed_requests(self.servers)
+    def start_heartbleeds(self, sock):
+        first_deadline = time.monotonic() + random.uniform(0, MChatServer.HEARTBLEED_INTERVAL)
+        self.heartbleed_wheel.schedule(sock, first_deadline)
 
-    def check_heartbleed_responses(self, conn_manager):
-        # Check if previous HEART\m messages were answered
+    # Check the client and server connections whose heartbleed deadline has passed. Their previous HEART
+    # should have been answered by now. Alive connections get a new HEART and a new deadline one interval later.
+    # Candidate servers whose deadline has passed are closed.
+    def process_heartbleeds(self):
+        now = time.monotonic()
         dead_sockets = []
-        for i in range(len(conn_manager.heartbleed_status)):
-            if conn_manager.heartbleed_status[i] < 0:
-                conn_manager.heartbleed_status[i] = 0
-            elif conn_manager.heartbleed_status[i] < MChatServer.MISSING_HEARTBLEEDS_ACCEPTED:
-                conn_manager.heartbleed_status[i] += 1
+        for sock in self.heartbleed_wheel.expire(now):
+            if sock in self.clients.sockets:
+                conn_manager = self.clients
+            elif sock in self.servers.sockets:
+                conn_manager = self.servers
+            elif sock in self.candidate_servers:
+                # Didn't answer with MY_ADDR in time
+                dead_sockets.append(sock)
+                continue
+            elif sock in self.admin_requests:
+                # Didn't send its request in time
+                self.close_admin(sock)
+                continue
             else:
-                dead_sockets.append(conn_manager.sockets[i])
-
-        for sock in dead_sockets:
-            if conn_manager.type == ConnectionManager.TYPE_CLIENT:
-                self.close_client(sock)
-            elif conn_manager.type == ConnectionManager.TYPE_SERVER:
-                self.close_server(sock)
-
-    def send_heartbleed_requests(self, conn_manager):
-        dead_sockets = []
-        for sock in conn_manager.sockets:
+                continue
+            if not self.check_heartbleed_response(conn_manager.get_connection(sock)):
+                dead_sockets.append(sock)
+                continue
             try:
-                sock.sendall("HEART\n".encode())
+                self.send(sock, "HEART\n".encode())
             except socket.error:
                 dead_sockets.append(sock)
+                continue
+            self.heartbleed_wheel.schedule(sock, now + MChatServer.HEARTBLEED_INTERVAL)
 
-        for dead_sock in dead_sockets:
-            if conn_manager.type == ConnectionManager.TYPE_CLIENT:
-                self.close_client(dead_sock)
-            elif conn_manager.type == ConnectionManager.TYPE_SERVER:
-                self.close_server(dead_sock)
-
-    # Return connected socket or None if unsuccessful
-    def connect(self, ip, port):
-		# prevent connections to own ip and server ports
-        if ip == self.ip and (port == self.client_listen_port or port == self.server_listen_port):
-            return None
-        sock = None
-
+        for sock in dead_sockets:
+            self.close_socket(sock)
+
+    # Check if the previous HEART message was answered. Returns False if too many have been missed in a row.
+    def check_heartbleed_response(self, connection):
+        if connection.heartbleed_status < 0:
+            connection.heartbleed_status = 0
+        elif connection.heartbleed_status < MChatServer.MISSING_HEARTBLEEDS_ACCEPTED:
+            connection.heartbleed_status += 1
+            self.heartbleeds_missed.inc()
+        else:
+            self.heartbleed_timeouts.inc()
+            return False
+        return True
+
+    def is_own_address(self, ip, port):
+        return ip == self.ip and (port == self.client_listen_port or port == self.server_listen_port)
+
+    # Start connecting to all not_connected_servers, and to the servers whose retry delay has passed. The connects
+    # proceed in the background: the host name is resolved by a resolver thread, and the connect itself is
+    # finished in finish_connect() when the socket becomes writable.
+    def connect_to_new_servers(self):
+        for server_addr in self.not_connected_servers:
+            self.start_connect(server_addr, 0)
+        self.not_connected_servers = {}
+
+        if self.connect_retries:
+            now = time.monotonic()
+            for server_addr, (attempt, retry_time) in list(self.connect_retries.items()):
+                if retry_time <= now:
+                    del self.connect_retries[server_addr]
+                    self.start_connect(server_addr, attempt)
+
+    def start_connect(self, server_addr, attempt):
+        # prevent connections to own ip and server ports, and to the servers that are connected or being connected
+        if self.is_own_address(server_addr[0], server_addr[1]):
+            return
+        if server_addr in self.connect_attempts or self.servers.has_listen_addr(server_addr):
+            return
+        connect_attempt = ConnectAttempt(server_addr, attempt)
+        self.connect_attempts[server_addr] = connect_attempt
+        future = self.resolver.submit(socket.getaddrinfo, server_addr[0], server_addr[1],
+                                      socket.AF_UNSPEC, socket.SOCK_STREAM)
+        future.add_done_callback(lambda future: self.resolve_done(connect_attempt, future))
+
+    # Called in a resolver thread. The result is handled in the main loop by read_wakeup().
+    def resolve_done(self, connect_attempt, future):
+        self.resolved.append((connect_attempt, future))
         try:
-            addrinfo = socket.getaddrinfo(ip, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
-        except socket.error:
-            return None
+            self.wakeup_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass  # the main loop will wake up anyway, there's unread data already
 
-        for result in addrinfo:
-            family, socktype, proto, _, addr = result
+    def read_wakeup(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        if self.profile_requested:
+            self.profile_requested = False
+            self.handle_profile_signal()
+        while self.resolved:
+            connect_attempt, future = self.resolved.popleft()
             try:
-                sock = socket.socket(family, socktype, proto)
-            except socket.error:
-                sock = None
+                connect_attempt.addrinfo = future.result()
+            except socket.error as e:
+                self.connect_failed(connect_attempt, e)
                 continue
+            self.connect_next_address(connect_attempt)
+
+    # Start a non-blocking connect to the next resolved address of the server
+    def connect_next_address(self, connect_attempt):
+        error = None
+        while connect_attempt.addrinfo:
+            family, socktype, proto, _, addr = connect_attempt.addrinfo.pop(0)
             try:
-                sock.connect(addr)
+                sock = socket.socket(family, socktype, proto)
             except socket.error as e:
-                log_message = "Failed to connect {}:{} due to {}".format(addr[0], addr[1], e)
-                print(log_message)
-                self.logger.error(log_message)
+                error = e
+                continue
+            sock.setblocking(False)
+            self.set_nodelay(sock)
+            result = sock.connect_ex(addr)
+            if result != 0 and result != errno.EINPROGRESS:
+                error = socket.error(result, os.strerror(result))
                 sock.close()
-                sock = None
                 continue
-            break
-        return sock
+            connect_attempt.sock = sock
+            connect_attempt.deadline = time.monotonic() + MChatServer.CONNECT_TIMEOUT
+            self.connecting[sock] = connect_attempt
+            self.selector.register(sock, selectors.EVENT_WRITE)
+            return
+        self.connect_failed(connect_attempt, error)
+
+    # The connecting socket became writable, the connect has either succeeded or failed
+    def finish_connect(self, sock):
+        connect_attempt = self.connecting.pop(sock)
+        self.selector.unregister(sock)
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            self.log_connect_error(connect_attempt.server_addr, socket.error(error, os.strerror(error)))
+            sock.close()
+            self.connect_next_address(connect_attempt)
+            return
+        del self.connect_attempts[connect_attempt.server_addr]
+        self.add_connected_server(sock, connect_attempt.server_addr)
 
-    def connect_to_new_servers(self):
-        for server_addr in self.not_connected_servers:
-            server_sock = self.connect(server_addr[0], server_addr[1])
-            if server_sock == None:
-                continue
-            try:
-                self.servers.add(server_sock, listen_addr=server_addr)
-            # This server is already connected to maximum amount of other servers.
-            except ConnectionAddError:
-                server_sock.close()
-                continue
-        self.not_connected_servers = []
+    def check_connect_timeouts(self):
+        if not self.connecting:
+            return
+        now = time.monotonic()
+        for sock, connect_attempt in list(self.connecting.items()):
+            if connect_attempt.deadline <= now:
+                del self.connecting[sock]
+                self.selector.unregister(sock)
+                sock.close()
+                self.log_connect_error(connect_attempt.server_addr, socket.timeout("timed out"))
+                self.connect_next_address(connect_attempt)
+
+    # All the addresses of the server failed. Try again later, unless this is the overlay, where
+    # maintain_overlay() moves on to the next server instead.
+    def connect_failed(self, connect_attempt, error):
+        server_addr = connect_attempt.server_addr
+        del self.connect_attempts[server_addr]
+        if error is not None:
+            self.log_connect_error(server_addr, error)
+        attempt = connect_attempt.attempt + 1
+        if self.overlay:
+            return
+        if attempt >= MChatServer.CONNECT_MAX_ATTEMPTS:
+            self.known_servers.discard(server_addr)
+            return
+        delay = min(MChatServer.CONNECT_RETRY_DELAY * 2 ** (attempt - 1), MChatServer.CONNECT_RETRY_MAX_DELAY)
+        # Servers that lost each other at the same moment should not all retry at the same moment
+        delay *= random.uniform(0.5, 1)
+        self.connect_retries[server_addr] = (attempt, time.monotonic() + delay)
+
+    def log_connect_error(self, server_addr, error):
+        log_message = "Failed to connect {}:{} due to {}".format(server_addr[0], server_addr[1], error)
+        self.logger.error(log_message)
+
+    # The connect to the server has succeeded, start handling it as a server connection
+    def add_connected_server(self, server_sock, server_addr):
+        if not self.keep_new_server_link(server_addr, (self.ip, self.server_listen_port)):
+            server_sock.close()
+            return
+        try:
+            self.servers.add(server_sock, listen_addr=server_addr)
+            self.known_servers.add(server_addr)
+        # This server is already connected to maximum amount of other servers.
+        except ConnectionAddError:
+            server_sock.close()
+            return
+        self.add_connection(server_sock, self.read_server, self.close_server, self.server_metrics,
+                            MChatServer.SERVER_SEND_QUEUE_MAXLEN, MChatServer.SERVER_SLOW_CONSUMER_POLICY)
+        self.connections[server_sock].recv_buffer.keep_newline = True
+        self.start_heartbleeds(server_sock)
+        self.interest_unknown.add(server_sock)
+        self.set_overlay_parent(server_sock)
+
+    # In overlay mode the only server connection we open ourselves is to our parent. When we don't have one
+    # (the parent was lost, it was full, or connecting failed), try the next server we have heard of.
+    def maintain_overlay(self):
+        if not self.overlay or self.overlay_root or self.overlay_parent is not None or not self.known_servers:
+            return
+        # Connecting to the seed server given on the command line, or the previous attempt, is still pending
+        if self.not_connected_servers or self.connect_attempts:
+            return
+        if self.overlay_retry_timer.running and not self.overlay_retry_timer.has_expired():
+            return
+        self.overlay_retry_timer.start()
+        known_addrs = self.known_servers.get_addrs()
+        for i in range(len(known_addrs)):
+            server_addr = known_addrs[self.overlay_next % len(known_addrs)]
+            self.overlay_next += 1
+            if not self.servers.has_listen_addr(server_addr) and server_addr not in self.overlay_children:
+                self.not_connected_servers[server_addr] = None
+                return
+
+    def set_overlay_parent(self, sock):
+        if not self.overlay:
+            return
+        self.overlay_parent = sock
+        self.overlay_retry_timer.reset()
+        # If the parent is lost, continue from the server after it
+        listen_addr = self.servers.get_socket_listen_addr(sock)
+        if listen_addr in self.known_servers:
+            self.overlay_next = self.known_servers.get_addrs().index(listen_addr) + 1
+
+    # The parent told its path to the root. If we are on the path, the parent is in our own subtree: drop the link
+    # and look for another parent after OVERLAY_RETRY_INTERVAL.
+    def handle_overlay_path(self, sock, path):
+        if sock is not self.overlay_parent or not path:
+            return
+        if self.relay_origin in path:
+            listen_addr = self.servers.get_socket_listen_addr(sock)
+            log_message = "Link to {}:{} closed a loop in the overlay, closing it".format(listen_addr[0], listen_addr[1])
+            self.logger.warning(log_message)
+            self.close_server(sock)
+            self.overlay_retry_timer.start()
+            return
+        self.set_overlay_path(path + [self.relay_origin])
+
+    # Our path to the root changed, tell it to the children
+    def set_overlay_path(self, path):
+        if path == self.overlay_path:
+            return
+        self.overlay_path = path
+        for sock in list(self.servers.sockets):
+            if sock is not self.overlay_parent:
+                self.send_overlay_path(sock)
+
+    def send_overlay_path(self, sock):
+        try:
+            self.send(sock, ("OVERLAY_PATH " + " ".join(self.overlay_path) + "\n").encode())
+        except socket.error:
+            self.close_server(sock)
+
+    # Tell the linked servers how loaded we are, once per LOAD_REPORT_INTERVAL. In worker mode the other workers
+    # report their load to the gateway, which reports the load of the whole host.
+    def report_load(self):
+        now = time.monotonic()
+        elapsed = now - self.last_load_report
+        if elapsed < MChatServer.LOAD_REPORT_INTERVAL:
+            return
+        messages = self.client_metrics.messages_received.value
+        msg_rate = (messages - self.load_report_messages) / elapsed
+        self.load_report_messages = messages
+        self.last_load_report = now
+        if not self.gateway:
+            self.broadcast_workers("WORKER_LOAD {} {:.1f}\n".format(len(self.clients), msg_rate).encode())
+            return
+        if not self.servers.sockets:
+            return
+        msg_rate += sum(rate for clients, rate in self.worker_load.values())
+        load_message = "LOAD {} {} {} {:.1f} {:.1f}\n".format(self.ip, self.client_listen_port, self.count_clients(),
+                                                              msg_rate, self.loop_latency * 1000)
+        self.broadcast_servers(load_message.encode())
+
+    # Returns the number of clients connected to this host, in worker mode the clients of every worker as the
+    # gateway knows them
+    def count_clients(self):
+        return len(self.clients) + sum(clients for clients, rate in self.worker_load.values())
+
+    def update_loop_latency(self, latency):
+        self.loop_time.observe(latency)
+        self.loop_latency += (latency - self.loop_latency) * MChatServer.LOOP_LATENCY_WEIGHT
+
+    # Returns the LoadReport of the least loaded linked server, or None if there are no recent reports. Servers
+    # with fewer clients are less loaded, and of those with as many clients, the one with the shorter loop latency.
+    def get_least_loaded_server(self):
+        oldest = time.monotonic() - MChatServer.LOAD_REPORT_MAX_AGE
+        reports = [report for report in self.peer_load.values() if report.time >= oldest]
+        if not reports:
+            return None
+        return min(reports, key=lambda report: (report.connections, report.loop_latency))
+
+    # Send REDIRECT <ip> <port> to a new client if another server has clearly fewer clients than we have. The
+    # client should reconnect to that server, until then it's handled here as usual.
+    def redirect_client(self, sock):
+        report = self.get_least_loaded_server()
+        if report is None or self.count_clients() - report.connections < MChatServer.REDIRECT_THRESHOLD:
+            return
+        # Count the client there already, so that the next new clients are not all sent to the same server
+        report.connections += 1
+        try:
+            self.send(sock, "REDIRECT {} {}\n".format(report.client_addr[0], report.client_addr[1]).encode())
+        except socket.error:
+            self.close_client(sock)
+
+    # Write known_servers to the address cache if they have changed, at most once per ADDRESS_CACHE_SAVE_INTERVAL
+    # unless force is True
+    def save_known_servers(self, force=False):
+        if not self.known_servers.changed:
+            return
+        if not force and self.address_cache_timer.running and not self.address_cache_timer.has_expired():
+            return
+        self.address_cache_timer.start()
+        try:
+            self.known_servers.save()
+        except OSError as e:
+            log_message = "Failed to save the address cache {} due to {}".format(self.known_servers.path, e)
+            self.logger.error(log_message)
+
+    # The metrics served to the admin port. Counters and histograms are updated where the events happen, gauges
+    # are only computed when the metrics are read.
+    def create_metrics(self):
+        self.client_metrics = ConnectionMetrics(self.metrics, "client")
+        self.server_metrics = ConnectionMetrics(self.metrics, "server")  # candidate servers too
+        self.worker_metrics = ConnectionMetrics(self.metrics, "worker")
+        self.admin_metrics = ConnectionMetrics(self.metrics, "admin")
+        for conn_type, connections in (("client", self.clients), ("server", self.servers), ("worker", self.workers),
+                                       ("candidate_server", self.candidate_servers)):
+            self.metrics.gauge("mchat_connections", "Open connections", connections.__len__, {"type": conn_type})
+        self.metrics.gauge("mchat_channels", "Channels with members on this server", lambda: len(self.channels.channels))
+        self.metrics.gauge("mchat_known_servers", "Servers in the address book", self.known_servers.__len__)
+        self.metrics.gauge("mchat_send_queue_bytes", "Bytes waiting to be sent to all connections",
+                           lambda: sum(connection.send_queue.size for connection in self.connections.values()))
+        self.metrics.gauge("mchat_loop_latency_seconds", "Moving average of the loop latency", lambda: self.loop_latency)
+        # The asyncio engine measures how late its periodic task runs instead
+        self.loop_time = self.metrics.histogram("mchat_loop_seconds", "Time to handle one round of events",
+                                                MChatServer.LOOP_TIME_BUCKETS)
+        self.broadcast_receivers = self.metrics.histogram("mchat_broadcast_receivers", "Receivers of each broadcast",
+                                                          MChatServer.FANOUT_BUCKETS)
+        self.heartbleeds_missed = self.metrics.counter("mchat_heartbleeds_missed_total",
+                                                       "HEART messages that were not answered in time")
+        self.heartbleed_timeouts = self.metrics.counter("mchat_heartbleed_timeouts_total",
+                                                        "Connections closed because they stopped answering HEART")
+
+    # New connection to the admin port. It is read and written without blocking like the other connections, and
+    # closed once the answer has been sent (see flush), or when ADMIN_TIMEOUT has passed.
+    def accept_admin(self, listen_sock):
+        accepted = self.accept(listen_sock)
+        if accepted is None:
+            return
+        sock = accepted[0]
+        sock.setblocking(False)
+        self.admin_requests[sock] = b""
+        self.add_connection(sock, self.read_admin, self.close_admin, self.admin_metrics,
+                            MChatServer.ADMIN_SEND_QUEUE_MAXLEN, SendQueue.POLICY_DISCONNECT)
+        self.heartbleed_wheel.schedule(sock, time.monotonic() + MChatServer.ADMIN_TIMEOUT)
+
+    def read_admin(self, sock):
+        try:
+            data = sock.recv(MChatServer.ADMIN_REQUEST_MAXLEN)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            self.close_admin(sock)
+            return
+        self.admin_metrics.bytes_received.inc(len(data))
+        request = self.admin_requests[sock]
+        if request is None:
+            # The answer is still being sent. Anything more from the scraper is ignored.
+            if not data:
+                self.close_admin(sock)
+            return
+        request += data
+        if data and b"\r\n\r\n" not in request and len(request) < MChatServer.ADMIN_REQUEST_MAXLEN:
+            self.admin_requests[sock] = request
+            return
+        self.admin_requests[sock] = None
+        self.admin_metrics.messages_received.inc()
+        try:
+            self.send(sock, self.create_admin_response(request))
+        except socket.error:
+            self.close_admin(sock)
+
+    def close_admin(self, sock):
+        if sock not in self.admin_requests:
+            return
+        del self.admin_requests[sock]
+        self.close_connection(sock)
+
+    # Returns the HTTP answer to an admin request. GET / and GET /metrics return the metrics, POST /profile
+    # starts the profiler.
+    def create_admin_response(self, request):
+        request_line = request.split(b"\r\n", 1)[0].decode("latin-1").split()
+        url = urlsplit(request_line[1]) if len(request_line) >= 2 else None
+        if url is None:
+            status, body = "400 Bad Request", "Bad request\n"
+        elif url.path in ("/", "/metrics"):
+            if request_line[0] == "GET":
+                status, body = "200 OK", self.metrics.render()
+            else:
+                status, body = "405 Method Not Allowed", "Use GET\n"
+        elif url.path == "/profile":
+            if request_line[0] == "POST":
+                status, body = self.handle_profile_request(parse_qs(url.query))
+            else:
+                status, body = "405 Method Not Allowed", "Use POST\n"
+        else:
+            status, body = "404 Not Found", "Not found\n"
+        body = body.encode()
+        header = "HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {}\r\n\r\n"
+        return header.format(status, len(body)).encode() + body
+
+    # Returns the HTTP status and body of the answer to POST /profile?seconds=<n>
+    def handle_profile_request(self, query):
+        try:
+            duration = float(query.get("seconds", [MChatServer.PROFILE_DEFAULT_DURATION])[0])
+        except ValueError:
+            return "400 Bad Request", "seconds must be a number\n"
+        if not 0 < duration <= MChatServer.PROFILE_MAX_DURATION:
+            return "400 Bad Request", "seconds must be more than 0 and at most {}\n".format(MChatServer.PROFILE_MAX_DURATION)
+        path = self.start_profiler(duration)
+        if path is None:
+            return "409 Conflict", "The profiler is already running\n"
+        return "202 Accepted", path + "\n"
+
+    # Sample the stack of the main loop for duration seconds. The stacks are written next to the log file in the
+    # collapsed stack format that flamegraph.pl and speedscope read. Must be called from the main thread. Returns
+    # the path of the file, or None if the profiler is already running.
+    def start_profiler(self, duration):
+        path = "{}_profile_{}.folded".format(os.path.splitext(self.log_file)[0], time.strftime("%Y%m%d-%H%M%S"))
+        if not self.profiler.start(threading.get_ident(), duration, path, self.profiler_done):
+            return None
+        log_message = "Profiling for {} seconds to {}".format(duration, path)
+        self.logger.info(log_message)
+        return path
+
+    # Called from the profiler thread when the profile has been written
+    def profiler_done(self, path, samples, error):
+        if error is not None:
+            log_message = "Failed to write the profile {} due to {}".format(path, error)
+            self.logger.error(log_message)
+            return
+        log_message = "Wrote {} samples to the profile {}".format(samples, path)
+        self.logger.info(log_message)
+
+    # Open the client listen socket, and the server listen socket unless this is a worker other than the gateway.
+    # Exits if this fails.
+    def create_listen_sockets(self):
+        # Workers share the client port
+        reuse_port = self.worker_id is not None
+        self.client_listen_socket = self.create_listen_socket(self.ip, self.client_listen_port, reuse_port)
+        if self.gateway:
+            self.server_listen_socket = self.create_listen_socket(self.ip, self.server_listen_port)
+        if self.client_listen_socket == None or (self.gateway and self.server_listen_socket == None):
+            sys.exit("Failed to open listen sockets to given hostname and port combination.")
+        if self.admin_port is not None:
+            self.admin_listen_socket = self.create_listen_socket(MChatServer.ADMIN_IP, self.admin_port)
+            if self.admin_listen_socket == None:
+                sys.exit("Failed to open the admin listen socket to port {}.".format(self.admin_port))
 
     # Return created listen socket or None if unsuccessful
-    def create_listen_socket(self, ip, port):
+    def create_listen_socket(self, ip, port, reuse_port=False):
         sock = None
 
         try:
@@ -503,12 +1711,13 @@ class MChatServer(Daemon):
                 sock = None
                 continue
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             try:
                 sock.bind(addr)
                 sock.listen(128)  # parameter value = maximum number of queued connections
             except socket.error as e:
                 log_message = "Failed to bind listen socket to address {}:{} due to {}".format(addr[0], addr[1], e)
-                print(log_message)
                 self.logger.error(log_message)
                 sock.close()
                 sock = None
@@ -519,17 +1728,57 @@ class MChatServer(Daemon):
     def sigterm_handler(self, _signo, _stack_frame):
         raise SystemExit
 
+    # The handler may interrupt the main loop anywhere, even inside a log call that holds the lock of the log
+    # queue, so it must not log or start anything itself. It only wakes up the loop, and read_wakeup() calls
+    # handle_profile_signal().
+    def sigusr1_handler(self, _signo, _stack_frame):
+        self.profile_requested = True
+        try:
+            self.wakeup_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            pass  # the main loop will wake up anyway, there's unread data already
+
+    def handle_profile_signal(self):
+        if self.start_profiler(MChatServer.PROFILE_DEFAULT_DURATION) is None:
+            self.logger.warning("SIGUSR1 ignored, the profiler is already running")
+
+    # The logger only puts the records on a queue. The file and console handlers are run by log_listener in its
+    # own thread, which is started by run(), after the daemon and the worker processes have been forked.
     def logger_setup(self):
         log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s')
         log_file = self.ip + "_" + str(self.client_listen_port) + "_" + "server.log"
+        if self.worker_id is not None:
+            log_file = self.ip + "_" + str(self.client_listen_port) + "_" + "worker" + str(self.worker_id) + "_server.log"
+        self.log_file = os.path.abspath(log_file)  # the daemon changes its working directory later
         my_handler = RotatingFileHandler(log_file, mode='a', maxBytes=5*1024*1024, backupCount=1, encoding=None, delay=0)
         my_handler.setFormatter(log_formatter)
         my_handler.setLevel(logging.INFO)
+        handlers = [my_handler]
+        if self.console_log:
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(logging.Formatter('%(message)s'))
+            console_handler.setLevel(logging.INFO)
+            handlers.append(console_handler)
+        queue_handler = DroppingQueueHandler(MChatServer.LOG_QUEUE_MAXLEN, self.metrics.counter(
+            "mchat_log_records_dropped_total", "Log records dropped because the log writer couldn't keep up"))
+        queue_handler.addFilter(RateLimitFilter(MChatServer.LOG_RATE, MChatServer.LOG_BURST, self.metrics.counter(
+            "mchat_log_records_suppressed_total", "Log records suppressed by the rate limit")))
+        self.log_listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
         app_log = logging.getLogger("Rotating Logger")
         app_log.setLevel(logging.INFO)
-        app_log.addHandler(my_handler)
+        self.replace_queue_handler(app_log, queue_handler)
+        # The event loop of the asyncio engine logs its own errors, e.g. failed accepts, keep them off the loop too
+        self.replace_queue_handler(logging.getLogger("asyncio"), queue_handler)
         return app_log
 
+    # The loggers are shared by the whole process, and a process may create several servers (e.g. microbench.py).
+    # Only the queue of the latest one is attached, so that each record is emitted once.
+    def replace_queue_handler(self, logger, queue_handler):
+        for handler in list(logger.handlers):
+            if isinstance(handler, DroppingQueueHandler):
+                logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+
     # parameter message is a string, not bytes
     def send_system_message(self, channel, message):
         system_message = "SYSTEM " + channel + " " + message + "\n"
@@ -537,7 +1786,212 @@ class MChatServer(Daemon):
             raise InvalidProtocolMessageError("Tried to send invalid system message")
         byte_system_message = system_message.encode()
         self.broadcast_channel(byte_system_message, channel)
-        self.broadcast_servers(byte_system_message)
+        self.broadcast_peers(byte_system_message, [channel], frame=self.create_frame(system_message[:-1]))
+
+    # Binary frame of a valid MSG or SYSTEM message (a string without the newline), or None if the server doesn't
+    # use binary links
+    def create_frame(self, message):
+        if "BINARY" not in self.link_caps:
+            return None
+        if message.startswith("MSG "):
+            protocol_msg = message.split(" ", 3)
+            return binaryframe.encode(binaryframe.TYPE_MSG, protocol_msg[3].encode(), protocol_msg[2].encode(),
+                                      protocol_msg[1].encode())
+        if message.startswith("SYSTEM "):
+            protocol_msg = message.split(" ", 2)
+            return binaryframe.encode(binaryframe.TYPE_SYSTEM, protocol_msg[2].encode(), protocol_msg[1].encode())
+        return None
+
+    # A client changed its nickname or disconnected. Every local client sharing a channel with it gets one SYSTEM
+    # message about it, and every other server and worker gets the event once:
+    #   PRESENCE NICK <old_nick> <new_nick> <channel> [<channel> ...]
+    #   PRESENCE QUIT <nick> <channel> [<channel> ...]
+    # The event is split into several messages if it doesn't fit in PROTOCOL_MSG_MAXLEN. Each of them only goes to
+    # the peers that want the channels in it, and the kind is followed by /<event ID> (e.g. QUIT/<ID>), so that
+    # the receivers can tell which messages belong to the same event.
+    def send_presence(self, kind, nick, new_nick, channels):
+        self.deliver_presence(kind, nick, new_nick, channels)
+        nicks = nick if kind != MChatServer.PRESENCE_NICK else nick + " " + new_nick
+        prefix = "PRESENCE " + kind + " " + nicks
+        groups = self.split_parts(prefix, channels)
+        if len(groups) > 1:
+            self.presence_seq += 1
+            prefix = "PRESENCE {}/{}:{} {}".format(kind, self.relay_origin, self.presence_seq, nicks)
+            groups = self.split_parts(prefix, channels)
+        for group in groups:
+            self.broadcast_peers(self.join_message(prefix, group), group)
+
+    # Returns (kind, nick, new_nick, channels, event ID or None) or None if message is not a valid PRESENCE message
+    def parse_presence(self, message):
+        protocol_msg = message.split(" ")
+        if len(protocol_msg) < 2:
+            return None
+        kind, _, event = protocol_msg[1].partition("/")
+        if len(protocol_msg) >= 5 and kind == MChatServer.PRESENCE_NICK:
+            nicks = protocol_msg[2:4]
+            channels = protocol_msg[4:]
+        elif len(protocol_msg) >= 4 and kind == MChatServer.PRESENCE_QUIT:
+            nicks = protocol_msg[2:3]
+            channels = protocol_msg[3:]
+        else:
+            return None
+        for nick in nicks:
+            if len(nick) > MChatServer.NICKNAME_MAXLEN:
+                return None
+        for channel in channels:
+            if len(channel) > MChatServer.CHANNELNAME_MAXLEN:
+                return None
+        new_nick = nicks[1] if len(nicks) == 2 else None
+        return (kind, nicks[0], new_nick, channels, event or None)
+
+    # Send the SYSTEM message about the presence event to the local members of the channels. A client on several
+    # of the channels only gets it once, on the first of them, and each channel's message is only built if
+    # someone gets it. The clients notified about a split event (one with an event ID) are remembered, so that
+    # its other messages don't notify them again.
+    def deliver_presence(self, kind, nick, new_nick, channels, event=None):
+        if kind == MChatServer.PRESENCE_NICK:
+            text = nick + " changed nickname to " + new_nick
+        else:
+            text = nick + " left channel"
+        if event is None:
+            notified = set()
+        else:
+            notified = self.presence_notified.get(event)
+            if notified is None:
+                notified = set()
+                self.presence_notified[event] = notified
+                if len(self.presence_notified) > MChatServer.PRESENCE_CACHE_SIZE:
+                    del self.presence_notified[next(iter(self.presence_notified))]
+        dead_sockets = []
+        for channel in channels:
+            system_message = None
+            for member in self.channels.get(channel):
+                if member in notified:
+                    continue
+                notified.add(member)
+                if system_message is None:
+                    system_message = ("SYSTEM " + channel + " " + text + "\n").encode()
+                try:
+                    self.send(member, system_message)
+                except socket.error:
+                    dead_sockets.append(member)
+
+        for dead_sock in dead_sockets:
+            self.close_socket(dead_sock)
+
+    # Split "<prefix> <part> <part> ..." into as many messages as needed to keep each of them shorter than
+    # PROTOCOL_MSG_MAXLEN. Returns a list of bytes objects.
+    def split_message(self, prefix, parts):
+        return [self.join_message(prefix, group) for group in self.split_parts(prefix, parts)]
+
+    # Returns parts divided into lists, each of which fits in one message of split_message
+    def split_parts(self, prefix, parts):
+        groups = []
+        group = []
+        length = len(prefix)
+        for part in parts:
+            length += 1 + len(part)
+            if length >= MChatServer.PROTOCOL_MSG_MAXLEN:
+                groups.append(group)
+                group = []
+                length = len(prefix) + 1 + len(part)
+            group.append(part)
+        groups.append(group)
+        return groups
+
+    # Returns "<prefix> <part> <part> ...\n" as bytes
+    def join_message(self, prefix, parts):
+        if not parts:
+            return (prefix + "\n").encode()
+        return (prefix + " " + " ".join(parts) + "\n").encode()
+
+    # Wrap message (bytes) into a RELAY message with a new ID for sending to the overlay
+    def create_relay_data(self, message):
+        self.relay_seq += 1
+        self.remember_relayed(self.relay_origin, str(self.relay_seq))
+        return ("RELAY " + self.relay_origin + " " + str(self.relay_seq) + " ").encode() + message
+
+    # Returns False if the message with the ID has been relayed already
+    def remember_relayed(self, origin, seq):
+        message_id = (origin, seq)
+        if message_id in self.relayed:
+            return False
+        self.relayed[message_id] = None
+        if len(self.relayed) > MChatServer.RELAY_CACHE_SIZE:
+            del self.relayed[next(iter(self.relayed))]
+        return True
+
+    # SUB <channel> [<channel> ...] and UNSUB <channel> [<channel> ...] from a server or a worker
+    def handle_interest_message(self, sock, message):
+        protocol_msg = message.split(" ")
+        channels = [channel for channel in protocol_msg[1:] if channel]
+        for channel in channels:
+            if len(channel) > MChatServer.CHANNELNAME_MAXLEN:
+                return
+        self.interest_unknown.discard(sock)
+        for channel in channels:
+            if protocol_msg[0] == "SUB":
+                try:
+                    changed = self.peer_interest.join(sock, channel)
+                except ChannelJoinError:
+                    self.logger.exception("Couldn't subscribe a peer to channel {}.".format(channel))
+                    continue
+            else:
+                changed = self.peer_interest.part(sock, channel)
+            if changed:
+                self.update_interest(channel)
+
+    # Returns True if we want messages of channel from link: a local client has joined the channel, or a
+    # message from link would be passed on to another link that wants it
+    def is_channel_wanted(self, link, channel):
+        if self.channels.member_count(channel):
+            return True
+        link_is_worker = link in self.workers.sockets
+        for peer in self.peer_interest.get(channel):
+            if peer is not link and (self.overlay or link_is_worker or peer in self.workers.sockets):
+                return True
+        return False
+
+    # Tell a newly connected server or worker every channel we want from it. Sent once per link, even if
+    # there are no channels, so the other end knows it can stop sending us everything.
+    def send_interest(self, sock):
+        if sock in self.advertised:
+            return
+        channel_names = dict.fromkeys(self.channels.get_channel_names())
+        channel_names.update(dict.fromkeys(self.peer_interest.get_channel_names()))
+        wanted = {channel: None for channel in channel_names if self.is_channel_wanted(sock, channel)}
+        self.advertised[sock] = wanted
+        for message in self.split_message("SUB", wanted):
+            self.send(sock, message)
+
+    # Channel got its first or lost its last member here or on another link. Send SUB or UNSUB to the links
+    # whose view of our interest in the channel changed.
+    def update_interest(self, channel):
+        dead_sockets = []
+        for link, advertised_channels in self.advertised.items():
+            wanted = self.is_channel_wanted(link, channel)
+            if wanted == (channel in advertised_channels):
+                continue
+            if wanted:
+                advertised_channels[channel] = None
+                message = "SUB " + channel + "\n"
+            else:
+                del advertised_channels[channel]
+                message = "UNSUB " + channel + "\n"
+            try:
+                self.send(link, message.encode())
+            except socket.error:
+                dead_sockets.append(link)
+
+        for dead_sock in dead_sockets:
+            self.close_socket(dead_sock)
+
+    # Server or worker link was closed
+    def forget_interest(self, sock):
+        self.interest_unknown.discard(sock)
+        self.advertised.pop(sock, None)
+        for channel in self.peer_interest.part_all(sock):
+            self.update_interest(channel)
 
 
 class InvalidProtocolMessageError(Exception):
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The server modules import each other by their plain names, like main.py does when it is run from src/server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
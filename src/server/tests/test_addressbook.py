@@ -0,0 +1,67 @@
+from addressbook import AddressBook
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "cache.txt")
+    book = AddressBook(path)
+    book.add(("10.0.0.1", 6062))
+    book.add(("server.example", 7000))
+    book.save()
+    loaded = AddressBook(path)
+    loaded.load()
+    assert loaded.get_addrs() == [("10.0.0.1", 6062), ("server.example", 7000)]
+    assert not loaded.changed
+
+
+def test_missing_file(tmp_path):
+    book = AddressBook(str(tmp_path / "missing.txt"))
+    book.load()
+    assert len(book) == 0
+
+
+def test_corrupt_lines_are_skipped(tmp_path):
+    path = tmp_path / "cache.txt"
+    path.write_text("10.0.0.1 6062\n"
+                    "garbage\n"
+                    "10.0.0.2 notaport\n"
+                    "10.0.0.3 6062 extra\n"
+                    "10.0.0.4 99999\n"
+                    "10.0.0.5 -1\n"
+                    "10.0.0.6 ²\n"
+                    "\n"
+                    "10.0.0.7 6063")
+    book = AddressBook(str(path))
+    book.load()
+    assert book.get_addrs() == [("10.0.0.1", 6062), ("10.0.0.7", 6063)]
+
+
+def test_binary_garbage(tmp_path):
+    path = tmp_path / "cache.txt"
+    path.write_bytes(b"\xff\xfe\x00\x81 junk\n10.0.0.1 6062\n\x9c\x00\x00\n")
+    book = AddressBook(str(path))
+    book.load()
+    assert book.get_addrs() == [("10.0.0.1", 6062)]
+
+
+def test_truncated_file(tmp_path):
+    path = tmp_path / "cache.txt"
+    path.write_text("10.0.0.1 6062\n10.0.0.2 60")
+    book = AddressBook(str(path))
+    book.load()
+    assert book.get_addrs() == [("10.0.0.1", 6062), ("10.0.0.2", 60)]
+
+
+def test_save_only_when_changed(tmp_path):
+    path = tmp_path / "cache.txt"
+    book = AddressBook(str(path))
+    book.save()
+    assert not path.exists()
+    book.add(("10.0.0.1", 6062))
+    book.save()
+    path.write_text("")
+    book.save()
+    assert path.read_text() == ""
+    book.discard(("10.0.0.1", 6062))
+    book.save()
+    assert path.read_text() == ""
+    assert not (tmp_path / "cache.txt.tmp").exists()
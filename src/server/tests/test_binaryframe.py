@@ -0,0 +1,53 @@
+import binaryframe
+
+
+def test_msg_round_trip():
+    frame = binaryframe.encode(binaryframe.TYPE_MSG, "hyvää päivää".encode(), b"#chan", b"nick")
+    assert binaryframe.frame_size(frame, 0) == len(frame)
+    assert binaryframe.decode(frame) == (binaryframe.TYPE_MSG, 0, b"#chan", b"nick", "hyvää päivää".encode())
+
+
+def test_flags_round_trip():
+    frame = binaryframe.encode(binaryframe.TYPE_BATCH, b"\x00\xff", flags=binaryframe.FLAG_COMPRESSED)
+    assert binaryframe.decode(frame) == (binaryframe.TYPE_BATCH, binaryframe.FLAG_COMPRESSED, b"", b"", b"\x00\xff")
+
+
+def test_text_frame_drops_the_newline():
+    frame = binaryframe.encode_text(b"HEART\n")
+    assert binaryframe.decode(frame) == (binaryframe.TYPE_TEXT, 0, b"", b"", b"HEART")
+
+
+def test_empty_payload():
+    frame = binaryframe.encode(binaryframe.TYPE_SYSTEM, b"", b"#c")
+    assert len(frame) == binaryframe.HEADER.size + 2
+    assert binaryframe.decode(frame) == (binaryframe.TYPE_SYSTEM, 0, b"#c", b"", b"")
+
+
+def test_frame_size_needs_the_whole_header():
+    frame = binaryframe.encode(binaryframe.TYPE_MSG, b"text", b"#c", b"n")
+    for length in range(binaryframe.HEADER.size):
+        assert binaryframe.frame_size(frame[:length], 0) is None
+    assert binaryframe.frame_size(frame[:binaryframe.HEADER.size], 0) == len(frame)
+
+
+def test_frame_size_at_an_offset():
+    first = binaryframe.encode_text(b"first\n")
+    second = binaryframe.encode(binaryframe.TYPE_MSG, b"text", b"#c", b"n")
+    data = bytearray(first + second)
+    assert binaryframe.frame_size(data, len(first)) == len(second)
+    assert binaryframe.frame_size(data, len(data) - 1) is None
+
+
+def test_split():
+    frames = [binaryframe.encode_text(b"one\n"), binaryframe.encode(binaryframe.TYPE_MSG, b"two", b"#c", b"n"),
+              binaryframe.encode(binaryframe.TYPE_SYSTEM, b"three", b"#c")]
+    assert binaryframe.split(b"".join(frames)) == frames
+    assert binaryframe.split(b"") == []
+
+
+def test_split_truncated():
+    data = binaryframe.encode_text(b"one\n") + binaryframe.encode(binaryframe.TYPE_MSG, b"two", b"#c", b"n")
+    for length in range(1, len(data)):
+        if length == len(binaryframe.encode_text(b"one\n")):
+            continue
+        assert binaryframe.split(data[:length]) is None
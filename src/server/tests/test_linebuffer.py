@@ -0,0 +1,102 @@
+import socket
+import pytest
+from linebuffer import LineBuffer
+
+
+@pytest.fixture
+def pair():
+    reader, writer = socket.socketpair()
+    yield reader, writer
+    reader.close()
+    writer.close()
+
+
+def receive(buffer, reader, writer, data):
+    writer.sendall(data)
+    buffer.recv(reader)
+
+
+def test_partial_line_waits_for_newline(pair):
+    reader, writer = pair
+    buffer = LineBuffer(100)
+    receive(buffer, reader, writer, b"hel")
+    assert buffer.next_line() is None
+    receive(buffer, reader, writer, b"lo\nwor")
+    assert buffer.next_line() == b"hello"
+    assert buffer.next_line() is None
+    receive(buffer, reader, writer, b"ld\n")
+    assert buffer.next_line() == b"world"
+    assert buffer.next_line() is None
+
+
+def test_several_lines_in_one_recv(pair):
+    reader, writer = pair
+    buffer = LineBuffer(100)
+    receive(buffer, reader, writer, b"a\nbb\n\nccc\n")
+    assert [buffer.next_line() for i in range(5)] == [b"a", b"bb", b"", b"ccc", None]
+
+
+def test_keep_newline(pair):
+    reader, writer = pair
+    buffer = LineBuffer(100)
+    buffer.keep_newline = True
+    receive(buffer, reader, writer, b"a\nbb\n")
+    assert buffer.next_line() == b"a\n"
+    assert buffer.next_line() == b"bb\n"
+
+
+# A line longer than max_line_len is handed out in max_line_len pieces, the last one ends at the newline
+def test_line_over_max_length_is_cut(pair):
+    reader, writer = pair
+    buffer = LineBuffer(8)
+    receive(buffer, reader, writer, b"abcdefghijklmnopqrs\nok\n")
+    assert buffer.next_line() == b"abcdefgh"
+    assert buffer.next_line() == b"ijklmnop"
+    assert buffer.next_line() == b"qrs"
+    assert buffer.next_line() == b"ok"
+    assert buffer.next_line() is None
+
+
+def test_line_of_max_length_without_newline_is_handed_out(pair):
+    reader, writer = pair
+    buffer = LineBuffer(4)
+    receive(buffer, reader, writer, b"abc")
+    assert buffer.next_line() is None
+    receive(buffer, reader, writer, b"d")
+    assert buffer.next_line() == b"abcd"
+
+
+def test_handled_lines_are_dropped_from_the_buffer(pair):
+    reader, writer = pair
+    buffer = LineBuffer(100)
+    receive(buffer, reader, writer, b"first\nsec")
+    assert buffer.next_line() == b"first"
+    receive(buffer, reader, writer, b"ond\n")
+    assert bytes(buffer.data) == b"second\n"
+
+
+def test_block(pair):
+    reader, writer = pair
+    buffer = LineBuffer(100)
+    receive(buffer, reader, writer, b"BATCH 6\nab\nc")
+    assert buffer.next_line() == b"BATCH 6"
+    buffer.expect_block(6)
+    assert buffer.next_line() is None
+    receive(buffer, reader, writer, b"d\nnext\n")
+    assert buffer.next_line() == b"ab\ncd\n"
+    assert buffer.next_line() == b"next"
+
+
+def test_recv_without_data_returns(pair):
+    reader, writer = pair
+    buffer = LineBuffer(100)
+    buffer.recv(reader)
+    assert buffer.next_line() is None
+
+
+def test_closed_connection_raises(pair):
+    reader, writer = pair
+    buffer = LineBuffer(100)
+    writer.close()
+    with pytest.raises(socket.error):
+        buffer.recv(reader)
@@ -0,0 +1,132 @@
+import zlib
+import pytest
+import binaryframe
+from linkbatcher import LinkBatcher
+from sendqueue import SendQueueFullError
+
+
+def lines(count):
+    return [b"MSG nick #chan message number %d\n" % i for i in range(count)]
+
+
+def test_text_batch():
+    batcher = LinkBatcher(False, False, 1024 * 1024)
+    for line in lines(3):
+        assert not batcher.add(line)
+    batcher.seal()
+    payload = b"".join(lines(3))
+    assert batcher.take_sendable() == ["BATCH {}\n".format(len(payload)).encode() + payload]
+
+
+def test_seal_without_frames():
+    batcher = LinkBatcher(True, False, 1024 * 1024)
+    batcher.seal()
+    assert batcher.take_sendable() == []
+
+
+def test_add_returns_true_when_the_batch_is_full():
+    batcher = LinkBatcher(False, False, 1024 * 1024)
+    assert not batcher.add(b"x" * (LinkBatcher.MAX_BATCH_SIZE - 1))
+    assert batcher.add(b"\n")
+
+
+def test_small_batch_is_not_compressed():
+    batcher = LinkBatcher(True, False, 1024 * 1024)
+    batcher.add(b"HEART\n")
+    batcher.seal()
+    assert batcher.take_sendable() == [b"BATCH 6\nHEART\n"]
+
+
+def test_compressed_text_round_trip():
+    sender = LinkBatcher(True, False, 1024 * 1024)
+    for line in lines(100):
+        sender.add(line)
+    sender.seal()
+    [batch] = sender.take_sendable()
+    header, _, block = batch.partition(b"\n")
+    assert header == "BATCH {} Z".format(len(block)).encode()
+
+    receiver = LinkBatcher(True, False, 1024 * 1024)
+    receiver.block_compressed = True
+    assert receiver.unpack(block) == b"".join(lines(100))
+    assert receiver.consumed == len(block)
+
+
+def test_compressed_binary_round_trip():
+    frames = [binaryframe.encode(binaryframe.TYPE_MSG, b"message %d" % i, b"#chan", b"nick") for i in range(100)]
+    sender = LinkBatcher(True, True, 1024 * 1024)
+    for frame in frames:
+        sender.add(frame)
+    sender.seal()
+    [batch] = sender.take_sendable()
+    frame_type, flags, _, _, block = binaryframe.decode(batch)
+    assert frame_type == binaryframe.TYPE_BATCH
+    assert flags == binaryframe.FLAG_COMPRESSED
+
+    receiver = LinkBatcher(True, True, 1024 * 1024)
+    receiver.block_compressed = True
+    assert binaryframe.split(receiver.unpack(block)) == frames
+
+
+def test_truncated_compressed_batch():
+    sender = LinkBatcher(True, False, 1024 * 1024)
+    for line in lines(100):
+        sender.add(line)
+    sender.seal()
+    block = sender.take_sendable()[0].partition(b"\n")[2]
+    receiver = LinkBatcher(True, False, 1024 * 1024)
+    for length in (0, 1, len(block) // 2, len(block) - 1):
+        receiver.block_compressed = True
+        assert receiver.unpack(block[:length]) is None
+
+
+def test_corrupt_compressed_batch():
+    receiver = LinkBatcher(True, False, 1024 * 1024)
+    receiver.block_compressed = True
+    assert receiver.unpack(b"not zlib data") is None
+
+
+def test_compressed_batch_over_max_block_size():
+    receiver = LinkBatcher(True, False, 1024 * 1024)
+    receiver.block_compressed = True
+    assert receiver.unpack(zlib.compress(b"x" * (LinkBatcher.MAX_BLOCK_SIZE + 1))) is None
+
+
+def test_batches_wait_for_credit():
+    batcher = LinkBatcher(False, False, 4 * LinkBatcher.CREDIT)
+    frame = b"x" * (LinkBatcher.MAX_BATCH_SIZE - 1) + b"\n"
+    batch_count = LinkBatcher.CREDIT // len(frame) + 2
+    for i in range(batch_count):
+        batcher.add(frame)
+        batcher.seal()
+    sendable = batcher.take_sendable()
+    assert len(sendable) == LinkBatcher.CREDIT // len(frame)
+    assert batcher.take_sendable() == []
+    batcher.add_credit(2 * len(frame))
+    assert len(batcher.take_sendable()) == 2
+    assert batcher.backlog == 0
+
+
+def test_credit_is_capped():
+    batcher = LinkBatcher(False, False, 1024 * 1024)
+    batcher.add_credit(100)
+    assert batcher.credit == LinkBatcher.CREDIT
+
+
+def test_backlog_over_the_limit():
+    batcher = LinkBatcher(False, False, 1000)
+    batcher.credit = 0
+    batcher.add(b"x" * 600)
+    batcher.seal()
+    batcher.add(b"x" * 600)
+    with pytest.raises(SendQueueFullError):
+        batcher.seal()
+
+
+def test_take_consumed():
+    receiver = LinkBatcher(False, False, 1024 * 1024)
+    receiver.unpack(b"x" * (LinkBatcher.CREDIT // 2 - 1))
+    assert receiver.take_consumed() == 0
+    receiver.unpack(b"x")
+    assert receiver.take_consumed() == LinkBatcher.CREDIT // 2
+    assert receiver.take_consumed() == 0
@@ -0,0 +1,117 @@
+import socket
+import pytest
+from sendqueue import SendQueue
+from sendqueue import SendQueueFullError
+
+
+class PartialSocket():
+    """
+    Takes at most limit bytes per sendmsg() call, and raises BlockingIOError when limit is 0
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = b""
+
+    def sendmsg(self, buffers, ancdata, flags):
+        if self.limit == 0:
+            raise BlockingIOError()
+        data = b"".join(bytes(buffer) for buffer in buffers)[:self.limit]
+        self.data += data
+        return len(data)
+
+
+def test_queue_up_to_the_limit_keeps_everything():
+    for policy in (SendQueue.POLICY_DROP_OLDEST, SendQueue.POLICY_DISCONNECT, SendQueue.POLICY_PAUSE_READS):
+        queue = SendQueue(10, policy)
+        queue.push(b"12345")
+        queue.push(b"67890")
+        assert len(queue) == 2
+        assert queue.size == 10
+        assert not queue.is_full()
+        assert queue.dropped == 0
+
+
+def test_drop_oldest_over_the_limit():
+    queue = SendQueue(10, SendQueue.POLICY_DROP_OLDEST)
+    queue.push(b"aaaa")
+    queue.push(b"bbbb")
+    queue.push(b"cccc")
+    assert list(queue.frames) == [b"bbbb", b"cccc"]
+    assert queue.size == 8
+    assert queue.dropped == 1
+
+
+def test_drop_oldest_keeps_the_newest_frame_even_if_it_is_too_big():
+    queue = SendQueue(10, SendQueue.POLICY_DROP_OLDEST)
+    queue.push(b"aaaa")
+    queue.push(b"b" * 20)
+    assert list(queue.frames) == [b"b" * 20]
+    assert queue.dropped == 1
+
+
+# The receiver would get a broken message if the rest of a partially sent frame was dropped
+def test_drop_oldest_finishes_a_partially_sent_frame():
+    queue = SendQueue(10, SendQueue.POLICY_DROP_OLDEST)
+    queue.push(b"aaaaaa")
+    sock = PartialSocket(2)
+    assert not queue.flush(sock)
+    assert queue.offset == 2
+    queue.push(b"bbbbbb")
+    queue.push(b"cccccc")
+    assert list(queue.frames) == [b"aaaaaa", b"cccccc"]
+    assert queue.dropped == 1
+    sock.limit = 100
+    assert queue.flush(sock)
+    assert sock.data == b"aaaaaacccccc"
+    assert queue.size == 0
+
+
+def test_disconnect_over_the_limit():
+    queue = SendQueue(10, SendQueue.POLICY_DISCONNECT)
+    queue.push(b"1234567890")
+    with pytest.raises(SendQueueFullError):
+        queue.push(b"x")
+
+
+def test_disconnect_error_is_a_socket_error():
+    queue = SendQueue(0, SendQueue.POLICY_DISCONNECT)
+    with pytest.raises(socket.error):
+        queue.push(b"x")
+
+
+def test_pause_reads_keeps_queueing_until_drained():
+    queue = SendQueue(10, SendQueue.POLICY_PAUSE_READS)
+    for i in range(4):
+        queue.push(b"abcd")
+    assert queue.size == 16
+    assert queue.is_full()
+    assert not queue.has_drained()
+    sock = PartialSocket(11)
+    assert not queue.flush(sock)
+    assert queue.size == 5
+    assert queue.has_drained()
+    sock.limit = 100
+    assert queue.flush(sock)
+    assert sock.data == b"abcd" * 4
+
+
+def test_flush_would_block():
+    queue = SendQueue(10, SendQueue.POLICY_DISCONNECT)
+    queue.push(b"abc")
+    assert not queue.flush(PartialSocket(0))
+    assert queue.size == 3
+
+
+def test_flush_to_socket():
+    reader, writer = socket.socketpair()
+    try:
+        queue = SendQueue(1024, SendQueue.POLICY_DISCONNECT)
+        queue.push(b"one\n")
+        queue.push(b"two\n")
+        assert queue.flush(writer)
+        assert len(queue) == 0
+        assert reader.recv(100) == b"one\ntwo\n"
+    finally:
+        reader.close()
+        writer.close()
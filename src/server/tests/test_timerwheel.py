@@ -0,0 +1,85 @@
+from timerwheel import TimerWheel
+
+
+def test_key_expires_at_its_deadline():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.schedule("a", 103)
+    assert wheel.expire(102) == []
+    assert wheel.expire(103) == ["a"]
+    assert "a" not in wheel
+    assert len(wheel) == 0
+
+
+def test_deadline_is_rounded_up_to_a_tick():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.schedule("a", 102.2)
+    assert wheel.expire(102.9) == []
+    assert wheel.expire(103) == ["a"]
+
+
+def test_cancel():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.schedule("a", 102)
+    wheel.schedule("b", 102)
+    wheel.cancel("a")
+    assert "a" not in wheel
+    assert wheel.expire(105) == ["b"]
+
+
+def test_cancel_unknown_key():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.cancel("a")
+    wheel.schedule("a", 101)
+    wheel.cancel("a")
+    wheel.cancel("a")
+    assert wheel.expire(110) == []
+
+
+def test_rearm_moves_the_deadline():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.schedule("a", 102)
+    wheel.schedule("a", 105)
+    assert len(wheel) == 1
+    assert wheel.expire(104) == []
+    assert wheel.expire(105) == ["a"]
+
+
+def test_rearm_to_an_earlier_deadline():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.schedule("a", 106)
+    wheel.schedule("a", 101)
+    assert wheel.expire(101) == ["a"]
+    assert wheel.expire(110) == []
+
+
+def test_rearm_after_expiry():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.schedule("a", 101)
+    assert wheel.expire(101) == ["a"]
+    wheel.schedule("a", 103)
+    assert wheel.expire(103) == ["a"]
+
+
+def test_deadline_in_the_past_expires_on_the_next_tick():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.schedule("a", 50)
+    assert wheel.expire(100.5) == []
+    assert wheel.expire(101) == ["a"]
+
+
+# A deadline more than one round of slots ahead shares its slot with earlier ticks
+def test_deadline_beyond_one_round():
+    wheel = TimerWheel(1, 8, 100)
+    wheel.schedule("far", 120)
+    wheel.schedule("near", 104)
+    assert wheel.expire(112) == ["near"]
+    assert wheel.expire(119) == []
+    assert wheel.expire(120) == ["far"]
+
+
+def test_long_pause_expires_everything_due():
+    wheel = TimerWheel(1, 8, 100)
+    for i in range(20):
+        wheel.schedule(i, 101 + i)
+    assert sorted(wheel.expire(1000)) == list(range(20))
+    assert len(wheel) == 0
@@ -0,0 +1,55 @@
+"""
+This module implements a hashed timer wheel
+"""
+
+import math
+
+
+class TimerWheel:
+    """
+    Keeps a deadline for any number of keys. Scheduling and cancelling are O(1), and expire() only touches
+    the slots that have passed since the previous call, so keys that are not due cost nothing.
+    Deadlines are rounded up to whole ticks.
+    """
+
+    def __init__(self, tick, slot_count, now):
+        self.tick = tick  # seconds
+        self.slots = [{} for i in range(slot_count)]  # key -> absolute tick number of its deadline
+        self.ticks = {}  # key -> absolute tick number, for cancelling
+        self.current_tick = math.floor(now / tick)  # the last tick that has been expired
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __contains__(self, key):
+        return key in self.ticks
+
+    def schedule(self, key, deadline):
+        self.cancel(key)
+        tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+        self.slots[tick % len(self.slots)][key] = tick
+        self.ticks[key] = tick
+
+    def cancel(self, key):
+        tick = self.ticks.pop(key, None)
+        if tick is not None:
+            del self.slots[tick % len(self.slots)][key]
+
+    # Remove and return the keys whose deadline is at or before now
+    def expire(self, now):
+        now_tick = math.floor(now / self.tick)
+        if now_tick <= self.current_tick:
+            return []
+        expired = []
+        # Every slot has to be visited at most once, however long it has been since the previous call
+        first_tick = max(self.current_tick + 1, now_tick - len(self.slots) + 1)
+        for tick in range(first_tick, now_tick + 1):
+            slot = self.slots[tick % len(self.slots)]
+            # Keys scheduled more than one round ahead stay in the slot
+            due = [key for key, key_tick in slot.items() if key_tick <= now_tick]
+            for key in due:
+                del slot[key]
+                del self.ticks[key]
+            expired.extend(due)
+        self.current_tick = now_tick
+        return expired
@@ -0,0 +1,131 @@
+import os
+import sys
+import signal
+import socket
+import logging
+from logging.handlers import RotatingFileHandler
+from daemon import Daemon
+
+
+class WorkerGroup(Daemon):
+    """
+    Runs the server in several worker processes that share the client listen port with SO_REUSEPORT, so
+    the kernel spreads the clients between them.
+
+    Worker 0 is the gateway: only it listens for and connects to the other servers. The other workers are
+    linked to the gateway with Unix socket pairs, and channel messages are passed between the workers over
+    them. The rest of the network sees the host as a single server.
+
+    start() is inherited from Daemon class and starts the group as a daemon
+    run() should be used to run the group as a non-daemon
+    """
+
+    def __init__(self, pidfile, worker_count, server_class, ip, client_listen_port, server_listen_port,
+                 existing_server_ip=None, existing_server_port=None, **server_options):
+        self.worker_count = worker_count
+        self.server_class = server_class  # MChatServer or a subclass of it
+        self.ip = ip
+        self.client_listen_port = client_listen_port
+        self.server_listen_port = server_listen_port
+        self.existing_server_ip = existing_server_ip
+        self.existing_server_port = existing_server_port
+        self.server_options = server_options  # keyword arguments for server_class, e.g. overlay=True
+        self.worker_pids = []
+        # The workers log to files of their own, the group only logs its start and stop
+        log_file = ip + "_" + str(client_listen_port) + "_" + "server.log"
+        self.log_file = os.path.abspath(log_file)  # the daemon changes its working directory later
+        self.logger = None
+
+        super(WorkerGroup, self).__init__(pidfile)
+
+    def run(self):
+        """
+        Overrides run() of parent class Daemon
+        """
+        # SIGUSR1 (profiling) would kill a process that hasn't installed its handler yet. It is blocked until then,
+        # in the group and in the workers, which inherit the mask, and a signal sent meanwhile is delivered later.
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+        # links[i - 1] connects the gateway to worker i
+        links = [socket.socketpair() for i in range(1, self.worker_count)]
+
+        for worker_id in range(self.worker_count):
+            if worker_id == 0:
+                worker_links = [link[0] for link in links]
+            else:
+                worker_links = [links[worker_id - 1][1]]
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker(worker_id, worker_links, links)
+            self.worker_pids.append(pid)
+
+        for link in links:
+            link[0].close()
+            link[1].close()
+
+        self.logger = self.logger_setup()
+        self.logger.info("Started {} workers.".format(self.worker_count))
+        signal.signal(signal.SIGTERM, self.sigterm_handler)
+        signal.signal(signal.SIGUSR1, self.sigusr1_handler)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+        try:
+            while self.worker_pids:
+                pid, _ = os.wait()
+                self.worker_pids.remove(pid)
+        except (KeyboardInterrupt, SystemExit):
+            self.stop_workers()
+        self.logger.info("Server stopped.")
+
+    # Runs in the forked worker process and never returns
+    def run_worker(self, worker_id, worker_links, links):
+        try:
+            # Close the ends of the links that belong to the other workers
+            for link in links:
+                for sock in link:
+                    if sock not in worker_links:
+                        sock.close()
+            existing_server_ip = self.existing_server_ip if worker_id == 0 else None
+            existing_server_port = self.existing_server_port if worker_id == 0 else None
+            server = self.server_class(self.pidfile, self.ip, self.client_listen_port, self.server_listen_port,
+                                       existing_server_ip, existing_server_port,
+                                       worker_id=worker_id, worker_links=worker_links, **self.server_options)
+            server.run()
+        finally:
+            # Skip the atexit handlers (e.g. pidfile removal) of the parent
+            os._exit(0)
+
+    # Set up after the workers have been forked, they don't need the handlers of the group
+    def logger_setup(self):
+        group_log = logging.getLogger("Worker Group")
+        group_log.setLevel(logging.INFO)
+        file_handler = RotatingFileHandler(self.log_file, mode='a', maxBytes=1024*1024, backupCount=1)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s'))
+        group_log.addHandler(file_handler)
+        if self.server_options.get("console_log", True):
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(logging.Formatter('%(message)s'))
+            group_log.addHandler(console_handler)
+        return group_log
+
+    def stop_workers(self):
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.worker_pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.worker_pids = []
+
+    def sigterm_handler(self, _signo, _stack_frame):
+        raise SystemExit
+
+    # Every worker profiles itself
+    def sigusr1_handler(self, signo, _stack_frame):
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signo)
+            except OSError:
+                pass